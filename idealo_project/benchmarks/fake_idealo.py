@@ -0,0 +1,108 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PERSISTED_QUERY_NOT_FOUND = {'errors': [{'message': 'PersistedQueryNotFound'}], 'data': None}
+
+
+class FakeIdealoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server.count_request()
+        persisted = payload.get('extensions', {}).get('persistedQuery', {}).get('sha256Hash')
+        if 'query' not in payload and persisted not in server.persisted:
+            return self.send_body(200, json.dumps(PERSISTED_QUERY_NOT_FOUND).encode('utf-8'))
+        if persisted is not None:
+            server.persisted.add(persisted)
+
+        time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+        if random.random() < server.error_rate:
+            return self.send_body(503, b'<html>Service Unavailable</html>', 'text/html')
+
+        variables = payload.get('variables', {})
+        self.send_body(200, json.dumps({'data': {'search': server.search(variables)}}).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeIdealo(ThreadingHTTPServer):
+    '''
+    Local stand-in for app.idealo.de/app-backend/api. Answers Search queries
+    (full, trimmed or persisted) with count generated items per search after
+    latency +- jitter seconds, and with a 503 for error_rate of the requests.
+    Items are deterministic per siteID, category and offset.
+    '''
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.05, jitter=0.01, error_rate=0.0, count=250):
+        super().__init__(address, FakeIdealoHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.count = count
+        self.persisted = set()
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/app-backend/api'
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def search(self, variables):
+        offset, limit = variables.get('offset', 0), variables.get('limit', 10)
+        site_id = variables.get('siteID')
+        category = ','.join(variables.get('filters', {}).get('includeCategories', []))
+        return {
+            'count': self.count,
+            'items': [{
+                'itemId': f'{site_id}-{category}-{index}',
+                'name': f'Item {index} in {category}',
+                'images': {'images350x350': [f'https://cdn.example.com/{site_id}/{index}.jpg']},
+                'url': f'https://www.example.com/{site_id}/{category}/{index}'
+            } for index in range(offset, min(offset + limit, self.count))]
+        }
+
+    def start(self):
+        '''
+        Serves on a daemon thread and returns self.
+        '''
+        threading.Thread(target=self.serve_forever, name='fake-idealo', daemon=True).start()
+        return self
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Idealo search backend.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean response time in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Standard deviation of the response time.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 503.')
+    parser.add_argument('--items', type=int, default=250, help='Result count of every search.')
+    options = parser.parse_args(argv)
+    server = FakeIdealo(('127.0.0.1', options.port), options.latency, options.jitter, options.error_rate, options.items)
+    print(f'Fake Idealo listening on {server.url}', file=sys.stderr)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
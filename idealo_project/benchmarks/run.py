@@ -0,0 +1,283 @@
+'''
+Offline benchmarks of the search endpoints and the Scraper API against the
+local fake backend (benchmarks/fake_idealo.py).
+
+    python -m benchmarks.run                          # all scenarios, WSGI and ASGI, cache on and off
+    python -m benchmarks.run --scenarios post --requests 2000 --concurrency 32 --latency 0.1
+    python -m benchmarks.run --save baseline.json
+    python -m benchmarks.run --compare baseline.json  # exits 1 on a regression
+
+Every combination runs in its own worker process with benchmarks.settings.
+WSGI drives the sync views through Django's WSGI handler from a thread pool,
+ASGI drives the async views (IDEALO_ASYNC_VIEWS=1) through the ASGI handler
+on one event loop. Both are called in-process (django.test clients), so the
+numbers cover Django, the views, cache, quota and scraper, but no web server.
+'''
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REGIONS = ('AT', 'DE', 'ES', 'FR', 'IT', 'UK')
+CATEGORIES = tuple(str(3686 + index) for index in range(20))
+
+SERVERS = ('wsgi', 'asgi')
+CACHES = ('on', 'off')
+SCENARIOS = {
+    # name: (description, goes through the search cache)
+    'get': ('GET /data/idealo/<region>', True),
+    'post': ('POST /data/idealo, 120 distinct searches', True),
+    'scraper': ('Scraper.fetch, limit 100', False),
+    'scraper-deep': ('Scraper.fetch_deep, total 500', False),
+}
+
+
+def search(index, limit=10):
+    '''
+    The index-th search of a rotation over REGIONS x CATEGORIES.
+    '''
+    return {
+        "limit": limit,
+        "minPrice": 10,
+        "maxPrice": 2000,
+        "includeCategories": [CATEGORIES[index // len(REGIONS) % len(CATEGORIES)]],
+        "sort": "RELEVANCE",
+        "region": REGIONS[index % len(REGIONS)]
+    }
+
+
+def percentile(samples, fraction):
+    '''
+    Nearest-rank percentile of sorted samples.
+    '''
+    if not samples:
+        return 0.0
+    return samples[max(0, math.ceil(fraction * len(samples)) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)
+    }
+
+
+# Worker side: runs inside a process set up with benchmarks.settings
+
+def setup_worker():
+    sys.path.insert(0, PROJECT_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from idealo_app.models import APIKey
+    from idealo_app.quota import QUOTA_WINDOW
+    call_command('migrate', verbosity=0)
+    api_key = APIKey.objects.create(email='benchmark@example.com', subscription_type='premium',
+                                    requests_left=10 ** 9, expiry=round(time.time() + QUOTA_WINDOW))
+    return str(api_key.key)
+
+
+def sync_call(scenario, api_key):
+    from django.test import Client
+    from modules.idealo import get_scraper
+    local = threading.local()
+
+    def call(index):
+        if scenario == 'scraper':
+            result = get_scraper().fetch(**search(index, 100))
+            return bool(result[0] and result[2])
+        if scenario == 'scraper-deep':
+            params = search(index)
+            del params['limit']
+            result = get_scraper().fetch_deep(500, **params)
+            return bool(result[0] and result[2])
+        if not hasattr(local, 'client'):
+            local.client = Client(raise_request_exception=False)
+        if scenario == 'get':
+            response = local.client.get(f'/data/idealo/{REGIONS[index % len(REGIONS)]}')
+        else:
+            response = local.client.post('/data/idealo', json.dumps(search(index)), content_type='application/json',
+                                         headers={'X-API-Key': api_key})
+        return response.status_code == 200
+    return call
+
+
+def async_call(scenario, api_key):
+    from django.test import AsyncClient
+    from modules.idealo import get_async_scraper
+    client = AsyncClient(raise_request_exception=False)
+    headers = {'X-API-Key': api_key}
+
+    async def call(index):
+        if scenario == 'scraper':
+            result = await get_async_scraper().fetch(**search(index, 100))
+            return bool(result[0] and result[2])
+        if scenario == 'scraper-deep':
+            params = search(index)
+            del params['limit']
+            result = await get_async_scraper().fetch_deep(500, **params)
+            return bool(result[0] and result[2])
+        if scenario == 'get':
+            response = await client.get(f'/data/idealo/{REGIONS[index % len(REGIONS)]}')
+        else:
+            response = await client.post('/data/idealo', json.dumps(search(index)), content_type='application/json', headers=headers)
+        return response.status_code == 200
+    return call
+
+
+def run_sync(call, requests, concurrency, warmup):
+    latencies, errors = [], 0
+
+    def timed(index):
+        start_time = time.perf_counter()
+        is_success = call(index)
+        return time.perf_counter() - start_time, is_success
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(warmup)))
+        start_time = time.perf_counter()
+        for latency, is_success in executor.map(timed, range(warmup, warmup + requests)):
+            latencies.append(latency)
+            errors += not is_success
+        elapsed = time.perf_counter() - start_time
+    return summarize(latencies, errors, elapsed)
+
+
+async def run_async(call, requests, concurrency, warmup):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(index):
+        async with semaphore:
+            start_time = time.perf_counter()
+            is_success = await call(index)
+            return time.perf_counter() - start_time, is_success
+
+    await asyncio.gather(*[timed(index) for index in range(warmup)])
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*[timed(index) for index in range(warmup, warmup + requests)])
+    elapsed = time.perf_counter() - start_time
+    return summarize([latency for latency, _ in results], sum(not is_success for _, is_success in results), elapsed)
+
+
+def worker(options):
+    api_key = setup_worker()
+    if options.server == 'asgi':
+        result = asyncio.run(run_async(async_call(options.scenario, api_key), options.requests, options.concurrency, options.warmup))
+    else:
+        result = run_sync(sync_call(options.scenario, api_key), options.requests, options.concurrency, options.warmup)
+    print(json.dumps(result))
+
+
+# Orchestrator side
+
+def run_worker(scenario, server, cache, options, upstream):
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ,
+                   DJANGO_SETTINGS_MODULE='benchmarks.settings',
+                   IDEALO_BENCH_UPSTREAM=upstream,
+                   IDEALO_BENCH_DB=os.path.join(directory, 'benchmark.db'),
+                   IDEALO_ASYNC_VIEWS='1' if server == 'asgi' else '0',
+                   IDEALO_CACHE_BACKEND='inprocess' if cache == 'on' else 'none')
+        command = [sys.executable, '-m', 'benchmarks.run', '--worker', '--scenario', scenario, '--server', server,
+                   '--requests', str(options.requests), '--concurrency', str(options.concurrency), '--warmup', str(options.warmup)]
+        completed = subprocess.run(command, cwd=PROJECT_DIR, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f'Benchmark worker {scenario}/{server}/cache {cache} failed:\n{completed.stderr}')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def print_table(results):
+    columns = ('scenario', 'server', 'cache', 'requests', 'errors', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'upstream_requests')
+    rows = [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[index]) for row in rows)) for index, column in enumerate(columns)]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def regressions(results, baseline, tolerance):
+    '''
+    Results whose p95 rose or throughput fell by more than tolerance
+    compared to the same combination in baseline.
+    '''
+    previous = {(result['scenario'], result['server'], result['cache']): result for result in baseline}
+    found = []
+    for result in results:
+        before = previous.get((result['scenario'], result['server'], result['cache']))
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            found.append(f"{result['scenario']}/{result['server']}/cache {result['cache']}: p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            found.append(f"{result['scenario']}/{result['server']}/cache {result['cache']}: throughput {before['throughput']} -> {result['throughput']} req/s")
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the API against a local fake Idealo backend.')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--servers', nargs='+', choices=SERVERS, default=list(SERVERS))
+    parser.add_argument('--cache', nargs='+', choices=CACHES, default=list(CACHES))
+    parser.add_argument('--requests', type=int, default=500, help='Measured requests per combination.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight.')
+    parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests before measuring.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean fake backend response time in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Standard deviation of the backend response time.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of backend requests answered with 503.')
+    parser.add_argument('--items', type=int, default=250, help='Result count of every backend search.')
+    parser.add_argument('--save', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Baseline JSON file from --save; exit 1 on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed p95/throughput change for --compare.')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--server', help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    if options.worker:
+        return worker(options)
+
+    sys.path.insert(0, PROJECT_DIR)
+    from benchmarks.fake_idealo import FakeIdealo
+    backend = FakeIdealo(latency=options.latency, jitter=options.jitter, error_rate=options.error_rate, count=options.items).start()
+    results = []
+    for scenario in options.scenarios:
+        _, is_cached = SCENARIOS[scenario]
+        for server in options.servers:
+            for cache in options.cache if is_cached else ['-']:
+                requests_before = backend.requests
+                result = run_worker(scenario, server, cache if is_cached else 'off', options, backend.url)
+                results.append({'scenario': scenario, 'server': server, 'cache': cache, **result,
+                                'upstream_requests': backend.requests - requests_before})
+                print(f"{scenario}/{server}/cache {cache}: {result['throughput']} req/s, p95 {result['p95_ms']} ms", file=sys.stderr)
+    backend.shutdown()
+
+    print_table(results)
+    if options.save:
+        with open(options.save, 'w') as file:
+            json.dump(results, file, indent=4)
+    if options.compare:
+        with open(options.compare) as file:
+            found = regressions(results, json.load(file), options.tolerance)
+        for regression in found:
+            print(f'REGRESSION {regression}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
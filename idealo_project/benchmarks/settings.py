@@ -0,0 +1,26 @@
+'''
+Settings for benchmark workers (see benchmarks/run.py): the project settings
+pointed at the fake backend and a scratch database, without throttling.
+'''
+import os
+from idealo_project.settings import *
+from idealo_project.database import database_config
+
+ALLOWED_HOSTS = ['*']
+
+DATABASES = {
+    'default': database_config(f"sqlite:///{os.environ.get('IDEALO_BENCH_DB', BASE_DIR / 'benchmark.db')}",
+                               conn_max_age=DATABASES['default']['CONN_MAX_AGE'], conn_health_checks=True)
+}
+
+REST_FRAMEWORK = dict(REST_FRAMEWORK, DEFAULT_THROTTLE_CLASSES=[])
+
+IDEALO_TRANSPORT = dict(IDEALO_TRANSPORT, url=os.environ.get('IDEALO_BENCH_UPSTREAM', 'http://127.0.0.1:8765/app-backend/api'))
+
+IDEALO_PREWARM = dict(IDEALO_PREWARM, IN_PROCESS=False)
+
+# all requests come from one API key, which would otherwise measure the per-key cap
+IDEALO_SCHEDULER = dict(IDEALO_SCHEDULER, per_key_concurrency=int(os.environ.get(
+    'IDEALO_UPSTREAM_CONCURRENCY_PER_KEY', IDEALO_SCHEDULER['max_concurrency'])))
+
+LOGGING = dict(LOGGING, loggers={name: dict(logger, level='WARNING') for name, logger in LOGGING['loggers'].items()})
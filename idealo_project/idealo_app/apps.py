@@ -6,3 +6,13 @@ class IdealoAppConfig(AppConfig):
     name = 'idealo_app'
     def ready(self):
         import idealo_app.signals
+        from django.conf import settings
+        from modules import transport, payload, resilience, scheduler
+        if getattr(settings, 'IDEALO_TRANSPORT', None):
+            transport.configure(**settings.IDEALO_TRANSPORT)
+        if getattr(settings, 'IDEALO_PAYLOAD_MODE', None):
+            payload.configure(settings.IDEALO_PAYLOAD_MODE)
+        if getattr(settings, 'IDEALO_RESILIENCE', None):
+            resilience.configure(**settings.IDEALO_RESILIENCE)
+        if getattr(settings, 'IDEALO_SCHEDULER', None):
+            scheduler.configure(**settings.IDEALO_SCHEDULER)
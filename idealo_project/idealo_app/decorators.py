@@ -1,10 +1,20 @@
 from django.http import JsonResponse
 from .models import APIKey
+from modules.metrics import AUTH_SECONDS
+from modules.scheduler import client
+import threading
+import time
 import uuid
 
 WHITELISTED_IPS = ['127.0.0.1']
 SECRET_TOKEN = "YOUR_SECRET_TOKEN"
 
+API_KEY_CACHE_TTL = 5
+API_KEY_CACHE_MAX_ENTRIES = 10000
+
+_api_key_cache = {}
+_api_key_cache_lock = threading.Lock()
+
 
 def validate_uuid_v4(value):
     try:
@@ -14,6 +24,56 @@ def validate_uuid_v4(value):
         return False
 
 
+def _cached_api_key(api_key):
+    cached = _api_key_cache.get(api_key)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached
+    return None
+
+
+def _cache_api_key(api_key, api_key_instance):
+    with _api_key_cache_lock:
+        if len(_api_key_cache) >= API_KEY_CACHE_MAX_ENTRIES:
+            _api_key_cache.clear()
+        _api_key_cache[api_key] = (api_key_instance, time.monotonic() + API_KEY_CACHE_TTL)
+
+
+def invalidate_api_key(api_key):
+    with _api_key_cache_lock:
+        _api_key_cache.pop(str(api_key), None)
+
+
+def resolve_api_key(api_key):
+    '''
+    Returns the active APIKey for api_key or None. Malformed keys are rejected
+    without a DB hit, lookups (including misses) are cached for
+    API_KEY_CACHE_TTL seconds and invalidated on save/delete (signals.py).
+    '''
+    with AUTH_SECONDS.time():
+        if validate_uuid_v4(api_key) == False:
+            return None
+        api_key = str(uuid.UUID(api_key))
+        cached = _cached_api_key(api_key)
+        if cached is not None:
+            return cached[0]
+        api_key_instance = APIKey.objects.filter(key=api_key, is_active=True).first()
+        _cache_api_key(api_key, api_key_instance)
+        return api_key_instance
+
+
+async def aresolve_api_key(api_key):
+    with AUTH_SECONDS.time():
+        if validate_uuid_v4(api_key) == False:
+            return None
+        api_key = str(uuid.UUID(api_key))
+        cached = _cached_api_key(api_key)
+        if cached is not None:
+            return cached[0]
+        api_key_instance = await APIKey.objects.filter(key=api_key, is_active=True).afirst()
+        _cache_api_key(api_key, api_key_instance)
+        return api_key_instance
+
+
 def restrict_ip_address(view_func):
     def _wrapped_view_func(request, *args, **kwargs):
         if request.META['REMOTE_ADDR'] not in WHITELISTED_IPS:
@@ -27,7 +87,23 @@ def require_api_key(view_func):
         api_key = request.headers.get('X-API-Key')
         if not api_key:
             return JsonResponse({"detail": "No API Key provided"}, status=401)
-        elif validate_uuid_v4(api_key) == False or not APIKey.objects.filter(key=api_key, is_active=True).exists():
+        request.api_key = resolve_api_key(api_key)
+        if request.api_key is None:
             return JsonResponse({"detail": "Invalid API Key"}, status=401)
-        return view_func(request, *args, **kwargs)
+        # upstream calls of the view are scheduled as this key's
+        with client(request.api_key.pk, request.api_key.subscription_type):
+            return view_func(request, *args, **kwargs)
+    return _wrapped_view_func
+
+
+def async_require_api_key(view_func):
+    async def _wrapped_view_func(request, *args, **kwargs):
+        api_key = request.headers.get('X-API-Key')
+        if not api_key:
+            return JsonResponse({"detail": "No API Key provided"}, status=401)
+        request.api_key = await aresolve_api_key(api_key)
+        if request.api_key is None:
+            return JsonResponse({"detail": "Invalid API Key"}, status=401)
+        with client(request.api_key.pk, request.api_key.subscription_type):
+            return await view_func(request, *args, **kwargs)
     return _wrapped_view_func
@@ -0,0 +1,187 @@
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.db import transaction
+from django.db.models import Max
+from modules.items import dumps
+from .models import ItemSnapshot, ItemCategory, HistoryLock
+
+logger = logging.getLogger(__name__)
+
+MAX_KNOWN = 100000
+MAX_CHANGES = 1000
+MAX_FLUSH_ATTEMPTS = 3
+
+
+def item_digest(item):
+    return hashlib.sha1(dumps([item.name, item.images, item.url])).hexdigest()
+
+
+def snapshot_dict(snapshot):
+    return {
+        'itemId': snapshot.item_id,
+        'name': snapshot.name,
+        'images': snapshot.images,
+        'url': snapshot.url,
+        'changedAt': snapshot.changed_at
+    }
+
+
+class HistoryRecorder:
+    '''
+    Collects the items of upstream searches and writes them to ItemSnapshot
+    every flush_interval seconds in one transaction. A snapshot is only
+    written if the item's digest differs from its latest one; the latest
+    digests are kept in an LRU so most items need no lookup. Each flush
+    first applies the snapshots other workers wrote since the previous one,
+    so the LRU never hides a change. Items of a batch that failed to flush
+    max_attempts times are dropped.
+    '''
+
+    def __init__(self, flush_interval=5, max_known=MAX_KNOWN, max_attempts=MAX_FLUSH_ATTEMPTS):
+        self.flush_interval = flush_interval
+        self.max_known = max_known
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.pending = []
+        self.attempts = 0
+        self.known = OrderedDict()
+        self.synced_id = None
+        self.flusher = None
+
+    def record(self, params, items):
+        '''
+        Queues the items of a search. Projected searches (fields) are skipped,
+        since partial items would look like changes.
+        '''
+        if params.get('fields') is not None or not items:
+            return
+        with self.lock:
+            self.pending.append((params['region'], params['includeCategories'], items, round(time.time() * 1000)))
+        self.start()
+
+    def remember(self, key, digest):
+        self.known[key] = digest
+        self.known.move_to_end(key)
+        while len(self.known) > self.max_known:
+            self.known.popitem(last=False)
+
+    def latest_digests(self, keys):
+        '''
+        Latest stored digest per (region, item_id) for keys not in the LRU.
+        '''
+        digests = {}
+        by_region = {}
+        for region, item_id in keys:
+            by_region.setdefault(region, []).append(item_id)
+        for region, item_ids in by_region.items():
+            rows = ItemSnapshot.objects.filter(region=region, item_id__in=item_ids) \
+                .order_by('item_id', '-changed_at').values_list('item_id', 'digest')
+            for item_id, digest in rows:
+                digests.setdefault((region, item_id), digest)
+        return digests
+
+    def sync(self):
+        '''
+        Updates the LRU with the snapshots written since the last flush,
+        including those of other workers.
+        '''
+        if self.synced_id is None:
+            self.synced_id = ItemSnapshot.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+            return
+        rows = ItemSnapshot.objects.filter(id__gt=self.synced_id).order_by('id') \
+            .values_list('id', 'region', 'item_id', 'digest')
+        with self.lock:
+            for snapshot_id, region, item_id, digest in rows:
+                if (region, item_id) in self.known:
+                    self.remember((region, item_id), digest)
+                self.synced_id = snapshot_id
+
+    def write(self, pending):
+        latest = {}
+        categories = set()
+        for region, includeCategories, items, seen_at in pending:
+            for item in items:
+                latest[(region, item.itemId)] = (item, seen_at)
+                categories.update((region, category, item.itemId) for category in includeCategories)
+
+        with transaction.atomic():
+            # held until commit: snapshot ids are committed in increasing order
+            HistoryLock.objects.select_for_update().get_or_create(pk=1)
+            self.sync()
+            with self.lock:
+                known = {key: self.known[key] for key in latest if key in self.known}
+            known.update(self.latest_digests([key for key in latest if key not in known]))
+
+            snapshots = []
+            for (region, item_id), (item, seen_at) in latest.items():
+                digest = item_digest(item)
+                if known.get((region, item_id)) != digest:
+                    snapshots.append(ItemSnapshot(region=region, item_id=item_id, name=item.name or '', images=item.images,
+                                                  url=item.url or '', digest=digest, changed_at=seen_at))
+            ItemSnapshot.objects.bulk_create(snapshots)
+            ItemCategory.objects.bulk_create([ItemCategory(region=region, category=category, item_id=item_id)
+                                              for region, category, item_id in categories], ignore_conflicts=True)
+        return snapshots
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        try:
+            snapshots = self.write(pending)
+        except Exception:
+            with self.lock:
+                self.attempts += 1
+                if self.attempts < self.max_attempts:
+                    self.pending = pending + self.pending
+                else:
+                    self.attempts = 0
+                    logger.error(f'Dropping {len(pending)} item history searches after {self.max_attempts} failed flushes')
+            raise
+        with self.lock:
+            self.attempts = 0
+            for snapshot in snapshots:
+                self.remember((snapshot.region, snapshot.item_id), snapshot.digest)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'Error flushing item history: {str(e)}')
+
+    def start(self):
+        if self.flusher is None:
+            with self.lock:
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self.run, name='history-flush', daemon=True)
+                    self.flusher.start()
+                    atexit.register(self.flush)
+
+
+def item_history(region, item_id):
+    return [snapshot_dict(snapshot) for snapshot in
+            ItemSnapshot.objects.filter(region=region, item_id=item_id).order_by('changed_at', 'id')]
+
+
+def changes_since(region, category, since, limit=MAX_CHANGES):
+    '''
+    Snapshots written after the cursor since for items of a category, in
+    the order they were committed. Returns (snapshots, until, is_complete):
+    poll again with since=until. The cursor is the snapshot id, which
+    HistoryLock keeps increasing in commit order, so rows flushed late
+    (e.g. retried) are not skipped the way a changed_at cursor would.
+    '''
+    item_ids = ItemCategory.objects.filter(region=region, category=category).values('item_id')
+    snapshots = list(ItemSnapshot.objects.filter(region=region, item_id__in=item_ids, id__gt=since)
+                     .order_by('id')[:limit + 1])
+    is_complete = len(snapshots) <= limit
+    snapshots = snapshots[:limit]
+    until = snapshots[-1].id if snapshots else since
+    return [snapshot_dict(snapshot) for snapshot in snapshots], until, is_complete
@@ -0,0 +1,64 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from modules.export import Exporter, plan, validate_export, TOTAL
+
+
+def price_band(value):
+    minPrice, _, maxPrice = value.partition('-')
+    try:
+        return [int(minPrice), int(maxPrice)]
+    except ValueError:
+        raise ValueError(f"Invalid price band '{value}', expected MIN-MAX")
+
+
+class Command(BaseCommand):
+    help = ('Exports the items of regions x categories x price bands to chunked NDJSON, CSV or Parquet files. '
+            'Run it again on the same directory to resume an interrupted export.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Output directory, holds the part files and checkpoint.json.')
+        parser.add_argument('--regions', nargs='+', help='e.g. DE AT')
+        parser.add_argument('--categories', nargs='+', help='Category ids, e.g. 3686 3751')
+        parser.add_argument('--price-bands', nargs='+', type=price_band, help='Price bands as MIN-MAX, e.g. 0-100 100-500')
+        parser.add_argument('--format', default='ndjson', help='ndjson, csv or parquet (default ndjson).')
+        parser.add_argument('--total', type=int, default=TOTAL, help=f'Items per combination (default {TOTAL}).')
+        parser.add_argument('--sort', default='RELEVANCE')
+        parser.add_argument('--parallelism', type=int, default=settings.IDEALO_EXPORT['parallelism'],
+                            help='Combinations fetched at once.')
+        parser.add_argument('--chunk-rows', type=int, default=settings.IDEALO_EXPORT['chunk_rows'],
+                            help='Rows after which a new part file is started.')
+
+    def progress(self, state):
+        self.stdout.write(f"{len(state['done'])}/{len(state['tasks'])} combinations, {state['rows']} rows, "
+                          f"{len(state['parts'])} files")
+
+    def handle(self, *args, **options):
+        tasks = None
+        if options['regions'] or options['categories'] or options['price_bands']:
+            data = {
+                'regions': options['regions'],
+                'categories': options['categories'],
+                'priceBands': options['price_bands'],
+                'format': options['format'],
+                'total': options['total'],
+                'sort': options['sort']
+            }
+            is_payload_valid, validation_msg = validate_export(data)
+            if not is_payload_valid:
+                raise CommandError(validation_msg)
+            tasks = plan(data['regions'], data['categories'], data['priceBands'])
+
+        exporter = Exporter(options['directory'], options['format'], options['total'], options['sort'],
+                            options['parallelism'], options['chunk_rows'], progress=self.progress)
+        start_time = time.time()
+        try:
+            state = exporter.run(tasks)
+        except ValueError as e:
+            raise CommandError(str(e))
+        for key, error in state['failed'].items():
+            self.stderr.write(self.style.WARNING(f'{key}: {error}'))
+        self.stdout.write(f"Export {state['status']}: {state['rows']} rows in {len(state['parts'])} files "
+                          f"in {round(time.time() - start_time, 2)} s")
+        if state['failed']:
+            self.stdout.write('Run the command again to retry the failed combinations.')
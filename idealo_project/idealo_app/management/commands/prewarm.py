@@ -0,0 +1,30 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from idealo_app.services import prewarmer
+
+
+class Command(BaseCommand):
+    help = 'Keeps popular searches warm in the search cache by refreshing them on a schedule.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run a single refresh round and exit.')
+        parser.add_argument('--top', type=int, help='Number of popular searches to keep warm.')
+        parser.add_argument('--interval', type=int, help='Seconds between refresh rounds.')
+
+    def handle(self, *args, **options):
+        if options['top'] is not None:
+            prewarmer.top_n = options['top']
+        if options['interval'] is not None:
+            prewarmer.interval = options['interval']
+        if settings.IDEALO_CACHE.get('BACKEND', 'inprocess') == 'inprocess':
+            self.stderr.write(self.style.WARNING(
+                "IDEALO_CACHE uses the 'inprocess' backend: only this process's cache is warmed. "
+                "Use a shared backend (IDEALO_CACHE_BACKEND=django) to warm the web workers."))
+        while True:
+            start_time = time.time()
+            refreshed = prewarmer.run_once()
+            self.stdout.write(f'Refreshed {refreshed} searches in {round((time.time() - start_time) * 1000, 2)} ms')
+            if options['once']:
+                return
+            time.sleep(prewarmer.interval)
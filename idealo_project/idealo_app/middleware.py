@@ -0,0 +1,145 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from modules.compression import Compressor
+from modules.metrics import HTTP_REQUEST_SECONDS, HTTP_REQUESTS_IN_FLIGHT
+from .renderers import NDJSON_MEDIA_TYPE
+
+COMPRESSIBLE_TYPES = ('application/json', NDJSON_MEDIA_TYPE, 'application/msgpack', 'text/')
+
+
+def route(request):
+    '''
+    The matched URL pattern (e.g. 'data/idealo/<str:region>'), keeping the
+    label set small whatever the path.
+    '''
+    resolver_match = getattr(request, 'resolver_match', None)
+    return resolver_match.route if resolver_match is not None else 'unmatched'
+
+
+class MetricsMiddleware:
+    '''
+    Records in-flight requests and the time until the view returned its
+    response, by method, route and status. Streamed bodies are sent after
+    this point and are not included.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def observe(self, request, response, start_time):
+        HTTP_REQUEST_SECONDS.labels(request.method, route(request), response.status_code).observe(
+            time.perf_counter() - start_time)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start_time = time.perf_counter()
+        with HTTP_REQUESTS_IN_FLIGHT.track():
+            response = self.get_response(request)
+        self.observe(request, response, start_time)
+        return response
+
+    async def __acall__(self, request):
+        start_time = time.perf_counter()
+        with HTTP_REQUESTS_IN_FLIGHT.track():
+            response = await self.get_response(request)
+        self.observe(request, response, start_time)
+        return response
+
+
+def item_span(response, body):
+    '''
+    (start, end) of the items in a search result body: the whole NDJSON
+    body, or the trailing "data" array of a compact JSON body.
+    '''
+    content_type = response.get('Content-Type', '')
+    if content_type.startswith(NDJSON_MEDIA_TYPE):
+        return 0, len(body)
+    if content_type.startswith('application/json') and body.endswith(b']}'):
+        start = body.find(b'"data":[')
+        if start != -1:
+            return start, len(body) - 1
+    return None
+
+
+class CompressionMiddleware:
+    '''
+    Compresses responses with the best of zstd, br and gzip the client
+    accepts (see settings.IDEALO_COMPRESSION). Bodies below MIN_SIZE and
+    non-text content types are sent as is. Streamed bodies are compressed
+    chunk by chunk, each flushed so NDJSON pages still arrive as they are
+    fetched. The items of search results are compressed once per ETag and
+    reused from a cache.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.compressor = Compressor(**settings.IDEALO_COMPRESSION['OPTIONS'])
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def encoding(self, request, response):
+        if response.has_header('Content-Encoding') or 'no-transform' in response.get('Cache-Control', ''):
+            return None
+        if not response.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+            return None
+        if not response.streaming and len(response.content) < self.compressor.min_size:
+            return None
+        return self.compressor.negotiate(request.headers.get('Accept-Encoding'))
+
+    def compress(self, request, response):
+        # the variant depends on Accept-Encoding whether or not it is compressed
+        if response.status_code == 304 or response.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+            patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = self.encoding(request, response)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            compress, finish = self.compressor.stream(encoding)
+            if response.is_async:
+                response.streaming_content = self.acompress_stream(response.streaming_content, compress, finish)
+            else:
+                response.streaming_content = self.compress_stream(response.streaming_content, compress, finish)
+            del response.headers['Content-Length']
+        else:
+            body = response.content
+            tag = response.get('ETag')
+            span = item_span(response, body) if tag else None
+            response.content = self.compressor.compress(encoding, body, tag, span)
+            response.headers['Content-Length'] = str(len(response.content))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            # the compressed body is no longer byte-identical to the tagged one
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def compress_stream(self, chunks, compress, finish):
+        for chunk in chunks:
+            if chunk:
+                yield compress(chunk)
+        yield finish()
+
+    async def acompress_stream(self, chunks, compress, finish):
+        async for chunk in chunks:
+            if chunk:
+                yield compress(chunk)
+        yield finish()
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.compress(request, await self.get_response(request))
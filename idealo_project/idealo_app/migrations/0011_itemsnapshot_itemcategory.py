@@ -0,0 +1,42 @@
+# Generated by Django 4.2.4 on 2026-10-18 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idealo_app', '0010_alter_apikey_requests_left'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemCategory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('region', models.CharField(max_length=2)),
+                ('category', models.CharField(max_length=32)),
+                ('item_id', models.CharField(max_length=32)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ItemSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('region', models.CharField(max_length=2)),
+                ('item_id', models.CharField(max_length=32)),
+                ('name', models.TextField()),
+                ('images', models.JSONField(null=True)),
+                ('url', models.TextField()),
+                ('digest', models.CharField(max_length=40)),
+                ('changed_at', models.BigIntegerField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['region', 'item_id', 'changed_at'], name='snapshot_region_item_time'), models.Index(fields=['region', 'changed_at'], name='snapshot_region_time')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='itemcategory',
+            constraint=models.UniqueConstraint(fields=('region', 'category', 'item_id'), name='unique_item_category'),
+        ),
+    ]
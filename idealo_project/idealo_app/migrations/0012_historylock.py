@@ -0,0 +1,19 @@
+# Generated by Django 4.2.4 on 2026-10-18 12:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idealo_app', '0011_itemsnapshot_itemcategory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+        ),
+    ]
@@ -9,3 +9,45 @@ class APIKey(models.Model):
     key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
     requests_left = models.IntegerField(default=1000) 
     expiry = models.BigIntegerField(default=None)
+
+
+class ItemSnapshot(models.Model):
+    '''
+    Append-only item history: a row is only added when an item's fields
+    differ from its previous snapshot. changed_at is epoch milliseconds.
+    '''
+    region = models.CharField(max_length=2)
+    item_id = models.CharField(max_length=32)
+    name = models.TextField()
+    images = models.JSONField(null=True)
+    url = models.TextField()
+    digest = models.CharField(max_length=40)
+    changed_at = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['region', 'item_id', 'changed_at'], name='snapshot_region_item_time'),
+            models.Index(fields=['region', 'changed_at'], name='snapshot_region_time'),
+        ]
+
+
+class ItemCategory(models.Model):
+    '''
+    Categories an item was found in, used to filter the change feed.
+    '''
+    region = models.CharField(max_length=2)
+    category = models.CharField(max_length=32)
+    item_id = models.CharField(max_length=32)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['region', 'category', 'item_id'], name='unique_item_category'),
+        ]
+
+
+class HistoryLock(models.Model):
+    '''
+    Single row locked by every item history flush. Flushes of all workers
+    are serialized, so ItemSnapshot ids are committed in increasing order
+    and the id can serve as the change feed cursor.
+    '''
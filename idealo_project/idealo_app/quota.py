@@ -0,0 +1,202 @@
+import atexit
+import logging
+import threading
+import time
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models import F
+from .models import APIKey
+from modules.metrics import QUOTA_SECONDS
+
+logger = logging.getLogger(__name__)
+
+REQUESTS_AMOUNT = {
+    'free': 1000,
+    'basic': 5000,
+    'premium': 10000
+}
+
+QUOTA_WINDOW = 30 * 24 * 60 * 60
+
+
+class QuotaEngine:
+    '''
+    Per-key request counters kept in a Django cache instead of the database.
+    Counters are changed with the cache's atomic incr/decr, so with a shared
+    cache (redis/memcached) limits hold across workers. Charges are
+    aggregated per key and written back to APIKey in one transaction every
+    flush_interval seconds.
+
+    A locmem cache is only correct for a single process: every worker would
+    enforce the full quota on its own. With a process-local cache (shared
+    False, the default for locmem) the counters are therefore re-seeded from
+    the database after each flush, so the charges of other workers are seen
+    within flush_interval and an overrun is bounded by what the workers
+    charge in one interval.
+    '''
+
+    def __init__(self, cache_alias='default', flush_interval=5, window=QUOTA_WINDOW, shared=None):
+        self.cache = caches[cache_alias]
+        self.flush_interval = flush_interval
+        self.window = window
+        self.shared = not isinstance(self.cache, LocMemCache) if shared is None else shared
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.resets = {}
+        # keys with a counter in a process-local cache / used since the last resync
+        self.seeded = set()
+        self.touched = set()
+        self.flusher = None
+
+    def counter_key(self, pk):
+        return f'quota:{pk}'
+
+    def expiry_key(self, pk):
+        return f'quota:{pk}:expiry'
+
+    def seed(self, api_key):
+        '''
+        Loads a counter from the APIKey row, minus charges not yet written back.
+        '''
+        with self.lock:
+            pending = self.pending.get(api_key.pk, 0)
+            if not self.shared:
+                self.seeded.add(api_key.pk)
+        self.cache.add(self.expiry_key(api_key.pk), api_key.expiry, None)
+        self.cache.add(self.counter_key(api_key.pk), api_key.requests_left - pending, None)
+
+    def expiry(self, api_key):
+        expiry = self.cache.get(self.expiry_key(api_key.pk))
+        if expiry is None:
+            self.seed(api_key)
+            expiry = self.cache.get(self.expiry_key(api_key.pk), api_key.expiry)
+        return expiry
+
+    def add(self, api_key, delta):
+        try:
+            return self.cache.incr(self.counter_key(api_key.pk), delta)
+        except ValueError:
+            self.seed(api_key)
+            return self.cache.incr(self.counter_key(api_key.pk), delta)
+
+    def renew(self, api_key, now):
+        '''
+        Starts a new window once the expiry has passed: the counter is refilled
+        for the subscription and the expiry moves forward by one window.
+        '''
+        expiry = round(now + self.window)
+        requests_left = REQUESTS_AMOUNT[api_key.subscription_type]
+        self.cache.set(self.expiry_key(api_key.pk), expiry, None)
+        self.cache.set(self.counter_key(api_key.pk), requests_left, None)
+        with self.lock:
+            self.resets[api_key.pk] = (requests_left, expiry)
+            self.pending[api_key.pk] = 0
+        return expiry
+
+    def acquire(self, api_key, requests_needed=1):
+        '''
+        Atomically reserves requests_needed requests. Returns (True, expiry) or
+        (False, expiry) if the key has too few requests left in this window.
+        '''
+        self.start()
+        with QUOTA_SECONDS.time():
+            expiry = self.expiry(api_key)
+            if round(time.time()) >= expiry:
+                expiry = self.renew(api_key, time.time())
+            if self.add(api_key, -requests_needed) < 0:
+                self.add(api_key, requests_needed)
+                return False, expiry
+            with self.lock:
+                self.pending[api_key.pk] = self.pending.get(api_key.pk, 0) + requests_needed
+                self.touched.add(api_key.pk)
+            return True, expiry
+
+    def settle(self, api_key, reserved, used):
+        '''
+        Refunds the unused part of a reservation once the actual cost is
+        known. Nothing is charged beyond what acquire reserved, so callers
+        reserve the most a request can cost (e.g. all pages of a deep fetch).
+        '''
+        refund = reserved - min(used, reserved)
+        if not refund:
+            return
+        self.add(api_key, refund)
+        with self.lock:
+            self.pending[api_key.pk] = self.pending.get(api_key.pk, 0) - refund
+
+    def forget(self, pk):
+        self.cache.delete_many([self.counter_key(pk), self.expiry_key(pk)])
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            resets, self.resets = self.resets, {}
+        if not pending and not resets:
+            if not self.shared:
+                self.resync()
+            return
+        try:
+            with transaction.atomic():
+                for pk, (requests_left, expiry) in resets.items():
+                    APIKey.objects.filter(pk=pk).update(
+                        requests_left=requests_left - pending.get(pk, 0), expiry=expiry)
+                for pk, delta in pending.items():
+                    if delta and pk not in resets:
+                        APIKey.objects.filter(pk=pk).update(
+                            requests_left=F('requests_left') - delta)
+        except Exception:
+            self.restore(pending, resets)
+            raise
+        if not self.shared:
+            self.resync()
+
+    def resync(self):
+        '''
+        Re-seeds the counters of a process-local cache from the database, minus
+        the charges not yet written back. Keys unused since the last resync are
+        dropped and seeded again on their next request.
+        '''
+        with self.lock:
+            idle = self.seeded - self.touched
+            self.seeded, self.touched = self.touched, set()
+        if idle:
+            self.cache.delete_many([key for pk in idle for key in (self.counter_key(pk), self.expiry_key(pk))])
+        if not self.seeded:
+            return
+        rows = APIKey.objects.filter(pk__in=list(self.seeded)).values_list('pk', 'requests_left', 'expiry')
+        with self.lock:
+            for pk, requests_left, expiry in rows:
+                if pk in self.resets:
+                    continue
+                self.cache.set_many({
+                    self.counter_key(pk): requests_left - self.pending.get(pk, 0),
+                    self.expiry_key(pk): expiry
+                }, None)
+
+    def restore(self, pending, resets):
+        '''
+        Puts back deltas of a failed flush, unless the key was renewed since.
+        '''
+        with self.lock:
+            for pk, reset in resets.items():
+                self.resets.setdefault(pk, reset)
+            for pk, delta in pending.items():
+                if self.resets.get(pk) is resets.get(pk):
+                    self.pending[pk] = self.pending.get(pk, 0) + delta
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'Error flushing quota: {str(e)}')
+
+    def start(self):
+        if self.flusher is None:
+            with self.lock:
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self.run, name='quota-flush', daemon=True)
+                    self.flusher.start()
+                    atexit.register(self.flush)
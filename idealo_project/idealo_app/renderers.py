@@ -0,0 +1,95 @@
+from django.http import HttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from modules.items import Item, dumps, packb, msgpack
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+
+
+def wants_ndjson(request):
+    return NDJSON_MEDIA_TYPE in request.headers.get('Accept', '')
+
+
+def wants_msgpack(request):
+    return msgpack is not None and MSGPACK_MEDIA_TYPE in request.headers.get('Accept', '')
+
+
+def ndjson_lines(items):
+    return b''.join(dumps(item) + b'\n' for item in items)
+
+
+def iter_ndjson(pages):
+    for page in pages:
+        if page:
+            yield ndjson_lines(page)
+
+
+async def aiter_ndjson(pages):
+    async for page in pages:
+        if page:
+            yield ndjson_lines(page)
+
+
+class NDJSONRenderer(BaseRenderer):
+    '''
+    Renders the 'data' items of a response one JSON object per line. Other
+    responses (e.g. errors) are rendered as a single line.
+    '''
+    media_type = NDJSON_MEDIA_TYPE
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict) and isinstance(data.get('data'), list):
+            return ndjson_lines(data['data'])
+        return dumps(data) + b'\n'
+
+
+class ItemJSONEncoder(JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Item):
+            return obj.as_dict()
+        return super().default(obj)
+
+
+class FastJSONRenderer(JSONRenderer):
+    '''
+    JSONRenderer that encodes with orjson (see modules.items.dumps) and
+    serializes Item records directly. Indented output (browsable API,
+    Accept: application/json; indent=4) and values orjson cannot encode
+    fall back to the stock renderer.
+    '''
+    encoder_class = ItemJSONEncoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not self.get_indent(accepted_media_type, renderer_context or {}):
+            try:
+                return dumps(data)
+            except TypeError:
+                pass
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+class MsgPackRenderer(BaseRenderer):
+    media_type = MSGPACK_MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return packb(data)
+
+
+def render_response(request, data, status=200, headers=None):
+    '''
+    Content-negotiated response for views outside of DRF (the async views):
+    MessagePack if the client asks for it, JSON otherwise.
+    '''
+    if wants_msgpack(request):
+        return HttpResponse(packb(data), content_type=MSGPACK_MEDIA_TYPE, status=status, headers=headers)
+    return HttpResponse(dumps(data), content_type='application/json', status=status, headers=headers)
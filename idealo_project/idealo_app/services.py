@@ -0,0 +1,90 @@
+import time
+import hashlib
+from django.conf import settings
+from django.utils.http import http_date, parse_etags
+from modules.items import dumps
+from modules.idealo import get_scraper, get_async_scraper
+from modules.cache import build_cache
+from modules.prewarm import build_prewarmer
+from modules.export import ExportJobs
+from .quota import QuotaEngine
+from .history import HistoryRecorder
+
+# Shared per-process instances used by the views
+scraper = get_scraper()
+async_scraper = get_async_scraper()
+search_cache = build_cache(settings.IDEALO_CACHE)
+prewarmer = build_prewarmer(settings.IDEALO_PREWARM, search_cache)
+quota_engine = QuotaEngine(**settings.IDEALO_QUOTA)
+history_recorder = HistoryRecorder(**settings.IDEALO_HISTORY['OPTIONS'])
+if settings.IDEALO_HISTORY['ENABLED']:
+    search_cache.history = history_recorder
+export_jobs = ExportJobs(**settings.IDEALO_EXPORT)
+
+
+CACHE_WARNINGS = {
+    'STALE': '110 - "Response is Stale"',
+    'STALE-IF-ERROR': '111 - "Revalidation Failed"'
+}
+
+
+def cache_headers(cache_status, cache_age):
+    headers = {'X-Cache': cache_status, 'Age': str(cache_age)}
+    if cache_status in CACHE_WARNINGS:
+        headers['Warning'] = CACHE_WARNINGS[cache_status]
+    return headers
+
+
+def etag(items):
+    '''
+    Weak ETag of a search result: a hash of its items only, as the rest of
+    the body (e.g. processing_time_ms) differs between identical results.
+    '''
+    return f'W/"{hashlib.blake2b(dumps(items), digest_size=16).hexdigest()}"'
+
+
+def search_headers(items, cache_status, cache_age, region=None):
+    '''
+    Cache headers of a search result. Given a region (the public GET
+    endpoint), shared caches may keep the result for the rest of its TTL;
+    otherwise clients revalidate with the ETag on every request.
+    '''
+    headers = cache_headers(cache_status, cache_age)
+    headers['ETag'] = etag(items)
+    headers['Last-Modified'] = http_date(time.time() - cache_age)
+    headers['Vary'] = 'Accept'
+    if region is None:
+        headers['Cache-Control'] = 'private, no-cache'
+    else:
+        max_age = 0 if cache_status in CACHE_WARNINGS else max(0, search_cache.ttl(region) - cache_age)
+        headers['Cache-Control'] = f'public, max-age={max_age}, stale-while-revalidate={search_cache.stale_while_revalidate}'
+    return headers
+
+
+def strip_weak(tag):
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def not_modified(request, etag):
+    '''
+    Whether the request's If-None-Match matches etag (weak comparison).
+    '''
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    tags = parse_etags(if_none_match)
+    return tags == ['*'] or strip_weak(etag) in (strip_weak(tag) for tag in tags)
+
+
+def invalid_request(errors):
+    '''
+    Body of a 400 answer listing all validation errors of a request.
+    '''
+    return {'success': False, 'error': '; '.join(errors), 'errors': errors}
+
+
+def stale_marker(cache_status):
+    '''
+    Extra body fields flagging a result served from an expired cache entry.
+    '''
+    return {'stale': True} if cache_status in CACHE_WARNINGS else {}
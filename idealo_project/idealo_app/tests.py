@@ -1,3 +1,1018 @@
-from django.test import TestCase
+import os
+import re
+import gzip
+import importlib
+import time
+import asyncio
+import threading
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import json
+import tempfile
+import unittest
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from django.core.cache import caches
+from django.db import DatabaseError
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from benchmarks.fake_idealo import FakeIdealo
+from modules.cache import SearchCache, InProcessBackend, NullBackend, normalize
+from modules.compression import Compressor
+from modules.idealo import Scraper
+from modules.export import Exporter, plan
+from modules.items import parse_items
+from modules.metrics import CONTENT_TYPE, Registry
+from modules.payload import PayloadCompiler
+from modules.prewarm import PopularityTracker, Prewarmer, UpstreamBudget
+from modules.resilience import Resilience, UpstreamError
+from modules.schema import Schema, Field
+from modules.scheduler import Scheduler, OverloadedError, client as scheduler_client, current as scheduler_current
+from modules.singleflight import SingleFlight
+from modules.transport import Transport, read_body
+from .history import HistoryRecorder, changes_since, item_history
+from .decorators import resolve_api_key
+from .middleware import CompressionMiddleware
+from .models import APIKey
+from .quota import QuotaEngine
 
-# Create your tests here.
+
+class CompressionTests(SimpleTestCase):
+
+    def test_bodies_sharing_a_tag_without_span_are_not_cached(self):
+        compressor = Compressor(encodings=('gzip',), min_size=0)
+        first, second = b'a' * 2000 + b'1', b'b' * 2000 + b'2'
+        compressor.compress('gzip', first, 'W/"tag"')
+        self.assertEqual(gzip.decompress(compressor.compress('gzip', second, 'W/"tag"')), second)
+
+    def test_item_span_is_reused_for_equal_items(self):
+        compressor = Compressor(encodings=('gzip',), min_size=0)
+        items = b'[' + b','.join(b'{"itemId":"%d"}' % index for index in range(100)) + b']'
+        for processing_time in (b'1.5', b'22.75'):
+            body = b'{"success":true,"processing_time_ms":' + processing_time + b',"data":' + items + b'}'
+            start = body.find(b'"data":[')
+            compressed = compressor.compress('gzip', body, 'W/"items"', (start, len(body) - 1))
+            self.assertEqual(gzip.decompress(compressed), body)
+
+    def test_msgpack_responses_sharing_an_etag(self):
+        bodies = [b'\x82' + b'x' * 3000, b'\x83' + b'y' * 3000]
+        responses = iter(HttpResponse(body, content_type='application/msgpack', headers={'ETag': 'W/"same"'}) for body in bodies)
+        middleware = CompressionMiddleware(lambda request: next(responses))
+        for body in bodies:
+            compressed = middleware(RequestFactory().get('/data/idealo/AT', HTTP_ACCEPT_ENCODING='gzip'))
+            self.assertEqual(compressed['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(compressed.content), body)
+
+
+class PersistedQueryTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.backend = FakeIdealo(latency=0, jitter=0).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.backend.shutdown()
+        cls.backend.server_close()
+        super().tearDownClass()
+
+    def test_fallback_registers_the_hash(self):
+        compiler = PayloadCompiler('persisted')
+        scraper = Scraper(transport=Transport(url=self.backend.url), compiler=compiler, resilience=Resilience(retries=0))
+        for max_price in range(2000, 2005):
+            is_payload_valid, validation_msg, items = scraper.fetch(10, 10, max_price, ['3686'], 'RELEVANCE', 'DE')
+            self.assertEqual(len(items), 10)
+        # one PersistedQueryNotFound and its resend, then the hash alone
+        self.assertEqual(self.backend.requests, 6)
+
+    def test_fallback_body_carries_query_and_hash(self):
+        body = json.loads(PayloadCompiler('persisted').compile({'limit': 10}, persisted=False))
+        self.assertIn('query', body)
+        self.assertIn('sha256Hash', body['extensions']['persistedQuery'])
+        self.assertNotIn('extensions', json.loads(PayloadCompiler('full').compile({'limit': 10})))
+
+
+class ResponseLimitTests(SimpleTestCase):
+
+    def setUp(self):
+        self.chunks_read = 0
+
+    def chunks(self, count, size=100):
+        for _ in range(count):
+            self.chunks_read += 1
+            yield b'x' * size
+
+    def test_content_length_is_checked_before_reading(self):
+        response = read_body(200, {'Content-Length': '1000'}, self.chunks(10), max_bytes=999)
+        self.assertTrue(response.too_large)
+        self.assertEqual(self.chunks_read, 0)
+
+    def test_streamed_body_stops_past_the_limit(self):
+        response = read_body(200, {}, self.chunks(10), max_bytes=250)
+        self.assertTrue(response.too_large)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(self.chunks_read, 3)
+        self.assertEqual(read_body(200, {}, self.chunks(10), max_bytes=1000).content, b'x' * 1000)
+
+    def test_oversized_search_is_rejected(self):
+        backend = FakeIdealo(latency=0, jitter=0).start()
+        self.addCleanup(backend.server_close)
+        self.addCleanup(backend.shutdown)
+
+        class SmallScraper(Scraper):
+            MAX_RESPONSE_BYTES = 1024
+        scraper = SmallScraper(transport=Transport(url=backend.url), compiler=PayloadCompiler(), resilience=Resilience(retries=0))
+        self.assertEqual(len(scraper.fetch(1, 10, 2000, ['3686'], 'RELEVANCE', 'DE')[2]), 1)
+        self.assertEqual(scraper.fetch(100, 10, 2000, ['3686'], 'RELEVANCE', 'DE'), (True, 'Error scraping count.', None))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def open_breaker(self, resilience):
+        breaker = resilience.breaker('DE')
+        for _ in range(resilience.failure_threshold):
+            breaker.failure()
+        breaker.opened_at -= resilience.reset_timeout
+        return breaker
+
+    def test_probe_with_unexpected_error_does_not_stick(self):
+        resilience = Resilience(retries=0, failure_threshold=1, reset_timeout=30)
+        breaker = self.open_breaker(resilience)
+
+        def send():
+            raise KeyError('bug')
+        with self.assertRaises(KeyError):
+            resilience.call('DE', send)
+        self.assertEqual(breaker.allow(), (True, True))
+
+    def test_cancelled_probe_does_not_stick(self):
+        resilience = Resilience(retries=0, failure_threshold=1, reset_timeout=30)
+        breaker = self.open_breaker(resilience)
+
+        async def probe():
+            task = asyncio.ensure_future(resilience.acall('DE', lambda: asyncio.sleep(10)))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(probe())
+        self.assertEqual(breaker.allow(), (True, True))
+
+    def test_hedge_pool_is_sized(self):
+        resilience = Resilience(hedge_after=0.01, hedge_workers=80)
+        resilience.attempt('DE', lambda: type('Response', (), {'status_code': 200})())
+        self.assertEqual(resilience.executor._max_workers, 80)
+
+
+class SchedulerTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.backend = FakeIdealo(latency=0.05, jitter=0).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.backend.shutdown()
+        cls.backend.server_close()
+        super().tearDownClass()
+
+    def scraper(self, scheduler):
+        return Scraper(transport=Transport(url=self.backend.url), compiler=PayloadCompiler(),
+                       resilience=Resilience(retries=0), scheduler=scheduler)
+
+    def test_follower_is_not_refused_for_the_leaders_key(self):
+        scheduler = Scheduler(max_concurrency=10, per_key_concurrency=1, per_key_queue=1, queue_timeout=0.3)
+        search_cache = SearchCache(NullBackend())
+        scraper = self.scraper(scheduler)
+        params = dict(limit=10, minPrice=10, maxPrice=2000, includeCategories=['3686'], sort='RELEVANCE', region='DE')
+        busy = threading.Event()
+
+        def hold_free_slot():
+            with scheduler_client('free-key', 'free'), scheduler.slot():
+                busy.set()
+                time.sleep(0.6)
+
+        def free_search():
+            with scheduler_client('free-key', 'free'):
+                with self.assertRaises(OverloadedError):
+                    search_cache.fetch(scraper, **params)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(hold_free_slot)
+            busy.wait()
+            free = executor.submit(free_search)
+            time.sleep(0.05)
+            with scheduler_client('premium-key', 'premium'):
+                is_payload_valid, validation_msg, items, cache_status, cache_age = search_cache.fetch(scraper, **params)
+            free.result()
+        self.assertEqual(len(items), 10)
+
+
+class SingleFlightTests(SimpleTestCase):
+    callers = 8
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.calls = 0
+
+    def slow(self, result=None, error=None):
+        self.calls += 1
+        time.sleep(0.2)
+        if error is not None:
+            raise error
+        return result
+
+    async def aslow(self, result=None, error=None):
+        self.calls += 1
+        await asyncio.sleep(0.2)
+        if error is not None:
+            raise error
+        return result
+
+    def run_threads(self, fn):
+        with ThreadPoolExecutor(max_workers=self.callers) as executor:
+            futures = [executor.submit(self.flight.do, 'key', fn) for _ in range(self.callers)]
+            return [future.exception() or future.result() for future in futures]
+
+    def test_threads_share_one_call(self):
+        results = self.run_threads(lambda: self.slow(['item']))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [['item']] * self.callers)
+
+    def test_tasks_share_one_call(self):
+        async def search():
+            return await asyncio.gather(*(self.flight.ado('key', lambda: self.aslow(['item'])) for _ in range(self.callers)))
+        self.assertEqual(asyncio.run(search()), [['item']] * self.callers)
+        self.assertEqual(self.calls, 1)
+
+    def test_exception_reaches_every_thread(self):
+        error = ValueError('upstream')
+        results = self.run_threads(lambda: self.slow(error=error))
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(result is error for result in results))
+
+    def test_exception_reaches_every_task(self):
+        async def search():
+            return await asyncio.gather(*(self.flight.ado('key', lambda: self.aslow(error=ValueError('upstream')))
+                                          for _ in range(self.callers)), return_exceptions=True)
+        results = asyncio.run(search())
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_cancelled_leader_does_not_cancel_the_call(self):
+        async def search():
+            leader = asyncio.ensure_future(self.flight.ado('key', lambda: self.aslow(['item'])))
+            await asyncio.sleep(0.01)
+            follower = asyncio.ensure_future(self.flight.ado('key', lambda: self.aslow(['other'])))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            return await follower
+        self.assertEqual(asyncio.run(search()), ['item'])
+        self.assertEqual(self.calls, 1)
+
+    def test_failed_call_is_cleaned_up(self):
+        with self.assertRaises(ValueError):
+            self.flight.do('key', lambda: self.slow(error=ValueError('upstream')))
+        self.assertEqual(self.flight.do('key', lambda: self.slow(['item'])), ['item'])
+
+        async def search():
+            with self.assertRaises(ValueError):
+                await self.flight.ado('key', lambda: self.aslow(error=ValueError('upstream')))
+            await asyncio.sleep(0)
+            return await self.flight.ado('key', lambda: self.aslow(['item']))
+        self.assertEqual(asyncio.run(search()), ['item'])
+        self.assertEqual(self.calls, 4)
+        self.assertEqual(self.flight.in_flight(), 0)
+
+    def test_unshared_exception_makes_followers_call_again(self):
+        def search():
+            if self.calls == 0:
+                return self.slow(error=OverloadedError('no slot'))
+            return self.slow(['item'])
+        with ThreadPoolExecutor(max_workers=self.callers) as executor:
+            futures = [executor.submit(self.flight.do, 'key', search, (OverloadedError,)) for _ in range(self.callers)]
+        errors = [future.exception() for future in futures]
+        # only the leader that was refused sees the error
+        self.assertEqual(sum(isinstance(error, OverloadedError) for error in errors), 1)
+        self.assertEqual(sorted(future.result() for future, error in zip(futures, errors) if error is None),
+                         [['item']] * (self.callers - 1))
+        self.assertEqual(self.calls, 2)
+
+
+class DeepFetchTests(SimpleTestCase):
+
+    def test_closing_the_stream_does_not_wait_for_queued_pages(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        fetched = []
+
+        def fetch_page(offset, *args):
+            fetched.append(offset)
+            if offset > 100:
+                release.wait(2)
+            return parse_items([{'itemId': str(offset), 'name': 'item', 'images': None, 'url': 'https://example.com'}]), 1000
+
+        pages = Scraper().iter_pages(items('a'), 1000, 1000, 10, 2000, ['3686'], 'RELEVANCE', 'DE', parallelism=2, fetch_page=fetch_page)
+        next(pages)
+        next(pages)
+        start_time = time.monotonic()
+        pages.close()
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        release.set()
+        time.sleep(0.05)
+        # at most the pages submitted before close, 300 may have been cancelled
+        self.assertIn(sorted(fetched), ([100, 200], [100, 200, 300]))
+
+
+class SchemaTests(SimpleTestCase):
+
+    def test_all_violations_are_reported(self):
+        errors = Scraper.SEARCH_SCHEMA.validate({'limit': True, 'minPrice': '10', 'includeCategories': ['3686', 7],
+                                                 'sort': 'RELEVANCE', 'region': 'XX', 'page': 2})
+        self.assertEqual(errors, [
+            'Unknown parameters page. Valid parameters are limit, minPrice, maxPrice, includeCategories, sort, region, fields.',
+            'limit must be Integer between 1-100',
+            'minPrice must be Integer',
+            'maxPrice must be Integer',
+            'includeCategories must be List of Strings',
+            Scraper.REGION_ERROR
+        ])
+
+    def test_optional_fields_and_extend(self):
+        schema = Schema({'name': Field(str, 'name must be String'), 'tags': Field(list, 'tags must be List', required=False, non_empty=True)})
+        self.assertEqual(schema.validate({'name': 'a', 'tags': None}), [])
+        self.assertEqual(schema.validate({'name': 'a', 'tags': []}), ['tags must be List'])
+        self.assertEqual(schema.extend(tags=None).validate({'name': 'a', 'tags': ['b']}),
+                         ['Unknown parameters tags. Valid parameters are name.'])
+        self.assertEqual(schema.validate([]), ['Request must be JSON object'])
+
+
+def items(*names):
+    return parse_items([{'itemId': str(index), 'name': name, 'images': None, 'url': f'https://example.com/{index}'}
+                        for index, name in enumerate(names)])
+
+
+class HistoryTests(TestCase):
+    search = {'region': 'DE', 'includeCategories': ['3686']}
+
+    def recorder(self, **kwargs):
+        # the background flusher never runs during a test
+        return HistoryRecorder(flush_interval=3600, **kwargs)
+
+    def test_late_flush_is_not_skipped_by_the_cursor(self):
+        early, late = self.recorder(), self.recorder()
+        early.record(self.search, items('c'))
+        time.sleep(0.01)
+        late.record(self.search, items('a', 'b'))
+        late.flush()
+        snapshots, until, is_complete = changes_since('DE', '3686', 0)
+        self.assertEqual(len(snapshots), 2)
+        # scraped before until was handed out, committed after it
+        early.flush()
+        snapshots, until, is_complete = changes_since('DE', '3686', until)
+        self.assertEqual([snapshot['name'] for snapshot in snapshots], ['c'])
+
+    def test_failed_flushes_are_dropped_after_max_attempts(self):
+        recorder = self.recorder(max_attempts=2)
+        recorder.record(self.search, items('a'))
+        with mock.patch.object(HistoryRecorder, 'write', side_effect=DatabaseError('no such table')):
+            for attempt in range(2):
+                with self.assertRaises(DatabaseError):
+                    recorder.flush()
+        self.assertEqual(recorder.pending, [])
+
+    def test_revert_after_another_workers_change_is_recorded(self):
+        first, second = self.recorder(), self.recorder()
+        for recorder, name in ((first, 'a'), (second, 'b'), (first, 'a')):
+            recorder.record(self.search, items(name))
+            recorder.flush()
+        self.assertEqual([snapshot['name'] for snapshot in item_history('DE', '0')], ['a', 'b', 'a'])
+
+
+WORKER_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': alias}
+    for alias in ('default', 'quota', 'worker-1', 'worker-2')
+}
+
+
+@override_settings(CACHES=WORKER_CACHES)
+@mock.patch.object(QuotaEngine, 'start')
+class QuotaTests(TestCase):
+
+    def setUp(self):
+        for alias in WORKER_CACHES:
+            caches[alias].clear()
+        self.api_key = APIKey.objects.create(email='quota@example.com', subscription_type='free',
+                                             requests_left=10, expiry=round(time.time()) + 3600)
+
+    def test_workers_see_each_others_charges_after_a_flush(self, start):
+        first, second = QuotaEngine('worker-1'), QuotaEngine('worker-2')
+        self.assertTrue(first.acquire(self.api_key, 6)[0])
+        self.assertTrue(second.acquire(self.api_key, 1)[0])
+        for engine in (first, second, first):
+            engine.flush()
+        self.assertEqual(APIKey.objects.get(pk=self.api_key.pk).requests_left, 3)
+        self.assertFalse(second.acquire(self.api_key, 4)[0])
+        self.assertTrue(second.acquire(self.api_key, 3)[0])
+
+    def test_unflushed_charges_survive_a_resync(self, start):
+        engine = QuotaEngine('worker-1')
+        engine.acquire(self.api_key, 4)
+        engine.flush()
+        engine.acquire(self.api_key, 2)
+        engine.resync()
+        self.assertEqual(engine.cache.get(engine.counter_key(self.api_key.pk)), 4)
+
+
+@override_settings(CACHES=WORKER_CACHES)
+@mock.patch('idealo_app.views.SECRET_KEY', 'secret')
+class GenerateKeyTests(TestCase):
+
+    def setUp(self):
+        # DRF keeps the throttling history in the default cache
+        caches['default'].clear()
+
+    def generate(self, **data):
+        return self.client.post('/generate_key', json.dumps(data), content_type='application/json', HTTP_AUTHORIZATION='secret')
+
+    def test_key_is_created_with_quota_and_expiry(self):
+        response = self.generate(email='new@example.com', subscription_type='basic')
+        self.assertEqual(response.status_code, 200)
+        api_key = APIKey.objects.get(key=response.json()['api_key'])
+        self.assertEqual(api_key.requests_left, 5000)
+        self.assertGreater(api_key.expiry, time.time())
+
+    def test_duplicate_email_is_rejected(self):
+        self.generate(email='new@example.com', subscription_type='free')
+        response = self.generate(email='new@example.com', subscription_type='premium')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(APIKey.objects.count(), 1)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.generate(email='new@example.com', subscription_type='gold').status_code, 400)
+        self.assertEqual(self.generate(subscription_type='free').status_code, 400)
+        self.assertEqual(self.client.post('/generate_key', '{}', content_type='application/json').status_code, 401)
+        self.assertFalse(APIKey.objects.exists())
+
+    def test_class_based_view_sets_quota_and_expiry(self):
+        view = importlib.import_module('idealo_app.views_class-based-view').GenerateAPIKey.as_view()
+
+        def generate(email):
+            return view(RequestFactory().post('/generate_key', json.dumps({'email': email, 'subscription_type': 'free'}),
+                                              content_type='application/json', HTTP_AUTHORIZATION='YOUR_SECRET_KEY'))
+        self.assertEqual(generate('view@example.com').status_code, 200)
+        api_key = APIKey.objects.get(email='view@example.com')
+        self.assertEqual(api_key.requests_left, 1000)
+        self.assertGreater(api_key.expiry, time.time())
+        self.assertEqual(generate('view@example.com').status_code, 400)
+
+
+@override_settings(CACHES=WORKER_CACHES)
+@mock.patch.object(QuotaEngine, 'start')
+class DataEndpointTests(TestCase):
+    search = {'limit': 10, 'minPrice': 10, 'maxPrice': 2000, 'includeCategories': ['3686'], 'sort': 'RELEVANCE', 'region': 'DE'}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.backend = FakeIdealo(latency=0, jitter=0).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.backend.shutdown()
+        cls.backend.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        for alias in WORKER_CACHES:
+            caches[alias].clear()
+        scraper = Scraper(transport=Transport(url=self.backend.url), compiler=PayloadCompiler(), resilience=Resilience(retries=0))
+        self.quota_engine = QuotaEngine('quota')
+        for patcher in (mock.patch('idealo_app.views.scraper', scraper),
+                        mock.patch('idealo_app.views.search_cache', SearchCache(NullBackend())),
+                        mock.patch('idealo_app.views.quota_engine', self.quota_engine)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.api_key = APIKey.objects.create(email='data@example.com', subscription_type='free',
+                                             requests_left=2, expiry=round(time.time()) + 3600)
+        self.upstream_requests = self.backend.requests
+
+    def post(self, data, **headers):
+        return self.client.post('/data/idealo', json.dumps(data), content_type='application/json',
+                                HTTP_X_API_KEY=str(self.api_key.key), **headers)
+
+    def test_get_and_not_modified(self, start):
+        response = self.client.get('/data/idealo/DE')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']), 10)
+        response = self.client.get('/data/idealo/DE', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_post_requires_a_valid_key(self, start):
+        response = self.client.post('/data/idealo', json.dumps(self.search), content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        response = self.client.post('/data/idealo', json.dumps(self.search), content_type='application/json',
+                                    HTTP_X_API_KEY='00000000-0000-4000-8000-000000000000')
+        self.assertEqual(response.status_code, 401)
+
+    def test_post_invalid_body_is_not_charged(self, start):
+        response = self.post({**self.search, 'limit': 0})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.backend.requests, self.upstream_requests)
+        self.assertEqual(self.post(self.search).status_code, 200)
+
+    def test_quota_and_not_modified_post(self, start):
+        response = self.post(self.search)
+        self.assertEqual(response.status_code, 200)
+        # a 304 still counts against the quota
+        self.assertEqual(self.post(self.search, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        response = self.post(self.search)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Rate limited', response.json()['error'])
+        self.assertEqual(self.backend.requests - self.upstream_requests, 2)
+
+    def test_invalid_body_lists_every_error(self, start):
+        response = self.post({**self.search, 'limit': 0, 'sort': 1, 'region': 'XX'})
+        self.assertEqual(response.status_code, 400)
+        errors = ['limit must be Integer between 1-100', 'sort must be String', Scraper.REGION_ERROR]
+        self.assertEqual(response.json(), {'success': False, 'error': '; '.join(errors), 'errors': errors})
+
+    def test_search_is_validated_once(self, start):
+        with mock.patch.object(Scraper.SEARCH_SCHEMA, 'validate', wraps=Scraper.SEARCH_SCHEMA.validate) as validate:
+            self.assertEqual(self.post(self.search).status_code, 200)
+        self.assertEqual(validate.call_count, 1)
+
+    def deep_search(self, total):
+        return {**{key: value for key, value in self.search.items() if key != 'limit'}, 'total': total}
+
+    def set_requests_left(self, requests_left):
+        # saving drops the cached key lookup (signals.py)
+        self.api_key.requests_left = requests_left
+        self.api_key.save()
+        self.quota_engine.forget(self.api_key.pk)
+
+    def requests_left(self):
+        return self.quota_engine.cache.get(self.quota_engine.counter_key(self.api_key.pk))
+
+    def test_deep_fetch_reserves_every_page(self, start):
+        response = self.post(self.deep_search(300))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.backend.requests, self.upstream_requests)
+        self.assertEqual(self.requests_left(), 2)
+
+    def test_deep_fetch_refunds_pages_not_returned(self, start):
+        self.set_requests_left(10)
+        # the stand-in has 250 results, so 3 of the 10 reserved pages are used
+        response = self.post(self.deep_search(1000))
+        self.assertEqual(len(response.json()['data']), 250)
+        self.assertEqual(self.requests_left(), 7)
+
+    def stream(self, total):
+        return self.client.post('/data/idealo', json.dumps(self.deep_search(total)), content_type='application/json',
+                                HTTP_X_API_KEY=str(self.api_key.key), HTTP_ACCEPT='application/x-ndjson')
+
+    def test_streamed_deep_fetch_reserves_every_page(self, start):
+        self.assertEqual(self.stream(300).status_code, 429)
+        self.set_requests_left(10)
+        response = self.stream(1000)
+        # all 10 pages are reserved before the first line is sent
+        self.assertEqual(self.requests_left(), 0)
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 250)
+        self.assertEqual(self.requests_left(), 7)
+
+    def test_disconnected_stream_refunds_unsent_pages(self, start):
+        self.set_requests_left(10)
+        response = self.stream(1000)
+        next(iter(response.streaming_content))
+        response.close()
+        self.assertEqual(self.requests_left(), 9)
+
+    def test_fields_are_projected(self, start):
+        response = self.post({**self.search, 'fields': ['url', 'name']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({tuple(sorted(item)) for item in response.json()['data']}, {('name', 'url')})
+        body = json.loads(PayloadCompiler().compile({'limit': 10}, fields=['url']))
+        self.assertIn('items { itemId url }', body['query'])
+
+    def test_unknown_fields_are_rejected(self, start):
+        for fields in (['url', 'price'], []):
+            response = self.post({**self.search, 'fields': fields})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['errors'], [Scraper.FIELDS_ERROR])
+        self.assertEqual(self.backend.requests, self.upstream_requests)
+
+    @unittest.skipIf(msgpack is None, 'needs msgpack')
+    def test_msgpack_is_negotiated_with_the_same_etag(self, start):
+        as_json = self.client.get('/data/idealo/DE')
+        as_msgpack = self.client.get('/data/idealo/DE', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(as_msgpack['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(as_msgpack.content)['data'], as_json.json()['data'])
+        self.assertEqual(as_msgpack['ETag'], as_json['ETag'])
+        response = self.client.get('/data/idealo/DE', HTTP_ACCEPT='application/msgpack', HTTP_IF_NONE_MATCH=as_json['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class StubScraper(Scraper):
+    '''
+    Scraper answering every search with one item (or raising error) without
+    going upstream. Searches in a failing region find nothing. While block
+    is set, fetches wait for it (at most 2s).
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.error = None
+        self.block = None
+        self.failing = set()
+
+    def fetch(self, limit, minPrice, maxPrice, includeCategories, sort, region=None, fields=None, validated=False):
+        self.calls += 1
+        if self.block is not None:
+            self.block.wait(2)
+        if self.error is not None:
+            raise self.error
+        if region in self.failing:
+            return True, 'Error scraping count.', None
+        return True, '', items(f'item {self.calls}')
+
+
+def age(backend, key, seconds):
+    value, stored_at, expires_at, size = backend.entries[key]
+    backend.entries[key] = (value, stored_at - seconds, expires_at - seconds, size)
+
+
+class SearchCacheTests(SimpleTestCase):
+    search = {'limit': 10, 'minPrice': 10, 'maxPrice': 2000, 'includeCategories': ['3686'], 'sort': 'RELEVANCE', 'region': 'DE'}
+
+    def test_equal_searches_share_a_key(self):
+        reordered = dict(reversed(list(self.search.items())), includeCategories=['3687', '3686', '3687'])
+        self.assertEqual(normalize(**reordered), normalize(**dict(self.search, includeCategories=['3686', '3687'])))
+        self.assertEqual(normalize(**dict(self.search, limit=7)), normalize(**self.search))
+        self.assertEqual(normalize(**dict(self.search, limit=11)), normalize(**dict(self.search, limit=25)))
+        self.assertNotEqual(normalize(**dict(self.search, limit=26)), normalize(**dict(self.search, limit=25)))
+        self.assertNotEqual(normalize(**dict(self.search, fields=['name'])), normalize(**self.search))
+
+    def test_entries_expire_after_their_ttl(self):
+        backend = InProcessBackend()
+        backend.set('key', ['item'], 10)
+        self.assertEqual(backend.get('key')[0], ['item'])
+        age(backend, 'key', 11)
+        self.assertIsNone(backend.get('key'))
+        self.assertEqual(backend.size, 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        backend = InProcessBackend(max_entries=2)
+        backend.set('a', ['a'], 10)
+        backend.set('b', ['b'], 10)
+        backend.get('a')
+        backend.set('c', ['c'], 10)
+        self.assertEqual(list(backend.entries), ['a', 'c'])
+
+    def test_size_bound_evicts_oldest_entries(self):
+        backend = InProcessBackend(max_bytes=25)
+        for key in 'abc':
+            backend.set(key, ['x' * 5], 10)
+        self.assertLessEqual(backend.size, 25)
+        self.assertEqual(list(backend.entries), ['b', 'c'])
+        backend.set('big', ['x' * 30], 10)
+        self.assertNotIn('big', backend.entries)
+
+    def test_fetch_hits_for_equal_searches(self):
+        cache, scraper = SearchCache(InProcessBackend()), StubScraper()
+        self.assertEqual(cache.fetch(scraper, **self.search)[3], 'MISS')
+        self.assertEqual(cache.fetch(scraper, **dict(self.search, limit=8))[3], 'HIT')
+        self.assertEqual(scraper.calls, 1)
+        age(cache.backend, normalize(**self.search), cache.storage_ttl('DE') + 1)
+        self.assertEqual(cache.fetch(scraper, **self.search)[3], 'MISS')
+        self.assertEqual(scraper.calls, 2)
+
+
+@override_settings(CACHES=WORKER_CACHES)
+class SearchCacheEndpointTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.scraper, self.search_cache = StubScraper(), SearchCache(InProcessBackend(), default_ttl=10, stale_while_revalidate=10, hard_ttl=100)
+        for patcher in (mock.patch('idealo_app.views.scraper', self.scraper),
+                        mock.patch('idealo_app.views.search_cache', self.search_cache)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def age(self, seconds):
+        for key in list(self.search_cache.backend.entries):
+            age(self.search_cache.backend, key, seconds)
+
+    def test_cache_status_header(self):
+        response = self.client.get('/data/idealo/DE')
+        self.assertEqual((response.status_code, response['X-Cache'], response['Age']), (200, 'MISS', '0'))
+        response = self.client.get('/data/idealo/DE')
+        self.assertEqual((response.status_code, response['X-Cache']), (200, 'HIT'))
+        self.assertEqual(self.scraper.calls, 1)
+
+    def test_stale_is_served_while_one_refresh_runs(self):
+        self.client.get('/data/idealo/DE')
+        self.age(15)
+        self.scraper.block = threading.Event()
+        for _ in range(2):
+            response = self.client.get('/data/idealo/DE')
+            self.assertEqual((response.status_code, response['X-Cache']), (200, 'STALE'))
+            self.assertTrue(response['Warning'].startswith('110'))
+            self.assertIs(response.json()['stale'], True)
+        self.scraper.block.set()
+        self.search_cache.executor.shutdown(wait=True)
+        self.assertEqual(self.scraper.calls, 2)
+        response = self.client.get('/data/idealo/DE')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.json()['data'][0]['name'], 'item 2')
+
+    def test_stale_result_is_served_if_upstream_fails(self):
+        self.client.get('/data/idealo/DE')
+        self.age(25)
+        self.scraper.error = UpstreamError('Idealo is down.')
+        response = self.client.get('/data/idealo/DE')
+        self.assertEqual((response.status_code, response['X-Cache']), (200, 'STALE-IF-ERROR'))
+        self.assertTrue(response['Warning'].startswith('111'))
+        self.assertIs(response.json()['stale'], True)
+        self.assertEqual(response.json()['data'][0]['name'], 'item 1')
+
+    def test_upstream_error_after_the_stale_window(self):
+        self.client.get('/data/idealo/DE')
+        self.age(101)
+        self.scraper.error = UpstreamError('Idealo is down.')
+        response = self.client.get('/data/idealo/DE')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {'success': False, 'error': 'Idealo is down.'})
+
+
+@override_settings(CACHES=WORKER_CACHES)
+@mock.patch.object(QuotaEngine, 'start')
+class RegionsBatchTests(TestCase):
+    search = SearchCacheTests.search
+
+    def setUp(self):
+        for alias in WORKER_CACHES:
+            caches[alias].clear()
+        self.scraper, self.quota_engine = StubScraper(), QuotaEngine('quota')
+        self.scraper.failing = {'UK'}
+        for patcher in (mock.patch('idealo_app.views.scraper', self.scraper),
+                        mock.patch('idealo_app.views.search_cache', SearchCache(NullBackend())),
+                        mock.patch('idealo_app.views.quota_engine', self.quota_engine)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.api_key = APIKey.objects.create(email='regions@example.com', subscription_type='free',
+                                             requests_left=10, expiry=round(time.time()) + 3600)
+
+    def post(self, path, data):
+        return self.client.post(path, json.dumps(data), content_type='application/json', HTTP_X_API_KEY=str(self.api_key.key))
+
+    def requests_left(self):
+        return self.quota_engine.cache.get(self.quota_engine.counter_key(self.api_key.pk))
+
+    def test_regions_report_each_region(self, start):
+        search = {key: value for key, value in self.search.items() if key != 'region'}
+        response = self.post('/data/idealo/regions', {**search, 'regions': ['AT', 'UK', 'AT', 'FR']})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['data']
+        self.assertEqual([(result['region'], result['siteID'], result['success']) for result in results],
+                         [('AT', 2, True), ('UK', 3, False), ('FR', 4, True)])
+        self.assertEqual(results[1]['error'], 'Error scraping count.')
+        self.assertEqual(self.scraper.calls, 3)
+        # 3 reserved, the failed region is refunded
+        self.assertEqual(self.requests_left(), 8)
+
+    def test_unknown_region_is_rejected(self, start):
+        search = {key: value for key, value in self.search.items() if key != 'region'}
+        response = self.post('/data/idealo/regions', {**search, 'regions': ['AT', 'XX']})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'], [Scraper.REGIONS_ERROR])
+        self.assertEqual(self.scraper.calls, 0)
+
+    def test_batch_reports_each_query(self, start):
+        queries = [self.search, dict(self.search, region='UK'), dict(self.search, limit=0), self.search]
+        response = self.post('/data/idealo/batch', queries)
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['data']
+        self.assertEqual([result['success'] for result in results], [True, False, False, True])
+        self.assertEqual(results[0], results[3])
+        self.assertEqual(results[2]['error'], 'limit must be Integer between 1-100')
+        # the duplicate query is fetched once, the invalid one not at all
+        self.assertEqual(self.scraper.calls, 2)
+        self.assertEqual(self.requests_left(), 8)
+
+    def test_batch_with_unknown_region_entry(self, start):
+        response = self.post('/data/idealo/batch', [dict(self.search, region='XX')])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['data'], [{'success': False, 'error': Scraper.REGION_ERROR}])
+        self.assertEqual(self.requests_left(), 10)
+
+
+@override_settings(CACHES=WORKER_CACHES)
+class APIKeyCacheTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.api_key = APIKey.objects.create(email='cached@example.com', subscription_type='free',
+                                             requests_left=10, expiry=round(time.time()) + 3600)
+
+    def changes(self):
+        return self.client.get('/data/idealo/changes/DE', {'category': '3686'}, HTTP_X_API_KEY=str(self.api_key.key))
+
+    def test_lookup_is_cached(self):
+        resolve_api_key(str(self.api_key.key))
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_api_key(str(self.api_key.key)), self.api_key)
+
+    def test_deleted_key_is_rejected_at_once(self):
+        self.assertEqual(self.changes().status_code, 200)
+        self.api_key.delete()
+        self.assertEqual(self.changes().status_code, 401)
+
+    def test_deactivated_key_is_rejected_at_once(self):
+        self.assertEqual(self.changes().status_code, 200)
+        self.api_key.is_active = False
+        self.api_key.save()
+        self.assertEqual(self.changes().status_code, 401)
+
+
+@override_settings(CACHES=WORKER_CACHES)
+class PrewarmTests(SimpleTestCase):
+    search = SearchCacheTests.search
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def hits(self, tracker, count, **params):
+        params = dict(self.search, **params)
+        for _ in range(count):
+            tracker.record(normalize(**params), params)
+
+    def test_workers_keep_each_others_counts(self):
+        first, second = PopularityTracker('default'), PopularityTracker('default')
+        self.hits(first, 2, region='DE')
+        self.hits(second, 3, region='FR')
+        first.flush()
+        second.flush()
+        self.hits(first, 2, region='DE')
+        first.flush()
+        self.assertNotEqual(first.slot, second.slot)
+        self.assertEqual([params['region'] for params, _ in PopularityTracker('default').top(2)], ['DE', 'FR'])
+        scores = PopularityTracker('default').shared_scores(time.time())
+        self.assertEqual(round(scores[normalize(**self.search)][0]), 4)
+
+    def test_counts_decay(self):
+        tracker = PopularityTracker(half_life=10)
+        now = time.time()
+        scores = tracker.merge({'old': (8, now - 20, {}, None)}, {'new': (3, {}, None)}, now)
+        self.assertAlmostEqual(scores['old'][0], 2)
+        self.assertEqual(scores['new'][0], 3)
+
+    def test_least_popular_searches_are_dropped(self):
+        tracker = PopularityTracker(max_tracked=2)
+        for count, region in enumerate(('DE', 'FR', 'IT'), 1):
+            self.hits(tracker, count, region=region)
+        self.assertEqual([params['region'] for params, _ in tracker.top(5)], ['IT', 'FR'])
+
+    def test_budget_refuses_spending_past_the_limit(self):
+        budget = UpstreamBudget(per_minute=3)
+        budget.record(2)
+        self.assertTrue(budget.spend())
+        self.assertFalse(budget.spend())
+        self.assertEqual(caches['default'].get(budget.window_key()), 3)
+
+    def test_refreshes_stop_when_the_budget_is_used_up(self):
+        tracker, scraper = PopularityTracker(), StubScraper()
+        for region in ('DE', 'FR', 'IT'):
+            self.hits(tracker, 1, region=region)
+        prewarmer = Prewarmer(SearchCache(InProcessBackend()), tracker, UpstreamBudget(per_minute=2),
+                              scraper_factory=lambda: scraper)
+        self.assertEqual(prewarmer.run_once(), 2)
+        self.assertEqual(scraper.calls, 2)
+
+    def test_searches_are_refreshed_for_the_key_that_made_them(self):
+        scraper, clients = StubScraper(), []
+        fetch = scraper.fetch
+        scraper.fetch = lambda *args, **kwargs: (clients.append(scheduler_current()), fetch(*args, **kwargs))[1]
+        search_cache = SearchCache(InProcessBackend())
+        prewarmer = Prewarmer(search_cache, PopularityTracker(), queries=[dict(self.search, region='FR')],
+                              scraper_factory=lambda: scraper)
+        search_cache.prewarmer = prewarmer
+        with scheduler_client('premium-key', 'premium'):
+            search_cache.fetch(scraper, **self.search)
+        age(search_cache.backend, normalize(**self.search), search_cache.ttl('DE'))
+        clients.clear()
+        self.assertEqual(prewarmer.run_once(), 2)
+        self.assertEqual(sorted(clients, key=str), [('premium-key', 'premium'), None])
+
+
+class ExportScraper:
+    '''
+    Deep fetches returning two items per category. The fetch number
+    interrupt_at raises KeyboardInterrupt, as when the process is stopped.
+    '''
+
+    def __init__(self, interrupt_at=None):
+        self.calls = 0
+        self.clients = set()
+        self.interrupt_at = interrupt_at
+        self.lock = threading.Lock()
+
+    def fetch_deep(self, total, minPrice, maxPrice, includeCategories, sort, region=None, parallelism=None):
+        with self.lock:
+            self.calls += 1
+            self.clients.add(scheduler_current())
+            if self.calls == self.interrupt_at:
+                raise KeyboardInterrupt
+        return True, '', items(f'{includeCategories[0]} a', f'{includeCategories[0]} b')
+
+
+class ExportTests(SimpleTestCase):
+    tasks = plan(['DE'], ['1', '2', '3', '4', '5'], [[0, 100]])
+
+    def exporter(self, directory, scraper):
+        return Exporter(directory, parallelism=1, chunk_rows=3, scraper_factory=lambda: scraper)
+
+    def rows(self, directory, state):
+        rows = []
+        for name in state['parts']:
+            with open(os.path.join(directory, name)) as file:
+                rows.extend(json.loads(line) for line in file)
+        return rows
+
+    def test_interrupted_export_resumes_without_duplicates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(KeyboardInterrupt):
+                self.exporter(directory, ExportScraper(interrupt_at=4)).run(self.tasks)
+            state = self.exporter(directory, None).load()
+            self.assertEqual(state['status'], 'interrupted')
+            self.assertEqual(state['parts'], ['part-00000.ndjson'])
+            self.assertIn('part-00001.ndjson.tmp', os.listdir(directory))
+
+            scraper = ExportScraper()
+            state = self.exporter(directory, scraper).run()
+            self.assertEqual(state['status'], 'complete')
+            self.assertEqual(scraper.calls, 3)
+            self.assertNotIn('part-00001.ndjson.tmp', os.listdir(directory))
+            rows = self.rows(directory, state)
+            self.assertEqual(sorted(row['name'] for row in rows), [f'{category} {suffix}' for category in '12345' for suffix in 'ab'])
+            self.assertEqual(state['rows'], len(rows))
+
+    def test_fetches_are_made_for_the_owner(self):
+        with tempfile.TemporaryDirectory() as directory:
+            scraper = ExportScraper()
+            self.exporter(directory, scraper).run(self.tasks, meta={'owner': 7, 'subscription': 'basic'})
+            self.assertEqual(scraper.clients, {(7, 'basic')})
+
+
+class MetricsTests(SimpleTestCase):
+    sample = re.compile(r'[a-zA-Z_:][a-zA-Z0-9_:]*(\{[a-zA-Z_]\w*="(\\.|[^"\\])*"(,[a-zA-Z_]\w*="(\\.|[^"\\])*")*\})? \S+')
+
+    def test_exposition_format(self):
+        self.client.get('/metrics')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], CONTENT_TYPE)
+        text = response.content.decode('utf-8')
+        self.assertTrue(text.endswith('\n'))
+        families = {}
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ')[2]
+                self.assertNotIn(name, families)
+                families[name] = None
+            elif line.startswith('# TYPE '):
+                _, _, name, kind = line.split(' ')
+                self.assertIn(name, families)
+                self.assertIn(kind, ('counter', 'gauge', 'histogram'))
+                families[name] = kind
+            else:
+                self.assertTrue(self.sample.fullmatch(line), line)
+                float(line.rsplit(' ', 1)[1])
+                name = line.split('{')[0].split(' ')[0]
+                family = re.sub(r'_(bucket|sum|count)$', '', name) if name not in families else name
+                self.assertIsNotNone(families.get(family), line)
+        self.assertEqual(families['idealo_http_request_seconds'], 'histogram')
+        self.assertIn('idealo_http_request_seconds_bucket{method="GET",route="metrics",status="200",le="+Inf"} ', text)
+        self.assertIn('idealo_http_request_seconds_count{method="GET",route="metrics",status="200"} ', text)
+
+    def test_histogram_buckets_are_cumulative_and_labels_escaped(self):
+        registry = Registry()
+        histogram = registry.histogram('latency_seconds', 'Latency.', ('path',), buckets=(0.1, 1))
+        for seconds in (0.05, 0.5, 5):
+            histogram.labels('a"b\\c').observe(seconds)
+        self.assertEqual(registry.render().splitlines()[2:], [
+            'latency_seconds_bucket{path="a\\"b\\\\c",le="0.1"} 1',
+            'latency_seconds_bucket{path="a\\"b\\\\c",le="1"} 2',
+            'latency_seconds_bucket{path="a\\"b\\\\c",le="+Inf"} 3',
+            'latency_seconds_sum{path="a\\"b\\\\c"} 5.55',
+            'latency_seconds_count{path="a\\"b\\\\c"} 3'])
+
+    def test_other_addresses_are_refused(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 403)
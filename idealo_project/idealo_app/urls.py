@@ -1,9 +1,21 @@
+from django.conf import settings
 from django.urls import path
-from .views import idealo_data_get, idealo_data_post, generate_key, LandingPage
+from .views import idealo_data_get, idealo_data_post, idealo_data_regions_post, idealo_data_batch_post, idealo_history_get, idealo_changes_get, idealo_export_post, idealo_export_get, idealo_export_file_get, metrics, generate_key, LandingPage
+
+if settings.IDEALO_ASYNC_VIEWS:
+    from .views_async import idealo_data_get, idealo_data_post, idealo_data_regions_post, idealo_data_batch_post
 
 urlpatterns = [
+    path('data/idealo/batch', idealo_data_batch_post, name='idealo_data_batch'),
+    path('data/idealo/regions', idealo_data_regions_post, name='idealo_data_regions'),
+    path('data/idealo/export', idealo_export_post, name='idealo_export'),
+    path('data/idealo/export/<str:job_id>', idealo_export_get, name='idealo_export_status'),
+    path('data/idealo/export/<str:job_id>/<str:name>', idealo_export_file_get, name='idealo_export_file'),
+    path('data/idealo/history/<str:region>/<str:item_id>', idealo_history_get, name='idealo_history'),
+    path('data/idealo/changes/<str:region>', idealo_changes_get, name='idealo_changes'),
     path('data/idealo/<str:region>', idealo_data_get, name='idealo_data'),
     path('data/idealo', idealo_data_post, name='idealo_data'),
+    path('metrics', metrics, name='metrics'),
     path('generate_key', generate_key, name='generate_key'),
     path('', LandingPage.as_view(), name='Landing Page'),
 ]
@@ -1,15 +1,27 @@
 import json
+import math
 import time
 import os
 from .decorators import restrict_ip_address, require_api_key
+from django.conf import settings
 from modules import idealo
+from modules.resilience import UpstreamError
+from modules.export import plan, validate_export, charged_requests, TOTAL
+from modules.metrics import registry, CONTENT_TYPE
+from modules.items import loads
+from .services import scraper, search_cache, quota_engine, export_jobs, search_headers, not_modified, invalid_request, stale_marker
 from .models import APIKey
-from django.db.models import F
+from .quota import REQUESTS_AMOUNT
+from .history import item_history, changes_since
 import logging
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from .renderers import NDJSON_MEDIA_TYPE, NDJSONRenderer, wants_ndjson, iter_ndjson
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.views import View
+from django.db import IntegrityError, transaction
 from datetime import datetime, timedelta
 
 
@@ -17,14 +29,36 @@ logger = logging.getLogger(__name__)
 
 SECRET_KEY = os.environ.get('SECRET_KEY')
 
-REQUESTS_AMOUNT = {
-    'free': '1000',
-    'basic': '5000',
-    'premium': '10000'
-}
+
+def acquire_quota(api_key_instance, requests_needed=1):
+    '''
+    Reserves requests_needed requests of the API key, returning an error
+    Response if it has too few left in the current window. Reservations
+    are refunded in part with quota_engine.settle once the actual cost is known.
+    '''
+    is_allowed, expiry = quota_engine.acquire(api_key_instance, requests_needed)
+    if not is_allowed:
+        return Response({'success': False, 'error': f'Rate limited: Try again after {datetime.fromtimestamp(expiry).strftime("%Y-%m-%d %H:%M:%S")}'}, status=429)
+    return None
+
+
+def charge_pages(pages, api_key_instance, requests_reserved):
+    '''
+    Passes streamed pages through and, once the stream ends or the client
+    disconnects, refunds the reserved requests beyond one per PAGE_SIZE
+    items actually sent.
+    '''
+    items_sent = 0
+    try:
+        for page in pages:
+            items_sent += len(page)
+            yield page
+    finally:
+        quota_engine.settle(api_key_instance, requests_reserved, math.ceil(items_sent / idealo.Scraper.PAGE_SIZE))
 
 
 @api_view(['GET'])
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer])
 def idealo_data_get(request, region):
     start_time = time.time()
     try:
@@ -36,45 +70,244 @@ def idealo_data_get(request, region):
             "sort": "RELEVANCE",
             "region": region
         }
-        is_payload_valid, validation_msg, items = idealo.Scraper().fetch(**sample_data)
+        is_payload_valid, validation_msg, items, cache_status, cache_age = search_cache.fetch(scraper, **sample_data)
         if is_payload_valid and items:
-            return Response({'success': is_payload_valid, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'data': items}, status=200)
+            headers = search_headers(items, cache_status, cache_age, region)
+            if not_modified(request, headers['ETag']):
+                return HttpResponseNotModified(headers=headers)
+            return Response({'success': is_payload_valid, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), **stale_marker(cache_status), 'data': items}, status=200, headers=headers)
         else:
             return Response({'success': is_payload_valid, 'error': validation_msg}, status=500)
+    except UpstreamError as e:
+        logger.error(f'Upstream error: {str(e)}')
+        return Response({'success': False, 'error': str(e)}, status=503)
     except Exception as e:
         return Response({'success': False, 'error': f'Error executing the script: {str(e)}'}, status=500)
 
 
 @api_view(['POST'])
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer])
 @require_api_key
 def idealo_data_post(request):
     start_time = time.time()
-    api_key_value = request.headers.get('X-API-Key')
     try:
-        api_key_instance = APIKey.objects.get(key=api_key_value)
-    except APIKey.DoesNotExist:
-        return Response({'success': False, 'error': 'Invalid API Key'}, status=401)
-    if api_key_instance.requests_left <= 0:
-        if round(datetime.now().timestamp()) < api_key_instance.expiry:
-            return Response({'success': False, 'error': f'Rate limited: Try again after {datetime.fromtimestamp(api_key_instance.expiry).strftime("%Y-%m-%d %H:%M:%S")}'}, status=429)
-        else:
-            api_key_instance.requests_left = REQUESTS_AMOUNT[api_key_instance.subscription_type]
-            api_key_instance.save()
-            pass
+        data = loads(request.body)
+    except json.JSONDecodeError:
+        return Response({'success': False, 'error': 'Request must be JSON'}, status=415)
+    errors = scraper.request_errors(data)
+    if errors:
+        return Response(invalid_request(errors), status=400)
+    # a deep fetch reserves all the pages it may need, unused ones are refunded
+    requests_reserved = math.ceil(data['total'] / idealo.Scraper.PAGE_SIZE) if 'total' in data else 1
+    quota_error = acquire_quota(request.api_key, requests_reserved)
+    if quota_error:
+        return quota_error
+    requests_used = 0
     try:
-        data = json.loads(request.body.decode('utf-8'))
-        is_payload_valid, validation_msg, items = idealo.Scraper().fetch(**data)
+        if 'total' in data and wants_ndjson(request):
+            is_payload_valid, validation_msg, pages = scraper.fetch_deep_pages(
+                validated=True, parallelism=settings.IDEALO_DEEP_FETCH_PARALLELISM, **data)
+            if pages is None:
+                return Response({'success': is_payload_valid, 'error': validation_msg}, status=400)
+            # charge_pages refunds the pages that are not sent
+            requests_used = requests_reserved
+            return StreamingHttpResponse(iter_ndjson(charge_pages(pages, request.api_key, requests_reserved)), content_type=NDJSON_MEDIA_TYPE)
+        elif 'total' in data:
+            is_payload_valid, validation_msg, items = scraper.fetch_deep(
+                validated=True, parallelism=settings.IDEALO_DEEP_FETCH_PARALLELISM, **data)
+            cache_status, cache_age, requests_cost = 'MISS', 0, math.ceil(len(items or []) / idealo.Scraper.PAGE_SIZE)
+        else:
+            is_payload_valid, validation_msg, items, cache_status, cache_age = search_cache.fetch(scraper, validated=True, **data)
+            requests_cost = 1
         if is_payload_valid and items:
-            APIKey.objects.filter(key=api_key_value).update(
-                requests_left=F('requests_left') - 1)
-            return Response({'success': is_payload_valid, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'data': items}, status=200)
+            requests_used = requests_cost
+            headers = search_headers(items, cache_status, cache_age)
+            if not_modified(request, headers['ETag']):
+                return HttpResponseNotModified(headers=headers)
+            return Response({'success': is_payload_valid, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), **stale_marker(cache_status), 'data': items}, status=200, headers=headers)
         else:
             return Response({'success': is_payload_valid, 'error': validation_msg}, status=400)
+    except UpstreamError as e:
+        logger.error(f'Upstream error: {str(e)}')
+        return Response({'success': False, 'error': str(e)}, status=503)
+    except Exception as e:
+        logger.error(f'Error executing the script: {str(e)}')
+        return Response({'success': False, 'error': 'Error retrieving data.'}, status=500)
+    finally:
+        quota_engine.settle(request.api_key, requests_reserved, requests_used)
+
+
+@api_view(['POST'])
+@require_api_key
+def idealo_data_regions_post(request):
+    start_time = time.time()
+    try:
+        data = loads(request.body)
     except json.JSONDecodeError:
         return Response({'success': False, 'error': 'Request must be JSON'}, status=415)
+    errors = scraper.REGIONS_SCHEMA.validate(data)
+    if errors:
+        return Response(invalid_request(errors), status=400)
+    requests_reserved = len(set(data['regions']))
+    quota_error = acquire_quota(request.api_key, requests_reserved)
+    if quota_error:
+        return quota_error
+    requests_used = 0
+    try:
+        is_payload_valid, validation_msg, results = scraper.fetch_regions(
+            validated=True, fetch=lambda **params: search_cache.fetch(scraper, **params), **data)
+        if not is_payload_valid:
+            return Response({'success': is_payload_valid, 'error': validation_msg}, status=400)
+        regions_succeeded = requests_used = sum(result['success'] for result in results)
+        return Response({'success': regions_succeeded > 0, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'data': results}, status=200 if regions_succeeded else 500)
     except Exception as e:
         logger.error(f'Error executing the script: {str(e)}')
         return Response({'success': False, 'error': 'Error retrieving data.'}, status=500)
+    finally:
+        quota_engine.settle(request.api_key, requests_reserved, requests_used)
+
+
+@api_view(['POST'])
+@require_api_key
+def idealo_data_batch_post(request):
+    start_time = time.time()
+    try:
+        data = loads(request.body)
+    except json.JSONDecodeError:
+        return Response({'success': False, 'error': 'Request must be JSON'}, status=415)
+    is_payload_valid, validation_msg = scraper.validate_batch_payload(data)
+    if not is_payload_valid:
+        return Response({'success': is_payload_valid, 'error': validation_msg}, status=400)
+    requests_reserved = len(data)
+    quota_error = acquire_quota(request.api_key, requests_reserved)
+    if quota_error:
+        return quota_error
+    requests_used = 0
+    try:
+        is_payload_valid, validation_msg, results = scraper.fetch_batch(
+            data, fetch=lambda **params: search_cache.fetch(scraper, **params))
+        if not is_payload_valid:
+            return Response({'success': is_payload_valid, 'error': validation_msg}, status=400)
+        queries_succeeded = requests_used = sum(result['success'] for result in results)
+        return Response({'success': queries_succeeded > 0, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'data': results}, status=200 if queries_succeeded else 400)
+    except Exception as e:
+        logger.error(f'Error executing the script: {str(e)}')
+        return Response({'success': False, 'error': 'Error retrieving data.'}, status=500)
+    finally:
+        quota_engine.settle(request.api_key, requests_reserved, requests_used)
+
+
+@api_view(['GET'])
+@require_api_key
+def idealo_history_get(request, region, item_id):
+    start_time = time.time()
+    if region not in idealo.Scraper.REGIONS:
+        return Response({'success': False, 'error': scraper.REGION_ERROR}, status=400)
+    try:
+        snapshots = item_history(region, item_id)
+    except Exception as e:
+        logger.error(f'Error reading item history: {str(e)}')
+        return Response({'success': False, 'error': 'Error retrieving data.'}, status=500)
+    if not snapshots:
+        return Response({'success': False, 'error': 'No history for this item.'}, status=404)
+    return Response({'success': True, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'data': snapshots}, status=200)
+
+
+@api_view(['GET'])
+@require_api_key
+def idealo_changes_get(request, region):
+    start_time = time.time()
+    category = request.GET.get('category')
+    since = request.GET.get('since', '0')
+    if region not in idealo.Scraper.REGIONS:
+        return Response({'success': False, 'error': scraper.REGION_ERROR}, status=400)
+    if not category:
+        return Response({'success': False, 'error': 'category is required'}, status=400)
+    if not since.isdigit():
+        return Response({'success': False, 'error': 'since must be the until of a previous response or 0'}, status=400)
+    try:
+        snapshots, until, is_complete = changes_since(region, category, int(since))
+    except Exception as e:
+        logger.error(f'Error reading item changes: {str(e)}')
+        return Response({'success': False, 'error': 'Error retrieving data.'}, status=500)
+    return Response({'success': True, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'until': until, 'complete': is_complete, 'data': snapshots}, status=200)
+
+
+@api_view(['POST'])
+@require_api_key
+def idealo_export_post(request):
+    start_time = time.time()
+    try:
+        data = loads(request.body)
+    except json.JSONDecodeError:
+        return Response({'success': False, 'error': 'Request must be JSON'}, status=415)
+    is_payload_valid, validation_msg = validate_export(data)
+    if not is_payload_valid:
+        return Response({'success': is_payload_valid, 'error': validation_msg}, status=400)
+    tasks = plan(data['regions'], data['categories'], data['priceBands'])
+    total = data.get('total', TOTAL)
+    # one request per upstream page, settled once the job has finished
+    requests_reserved = len(tasks) * math.ceil(total / idealo.Scraper.PAGE_SIZE)
+    quota_error = acquire_quota(request.api_key, requests_reserved)
+    if quota_error:
+        return quota_error
+    api_key_instance = request.api_key
+    try:
+        job_id = export_jobs.submit(
+            tasks, data.get('format', 'ndjson'), total, data.get('sort', 'RELEVANCE'),
+            meta={'owner': api_key_instance.pk, 'subscription': api_key_instance.subscription_type},
+            on_done=lambda state: quota_engine.settle(api_key_instance, requests_reserved, charged_requests(state) if state else 0))
+    except Exception as e:
+        quota_engine.settle(api_key_instance, requests_reserved, 0)
+        logger.error(f'Error starting export: {str(e)}')
+        return Response({'success': False, 'error': 'Error starting export.'}, status=500)
+    return Response({'success': True, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'job': job_id, 'tasks': len(tasks)}, status=202)
+
+
+def export_state(request, job_id):
+    state = export_jobs.status(job_id)
+    if state is None or state['meta'].get('owner') != request.api_key.pk:
+        return None
+    return state
+
+
+@api_view(['GET'])
+@require_api_key
+def idealo_export_get(request, job_id):
+    state = export_state(request, job_id)
+    if state is None:
+        return Response({'success': False, 'error': 'Export not found.'}, status=404)
+    return Response({
+        'success': True,
+        'job': job_id,
+        'status': state['status'],
+        'format': state['format'],
+        'tasks': len(state['tasks']),
+        'done': len(state['done']),
+        'failed': state['failed'],
+        'rows': state['rows'],
+        'files': state['parts'],
+        'updated_at': state['updated_at']
+    }, status=200)
+
+
+@require_api_key
+def idealo_export_file_get(request, job_id, name):
+    if request.method != 'GET':
+        return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+    path = export_jobs.part_path(job_id, name) if export_state(request, job_id) is not None else None
+    if path is None:
+        return JsonResponse({'success': False, 'error': 'File not found.'}, status=404)
+    content_type = NDJSON_MEDIA_TYPE if name.endswith('.ndjson') else None
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=name, content_type=content_type)
+
+
+def metrics(request):
+    if not settings.IDEALO_METRICS['ENABLED']:
+        return JsonResponse({"detail": "Not found"}, status=404)
+    if request.META['REMOTE_ADDR'] not in settings.IDEALO_METRICS['ALLOWED_IPS']:
+        return JsonResponse({"detail": "Forbidden"}, status=403)
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
 
 
 @api_view(['POST'])
@@ -96,12 +329,16 @@ def generate_key(request):
     except json.JSONDecodeError:
         return Response({'success': False, 'error': 'Request must be JSON'}, status=415)
 
-    if APIKey.objects.filter(email=email).exists():
-        return Response({'success': False, 'error': 'An API key for this email already exists!'}, status=400)
-
     api_key_instance = APIKey(
         email=email, is_active=True, subscription_type=subscription_type, requests_left=REQUESTS_AMOUNT[subscription_type], expiry=round((datetime.now()+timedelta(days=30)).timestamp()))
-    api_key_instance.save()
+    # the unique index on email rejects duplicates, also between concurrent requests
+    try:
+        with transaction.atomic():
+            api_key_instance.save()
+    except IntegrityError:
+        if not APIKey.objects.filter(email=email).exists():
+            raise
+        return Response({'success': False, 'error': 'An API key for this email already exists!'}, status=400)
     return Response({'success': True, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'api_key': str(api_key_instance.key)}, status=200)
 
 
@@ -111,3 +348,4 @@ class LandingPage(View):
             'message': "Hello from Django!"
         }
         return render(request, 'landing_page.html', context)
+
@@ -0,0 +1,215 @@
+import json
+import math
+import time
+import functools
+from .decorators import async_require_api_key
+from django.conf import settings
+from modules import idealo
+from modules.resilience import UpstreamError
+from modules.items import loads
+from .services import async_scraper, search_cache, quota_engine, search_headers, not_modified, invalid_request, stale_marker
+import logging
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from .renderers import NDJSON_MEDIA_TYPE, wants_ndjson, ndjson_lines, aiter_ndjson, render_response
+from rest_framework.settings import api_settings
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+def _check_throttles(request):
+    for throttle_class in api_settings.DEFAULT_THROTTLE_CLASSES:
+        throttle = throttle_class()
+        if not throttle.allow_request(request, None):
+            return throttle.wait()
+    return None
+
+
+def async_api_view(http_method_names):
+    '''
+    Async stand-in for rest_framework's @api_view, which cannot wrap coroutines.
+    Applies the method check, CSRF exemption and DEFAULT_THROTTLE_CLASSES.
+    '''
+    def decorator(view_func):
+        @functools.wraps(view_func)
+        async def _wrapped_view_func(request, *args, **kwargs):
+            if request.method not in http_method_names:
+                return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+            wait = await sync_to_async(_check_throttles)(request)
+            if wait is not None:
+                return JsonResponse({"detail": f"Request was throttled. Expected available in {round(wait or 0)} seconds."}, status=429)
+            return await view_func(request, *args, **kwargs)
+        _wrapped_view_func.csrf_exempt = True
+        return _wrapped_view_func
+    return decorator
+
+
+def acquire_quota(api_key_instance, requests_needed=1):
+    '''
+    Reserves requests_needed requests of the API key, returning an error
+    JsonResponse if it has too few left in the current window. Reservations
+    are refunded in part with quota_engine.settle once the actual cost is known.
+    '''
+    is_allowed, expiry = quota_engine.acquire(api_key_instance, requests_needed)
+    if not is_allowed:
+        return JsonResponse({'success': False, 'error': f'Rate limited: Try again after {datetime.fromtimestamp(expiry).strftime("%Y-%m-%d %H:%M:%S")}'}, status=429)
+    return None
+
+
+async def charge_pages(pages, api_key_instance, requests_reserved):
+    '''
+    Passes streamed pages through and, once the stream ends or the client
+    disconnects, refunds the reserved requests beyond one per PAGE_SIZE
+    items actually sent.
+    '''
+    items_sent = 0
+    try:
+        async for page in pages:
+            items_sent += len(page)
+            yield page
+    finally:
+        quota_engine.settle(api_key_instance, requests_reserved, math.ceil(items_sent / idealo.Scraper.PAGE_SIZE))
+
+
+@async_api_view(['GET'])
+async def idealo_data_get(request, region):
+    start_time = time.time()
+    try:
+        sample_data = {
+            "limit": 10,
+            "minPrice": 10,
+            "maxPrice": 2000,
+            "includeCategories": ["3686"],
+            "sort": "RELEVANCE",
+            "region": region
+        }
+        is_payload_valid, validation_msg, items, cache_status, cache_age = await search_cache.afetch(async_scraper, **sample_data)
+        if is_payload_valid and items:
+            headers = search_headers(items, cache_status, cache_age, region)
+            if not_modified(request, headers['ETag']):
+                return HttpResponseNotModified(headers=headers)
+            if wants_ndjson(request):
+                return HttpResponse(ndjson_lines(items), content_type=NDJSON_MEDIA_TYPE, headers=headers)
+            return render_response(request, {'success': is_payload_valid, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), **stale_marker(cache_status), 'data': items}, status=200, headers=headers)
+        else:
+            return render_response(request, {'success': is_payload_valid, 'error': validation_msg}, status=500)
+    except UpstreamError as e:
+        logger.error(f'Upstream error: {str(e)}')
+        return render_response(request, {'success': False, 'error': str(e)}, status=503)
+    except Exception as e:
+        return render_response(request, {'success': False, 'error': f'Error executing the script: {str(e)}'}, status=500)
+
+
+@async_api_view(['POST'])
+@async_require_api_key
+async def idealo_data_post(request):
+    start_time = time.time()
+    try:
+        data = loads(request.body)
+    except json.JSONDecodeError:
+        return render_response(request, {'success': False, 'error': 'Request must be JSON'}, status=415)
+    errors = async_scraper.request_errors(data)
+    if errors:
+        return render_response(request, invalid_request(errors), status=400)
+    # a deep fetch reserves all the pages it may need, unused ones are refunded
+    requests_reserved = math.ceil(data['total'] / idealo.Scraper.PAGE_SIZE) if 'total' in data else 1
+    quota_error = acquire_quota(request.api_key, requests_reserved)
+    if quota_error:
+        return quota_error
+    requests_used = 0
+    try:
+        if 'total' in data and wants_ndjson(request):
+            is_payload_valid, validation_msg, pages = await async_scraper.fetch_deep_pages(
+                validated=True, parallelism=settings.IDEALO_DEEP_FETCH_PARALLELISM, **data)
+            if pages is None:
+                return render_response(request, {'success': is_payload_valid, 'error': validation_msg}, status=400)
+            # charge_pages refunds the pages that are not sent
+            requests_used = requests_reserved
+            return StreamingHttpResponse(aiter_ndjson(charge_pages(pages, request.api_key, requests_reserved)), content_type=NDJSON_MEDIA_TYPE)
+        elif 'total' in data:
+            is_payload_valid, validation_msg, items = await async_scraper.fetch_deep(
+                validated=True, parallelism=settings.IDEALO_DEEP_FETCH_PARALLELISM, **data)
+            cache_status, cache_age, requests_cost = 'MISS', 0, math.ceil(len(items or []) / idealo.Scraper.PAGE_SIZE)
+        else:
+            is_payload_valid, validation_msg, items, cache_status, cache_age = await search_cache.afetch(async_scraper, validated=True, **data)
+            requests_cost = 1
+        if is_payload_valid and items:
+            requests_used = requests_cost
+            headers = search_headers(items, cache_status, cache_age)
+            if not_modified(request, headers['ETag']):
+                return HttpResponseNotModified(headers=headers)
+            if wants_ndjson(request):
+                return HttpResponse(ndjson_lines(items), content_type=NDJSON_MEDIA_TYPE, headers=headers)
+            return render_response(request, {'success': is_payload_valid, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), **stale_marker(cache_status), 'data': items}, status=200, headers=headers)
+        else:
+            return render_response(request, {'success': is_payload_valid, 'error': validation_msg}, status=400)
+    except UpstreamError as e:
+        logger.error(f'Upstream error: {str(e)}')
+        return render_response(request, {'success': False, 'error': str(e)}, status=503)
+    except Exception as e:
+        logger.error(f'Error executing the script: {str(e)}')
+        return render_response(request, {'success': False, 'error': 'Error retrieving data.'}, status=500)
+    finally:
+        quota_engine.settle(request.api_key, requests_reserved, requests_used)
+
+
+@async_api_view(['POST'])
+@async_require_api_key
+async def idealo_data_regions_post(request):
+    start_time = time.time()
+    try:
+        data = loads(request.body)
+    except json.JSONDecodeError:
+        return render_response(request, {'success': False, 'error': 'Request must be JSON'}, status=415)
+    errors = async_scraper.REGIONS_SCHEMA.validate(data)
+    if errors:
+        return render_response(request, invalid_request(errors), status=400)
+    requests_reserved = len(set(data['regions']))
+    quota_error = acquire_quota(request.api_key, requests_reserved)
+    if quota_error:
+        return quota_error
+    requests_used = 0
+    try:
+        is_payload_valid, validation_msg, results = await async_scraper.fetch_regions(
+            validated=True, fetch=lambda **params: search_cache.afetch(async_scraper, **params), **data)
+        if not is_payload_valid:
+            return render_response(request, {'success': is_payload_valid, 'error': validation_msg}, status=400)
+        regions_succeeded = requests_used = sum(result['success'] for result in results)
+        return render_response(request, {'success': regions_succeeded > 0, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'data': results}, status=200 if regions_succeeded else 500)
+    except Exception as e:
+        logger.error(f'Error executing the script: {str(e)}')
+        return render_response(request, {'success': False, 'error': 'Error retrieving data.'}, status=500)
+    finally:
+        quota_engine.settle(request.api_key, requests_reserved, requests_used)
+
+
+@async_api_view(['POST'])
+@async_require_api_key
+async def idealo_data_batch_post(request):
+    start_time = time.time()
+    try:
+        data = loads(request.body)
+    except json.JSONDecodeError:
+        return render_response(request, {'success': False, 'error': 'Request must be JSON'}, status=415)
+    is_payload_valid, validation_msg = async_scraper.validate_batch_payload(data)
+    if not is_payload_valid:
+        return render_response(request, {'success': is_payload_valid, 'error': validation_msg}, status=400)
+    requests_reserved = len(data)
+    quota_error = acquire_quota(request.api_key, requests_reserved)
+    if quota_error:
+        return quota_error
+    requests_used = 0
+    try:
+        is_payload_valid, validation_msg, results = await async_scraper.fetch_batch(
+            data, fetch=lambda **params: search_cache.afetch(async_scraper, **params))
+        if not is_payload_valid:
+            return render_response(request, {'success': is_payload_valid, 'error': validation_msg}, status=400)
+        queries_succeeded = requests_used = sum(result['success'] for result in results)
+        return render_response(request, {'success': queries_succeeded > 0, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'data': results}, status=200 if queries_succeeded else 400)
+    except Exception as e:
+        logger.error(f'Error executing the script: {str(e)}')
+        return render_response(request, {'success': False, 'error': 'Error retrieving data.'}, status=500)
+    finally:
+        quota_engine.settle(request.api_key, requests_reserved, requests_used)
@@ -1,14 +1,18 @@
 import json
 import time
 from .decorators import restrict_ip_address, require_api_key
-from modules import idealo
+from modules.items import loads
+from .services import scraper, invalid_request
 from django.utils.decorators import method_decorator
 from .models import APIKey
+from .quota import REQUESTS_AMOUNT
 import logging
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.shortcuts import render
 from django.views import View
+from django.db import IntegrityError, transaction
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 SECRET_KEY = 'YOUR_SECRET_KEY'
@@ -29,7 +33,7 @@ class IdealoData(APIView):
                 "sort": "RELEVANCE",
                 "region": region
             }
-            is_payload_valid, validation_msg, items = idealo.Scraper().fetch(**sample_data)
+            is_payload_valid, validation_msg, items = scraper.fetch(**sample_data)
             if is_payload_valid and items:
                 return Response({'success': is_payload_valid, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'data': items}, status=200)
             else:
@@ -41,8 +45,11 @@ class IdealoData(APIView):
     def post(self, request):
         start_time = time.time()
         try:
-            data = json.loads(request.body.decode('utf-8'))
-            is_payload_valid, validation_msg, items = idealo.Scraper().fetch(**data)
+            data = loads(request.body)
+            errors = scraper.SEARCH_SCHEMA.validate(data)
+            if errors:
+                return Response(invalid_request(errors), status=400)
+            is_payload_valid, validation_msg, items = scraper.fetch(validated=True, **data)
             if is_payload_valid and items:
                 return Response({'success': is_payload_valid, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'data': items}, status=200)
             else:
@@ -69,17 +76,21 @@ class GenerateAPIKey(APIView):
                 return Response({'success': False, 'error': 'Email is required!'}, status=400)
             elif not subscription_type:
                 return Response({'success': False, 'error': 'Subscription type is required!'}, status=400)
-            elif subscription_type not in ["free", "basic", "premium"]:
+            elif subscription_type not in REQUESTS_AMOUNT:
                 return Response({'success': False, 'error': 'Subscription type is invalid!'}, status=400)
         except json.JSONDecodeError:
             return Response({'success': False, 'error': 'Request must be JSON'}, status=415)
 
-        if APIKey.objects.filter(email=email).exists():
-            return Response({'success': False, 'error': 'An API key for this email already exists!'}, status=400)
-
         api_key_instance = APIKey(
-            email=email, subscription_type=subscription_type)
-        api_key_instance.save()
+            email=email, is_active=True, subscription_type=subscription_type, requests_left=REQUESTS_AMOUNT[subscription_type], expiry=round((datetime.now()+timedelta(days=30)).timestamp()))
+        # the unique index on email rejects duplicates, also between concurrent requests
+        try:
+            with transaction.atomic():
+                api_key_instance.save()
+        except IntegrityError:
+            if not APIKey.objects.filter(email=email).exists():
+                raise
+            return Response({'success': False, 'error': 'An API key for this email already exists!'}, status=400)
         return Response({'success': True, 'processing_time_ms': round((time.time() - start_time) * 1000, 2), 'api_key': str(api_key_instance.key)}, status=200)
 
 
@@ -0,0 +1,360 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from modules.singleflight import SingleFlight
+from modules.items import dumps
+from modules.resilience import UpstreamError
+from modules.scheduler import OverloadedError
+from modules.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+LIMIT_BUCKETS = (10, 25, 50, 100)
+DEFAULT_TTL = 300
+STALE_WHILE_REVALIDATE = 60
+HARD_TTL = 3600
+REVALIDATE_WORKERS = 4
+MAX_ENTRIES = 1000
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def limit_bucket(limit):
+    '''
+    Rounds limit up to the next bucket so nearby limits share one cache entry.
+    '''
+    for bucket in LIMIT_BUCKETS:
+        if limit <= bucket:
+            return bucket
+    return limit
+
+
+def normalize(limit, minPrice, maxPrice, includeCategories, sort, region, fields=None):
+    '''
+    Canonical cache key of the build_payload variables: categories are
+    de-duplicated and sorted, and limit is replaced by its bucket. Projected
+    searches get their own entries keyed by the sorted field set.
+    '''
+    categories = ','.join(sorted(set(includeCategories)))
+    key = f"{region}|{sort}|{minPrice}|{maxPrice}|{categories}|{limit_bucket(limit)}"
+    if fields is not None:
+        key += '|' + ','.join(sorted(set(fields)))
+    return key
+
+
+class InProcessBackend:
+    '''
+    Thread-safe LRU store capped by entry count and approximate payload size.
+    '''
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at, expires_at, size = entry
+            if time.time() >= expires_at:
+                del self.entries[key]
+                self.size -= size
+                return None
+            self.entries.move_to_end(key)
+            return value, stored_at
+
+    def set(self, key, value, ttl):
+        size = len(dumps(value))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[3]
+            self.entries[key] = (value, now, now + ttl, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[3]
+
+    def delete(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[3]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value, ttl):
+        self.set(key, value, ttl)
+
+
+class DjangoCacheBackend:
+    '''
+    Stores entries in a Django cache (settings.CACHES), e.g. to share them
+    between worker processes. Eviction is left to the configured cache.
+    '''
+
+    def __init__(self, alias='default', key_prefix='idealo:'):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        return self.cache.get(self.key_prefix + key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(self.key_prefix + key, (value, time.time()), ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.key_prefix + key)
+
+    def clear(self):
+        self.cache.clear()
+
+    async def aget(self, key):
+        return await self.cache.aget(self.key_prefix + key)
+
+    async def aset(self, key, value, ttl):
+        await self.cache.aset(self.key_prefix + key, (value, time.time()), ttl)
+
+
+class NullBackend:
+    '''
+    Stores nothing, so every search goes upstream (concurrent identical
+    searches are still coalesced). Used to measure or debug without the cache.
+    '''
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    async def aget(self, key):
+        return None
+
+    async def aset(self, key, value, ttl):
+        pass
+
+
+BACKENDS = {
+    'inprocess': InProcessBackend,
+    'django': DjangoCacheBackend,
+    'none': NullBackend
+}
+
+
+class SearchCache:
+    '''
+    TTL cache in front of Scraper.fetch. fetch/afetch return the usual
+    (is_payload_valid, validation_msg, items) plus the cache status and the
+    entry age in seconds. Concurrent misses for the same key are coalesced
+    into one upstream call.
+
+    Entries are fresh ('HIT') for the region's soft TTL. For another
+    stale_while_revalidate seconds they are served as 'STALE' while one
+    background refresh runs. Until hard_ttl they are kept as a fallback:
+    if the refetch fails upstream, the old result is served as 'STALE-IF-ERROR'.
+    '''
+
+    def __init__(self, backend=None, default_ttl=DEFAULT_TTL, region_ttls=None, flight=None,
+                 stale_while_revalidate=STALE_WHILE_REVALIDATE, hard_ttl=HARD_TTL):
+        self.backend = backend or InProcessBackend()
+        self.flight = flight or SingleFlight()
+        self.default_ttl = default_ttl
+        self.region_ttls = region_ttls or {}
+        self.stale_while_revalidate = stale_while_revalidate
+        self.hard_ttl = hard_ttl
+        self.lock = threading.Lock()
+        self.revalidations = {}
+        self.executor = None
+        # set by modules.prewarm.build_prewarmer
+        self.prewarmer = None
+        self.budget = None
+        # receives record(params, items) for every upstream result, see idealo_app.history
+        self.history = None
+
+    def ttl(self, region):
+        return self.region_ttls.get(region, self.default_ttl)
+
+    def storage_ttl(self, region):
+        return max(self.hard_ttl, self.ttl(region) + self.stale_while_revalidate)
+
+    def state(self, cached, region):
+        age = time.time() - cached[1]
+        if age < self.ttl(region):
+            return 'HIT'
+        if age < self.ttl(region) + self.stale_while_revalidate:
+            return 'STALE'
+        return 'EXPIRED'
+
+    def prepare(self, scraper, params, validated=False):
+        '''
+        Validates params (unless the caller already did) and returns their
+        cache key; the search schema is checked once per request.
+        '''
+        if not validated:
+            is_payload_valid, validation_msg = scraper.validate_payload(params)
+            if not is_payload_valid:
+                return is_payload_valid, validation_msg, None
+        return True, '', normalize(**params)
+
+    def lookup(self, cached, limit, cache_status='HIT'):
+        CACHE_REQUESTS.labels(cache_status).inc()
+        items, stored_at = cached
+        return True, '', items[:limit], cache_status, int(time.time() - stored_at)
+
+    def fetch_and_store(self, scraper, key, params, force=False):
+        cached = self.backend.get(key)
+        if not force and cached is not None and self.state(cached, params['region']) == 'HIT':
+            return True, '', cached[0]
+        # forced refreshes are pre-warms, which spend the budget themselves
+        if self.budget is not None and not force:
+            self.budget.record()
+        result = scraper.fetch(validated=True, **dict(params, limit=limit_bucket(params['limit'])))
+        if result[0] and result[2]:
+            self.backend.set(key, result[2], self.storage_ttl(params['region']))
+            if self.history is not None:
+                self.history.record(params, result[2])
+        return result
+
+    async def afetch_and_store(self, scraper, key, params):
+        cached = await self.backend.aget(key)
+        if cached is not None and self.state(cached, params['region']) == 'HIT':
+            return True, '', cached[0]
+        if self.budget is not None:
+            self.budget.record()
+        result = await scraper.fetch(validated=True, **dict(params, limit=limit_bucket(params['limit'])))
+        if result[0] and result[2]:
+            await self.backend.aset(key, result[2], self.storage_ttl(params['region']))
+            if self.history is not None:
+                self.history.record(params, result[2])
+        return result
+
+    def revalidated(self, key, future):
+        with self.lock:
+            self.revalidations.pop(key, None)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f'Error revalidating {key}: {str(future.exception())}')
+
+    def revalidate(self, scraper, key, params):
+        '''
+        Refreshes a stale entry on a background thread, once per key at a time.
+        '''
+        with self.lock:
+            if key in self.revalidations:
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=REVALIDATE_WORKERS, thread_name_prefix='cache-revalidate')
+            future = self.revalidations[key] = self.executor.submit(
+                self.flight.do, key, lambda: self.fetch_and_store(scraper, key, params), (OverloadedError,))
+        future.add_done_callback(lambda future: self.revalidated(key, future))
+
+    def arevalidate(self, scraper, key, params):
+        '''
+        Refreshes a stale entry in a background task on the running loop.
+        '''
+        with self.lock:
+            if key in self.revalidations:
+                return
+            task = self.revalidations[key] = asyncio.ensure_future(
+                self.flight.ado(key, lambda: self.afetch_and_store(scraper, key, params), (OverloadedError,)))
+        task.add_done_callback(lambda task: self.revalidated(key, task))
+
+    def result(self, result, cached, limit):
+        is_payload_valid, validation_msg, items = result
+        if is_payload_valid and items is None and cached is not None:
+            return self.lookup(cached, limit, 'STALE-IF-ERROR')
+        if is_payload_valid and items:
+            items = items[:limit]
+        CACHE_REQUESTS.labels('MISS').inc()
+        return is_payload_valid, validation_msg, items, 'MISS', 0
+
+    def refresh(self, scraper, **params):
+        '''
+        Refetches a search and stores it regardless of the cached entry's age.
+        '''
+        is_payload_valid, validation_msg, key = self.prepare(scraper, params)
+        if key is None:
+            return is_payload_valid, validation_msg, None
+        return self.flight.do(key, lambda: self.fetch_and_store(scraper, key, params, force=True), (OverloadedError,))
+
+    def fetch(self, scraper, validated=False, **params):
+        is_payload_valid, validation_msg, key = self.prepare(scraper, params, validated)
+        if key is None:
+            return is_payload_valid, validation_msg, None, 'MISS', 0
+        if self.prewarmer is not None:
+            self.prewarmer.track(key, params)
+        cached = self.backend.get(key)
+        if cached is not None:
+            cache_status = self.state(cached, params['region'])
+            if cache_status == 'STALE':
+                self.revalidate(scraper, key, params)
+            if cache_status != 'EXPIRED':
+                return self.lookup(cached, params['limit'], cache_status)
+
+        try:
+            # the leader's upstream slot is taken for its own API key, so a
+            # refused slot is not passed on to the callers waiting on it
+            result = self.flight.do(key, lambda: self.fetch_and_store(scraper, key, params), (OverloadedError,))
+        except UpstreamError as e:
+            if cached is None:
+                raise
+            logger.error(f'Serving stale result for {key}: {str(e)}')
+            return self.lookup(cached, params['limit'], 'STALE-IF-ERROR')
+        return self.result(result, cached, params['limit'])
+
+    async def afetch(self, scraper, validated=False, **params):
+        is_payload_valid, validation_msg, key = self.prepare(scraper, params, validated)
+        if key is None:
+            return is_payload_valid, validation_msg, None, 'MISS', 0
+        if self.prewarmer is not None:
+            self.prewarmer.track(key, params)
+        cached = await self.backend.aget(key)
+        if cached is not None:
+            cache_status = self.state(cached, params['region'])
+            if cache_status == 'STALE':
+                self.arevalidate(scraper, key, params)
+            if cache_status != 'EXPIRED':
+                return self.lookup(cached, params['limit'], cache_status)
+
+        try:
+            result = await self.flight.ado(key, lambda: self.afetch_and_store(scraper, key, params), (OverloadedError,))
+        except UpstreamError as e:
+            if cached is None:
+                raise
+            logger.error(f'Serving stale result for {key}: {str(e)}')
+            return self.lookup(cached, params['limit'], 'STALE-IF-ERROR')
+        return self.result(result, cached, params['limit'])
+
+
+def build_cache(config):
+    '''
+    Builds a SearchCache from a settings dict such as settings.IDEALO_CACHE.
+    '''
+    options = dict(config.get('OPTIONS', {}))
+    backend = BACKENDS[config.get('BACKEND', 'inprocess')](**options)
+    return SearchCache(backend, config.get('DEFAULT_TTL', DEFAULT_TTL), config.get('REGION_TTLS'),
+                       stale_while_revalidate=config.get('STALE_WHILE_REVALIDATE', STALE_WHILE_REVALIDATE),
+                       hard_ttl=config.get('HARD_TTL', HARD_TTL))
@@ -0,0 +1,210 @@
+import zlib
+import struct
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+MIN_SIZE = 1024
+CACHE_ENTRIES = 1024
+CACHE_BYTES = 16 * 1024 * 1024
+
+# Fixed gzip member header: deflate, no flags, no mtime, unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+class GzipCodec:
+    '''
+    gzip with the body split into raw deflate segments. Segments end on a
+    sync flush and never refer back to earlier ones, so a segment compressed
+    once can be spliced into any later body. The short head and tail around
+    it are written as stored (uncompressed) blocks.
+    '''
+    name = 'gzip'
+
+    def segment(self, data):
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def stored(self, data, is_final=False):
+        blocks = [data[index:index + 0xffff] for index in range(0, len(data), 0xffff)] or [b'']
+        return b''.join(struct.pack('<BHH', is_final and index == len(blocks) - 1, len(block), len(block) ^ 0xffff) + block
+                        for index, block in enumerate(blocks))
+
+    def join(self, head, segment, tail, body):
+        return b''.join((GZIP_HEADER, self.stored(head), segment, self.stored(tail, True),
+                         struct.pack('<II', zlib.crc32(body), len(body) & 0xffffffff)))
+
+    def compress(self, data):
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        return compressor.compress(data) + compressor.flush()
+
+    def stream(self):
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        return lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+class ZstdCodec:
+    '''
+    zstd; a body may consist of several frames (RFC 8878), so segments are
+    separate frames.
+    '''
+    name = 'zstd'
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def segment(self, data):
+        # ZstdCompressor instances must not be shared between threads
+        compressor = getattr(self.local, 'compressor', None)
+        if compressor is None:
+            compressor = self.local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return compressor.compress(data)
+
+    def join(self, head, segment, tail, body):
+        return b''.join((self.segment(head), segment, self.segment(tail)))
+
+    compress = segment
+
+    def stream(self):
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), compressor.flush
+
+
+class BrotliCodec:
+    '''
+    Brotli streams cannot be concatenated, so bodies are always compressed whole.
+    '''
+    name = 'br'
+    segment = None
+
+    def compress(self, data):
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+
+    def stream(self):
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return lambda chunk: compressor.process(chunk) + compressor.flush(), compressor.finish
+
+
+def available_codecs():
+    codecs = {'gzip': GzipCodec()}
+    if brotli is not None:
+        codecs['br'] = BrotliCodec()
+    if zstandard is not None:
+        codecs['zstd'] = ZstdCodec()
+    return codecs
+
+
+@lru_cache(maxsize=256)
+def negotiate(accept_encoding, encodings):
+    '''
+    The encoding out of encodings (in server preference order) that
+    accept_encoding gives the highest q-value, or None.
+    '''
+    weights = {}
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.partition(';')
+        params = params.strip()
+        try:
+            weights[name.strip()] = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            weights[name.strip()] = 0.0
+    best, best_weight = None, 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+class SegmentCache:
+    '''
+    Thread-safe LRU of compressed segments, capped by entry count and size.
+    '''
+
+    def __init__(self, max_entries=CACHE_ENTRIES, max_bytes=CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            segment = self.entries.get(key)
+            if segment is not None:
+                self.entries.move_to_end(key)
+            return segment
+
+    def set(self, key, segment):
+        if len(segment) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = segment
+            self.size += len(segment)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class Compressor:
+    '''
+    Compresses response bodies with the best encoding a client accepts.
+    Bodies below min_size are left alone. Given a tag identifying a part of
+    the body (the item ETag of a search result), that part is compressed once
+    and reused while it is in the cache; the rest, e.g. processing_time_ms,
+    is compressed per response.
+    '''
+
+    def __init__(self, encodings=('zstd', 'br', 'gzip'), min_size=MIN_SIZE, cache_entries=CACHE_ENTRIES, cache_bytes=CACHE_BYTES):
+        codecs = available_codecs()
+        self.codecs = {encoding: codecs[encoding] for encoding in encodings if encoding in codecs}
+        self.encodings = tuple(self.codecs)
+        self.min_size = min_size
+        self.cache = SegmentCache(cache_entries, cache_bytes)
+
+    def negotiate(self, accept_encoding):
+        if not accept_encoding:
+            return None
+        return negotiate(accept_encoding, self.encodings)
+
+    def compress(self, encoding, body, tag=None, span=None):
+        '''
+        Compresses body. span is (start, end) of the part of body identified
+        by tag; only that part is cached, so without a span the whole body
+        is compressed every time.
+        '''
+        codec = self.codecs[encoding]
+        if tag is None or span is None or codec.segment is None:
+            return codec.compress(body)
+        start, end = span
+        part = body[start:end]
+        # items with equal ETags encode to equal bytes; the length tells JSON from NDJSON
+        key = (encoding, tag, len(part))
+        segment = self.cache.get(key)
+        if segment is None:
+            segment = codec.segment(part)
+            self.cache.set(key, segment)
+        return codec.join(body[:start], segment, body[end:], body)
+
+    def stream(self, encoding):
+        '''
+        Returns (compress, finish) for a streamed body: compress(chunk)
+        returns the compressed chunk, flushed so it can be sent right away.
+        '''
+        return self.codecs[encoding].stream()
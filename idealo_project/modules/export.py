@@ -0,0 +1,395 @@
+import os
+import re
+import csv
+import json
+import math
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from itertools import islice
+from modules.items import dumps
+from modules.idealo import Scraper, get_scraper
+from modules.scheduler import client
+from modules.schema import Field, Schema
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+TOTAL = 1000
+PARALLELISM = 4
+CHUNK_ROWS = 100000
+MAX_TASKS = 1000
+MAX_JOBS = 1
+
+CHECKPOINT = 'checkpoint.json'
+COLUMNS = ('region', 'category', 'minPrice', 'maxPrice', 'itemId', 'name', 'url', 'images')
+PART_PATTERN = re.compile(r'part-\d{5}\.\w+(\.tmp)?')
+JOB_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+def plan(regions, categories, price_bands):
+    '''
+    One task per distinct region x category x price band, in a stable order.
+    '''
+    return [{'region': region, 'category': category, 'minPrice': minPrice, 'maxPrice': maxPrice}
+            for region in dict.fromkeys(regions) for category in dict.fromkeys(categories)
+            for minPrice, maxPrice in dict.fromkeys(tuple(band) for band in price_bands)]
+
+
+def task_key(task):
+    return f"{task['region']}|{task['category']}|{task['minPrice']}|{task['maxPrice']}"
+
+
+def task_rows(task, items):
+    return [{**task, 'itemId': item.itemId, 'name': item.name, 'url': item.url, 'images': item.images} for item in items]
+
+
+def validate_export(data):
+    '''
+    Checks an export request: regions, categories and priceBands
+    ([[minPrice, maxPrice], ...]) plus the optional format, total and sort.
+    '''
+    errors = EXPORT_SCHEMA.validate(data)
+    if errors:
+        return False, '; '.join(errors)
+    if data.get('format') == 'parquet' and pyarrow is None:
+        return False, 'Parquet output requires pyarrow (pip install pyarrow)'
+    if len(plan(data['regions'], data['categories'], data['priceBands'])) > MAX_TASKS:
+        return False, f'An export may have at most {MAX_TASKS} region x category x price band combinations'
+    return True, ''
+
+
+class ChunkWriter:
+    '''
+    Writes rows to part-NNNNN files in directory. A part is written as
+    part-NNNNN.<ext>.tmp and renamed when closed, so only complete parts
+    carry their final name.
+    '''
+    extension = None
+
+    def __init__(self, directory, part=0):
+        self.directory = directory
+        self.part = part
+        self.rows = 0
+        self.file = None
+
+    @property
+    def name(self):
+        return f'part-{self.part:05d}.{self.extension}'
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self.file is None:
+            self.file = self.open(os.path.join(self.directory, self.name + '.tmp'))
+        self.write_rows(rows)
+        self.rows += len(rows)
+
+    def close(self):
+        '''
+        Closes the current part and returns its name, or None if nothing was written.
+        '''
+        if self.file is None:
+            return None
+        self.close_file()
+        self.file = None
+        name = self.name
+        os.replace(os.path.join(self.directory, name + '.tmp'), os.path.join(self.directory, name))
+        self.part += 1
+        self.rows = 0
+        return name
+
+    def open(self, path):
+        raise NotImplementedError
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def close_file(self):
+        self.file.close()
+
+
+class NDJSONWriter(ChunkWriter):
+    extension = 'ndjson'
+
+    def open(self, path):
+        return open(path, 'wb')
+
+    def write_rows(self, rows):
+        self.file.write(b''.join(dumps(row) + b'\n' for row in rows))
+
+
+class CSVWriter(ChunkWriter):
+    '''
+    One CSV file per part with a header row; images are JSON encoded.
+    '''
+    extension = 'csv'
+
+    def open(self, path):
+        file = open(path, 'w', newline='', encoding='utf-8')
+        self.csv = csv.DictWriter(file, COLUMNS)
+        self.csv.writeheader()
+        return file
+
+    def write_rows(self, rows):
+        self.csv.writerows(dict(row, images=dumps(row['images']).decode('utf-8')) for row in rows)
+
+
+class ParquetWriter(ChunkWriter):
+    '''
+    One Parquet file per part, one row group per task; images are JSON encoded.
+    '''
+    extension = 'parquet'
+
+    def open(self, path):
+        if pyarrow is None:
+            raise ImportError('Parquet output requires pyarrow (pip install pyarrow)')
+        self.schema = pyarrow.schema([
+            (column, pyarrow.int64() if column in ('minPrice', 'maxPrice') else pyarrow.string()) for column in COLUMNS])
+        return pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_rows(self, rows):
+        self.file.write_table(pyarrow.Table.from_pylist(
+            [dict(row, images=dumps(row['images']).decode('utf-8')) for row in rows], schema=self.schema))
+
+
+WRITERS = {
+    'ndjson': NDJSONWriter,
+    'csv': CSVWriter,
+    'parquet': ParquetWriter
+}
+
+EXPORT_SCHEMA = Schema({
+    'regions': Field(list, Scraper.REGIONS_ERROR, non_empty=True, items=Field(str, choices=Scraper.REGIONS)),
+    'categories': Field(list, 'categories must be List of Strings', non_empty=True, items=Field(str)),
+    'priceBands': Field(list, 'priceBands must be List of [minPrice, maxPrice] Integer pairs', non_empty=True,
+                        items=Field(list, check=lambda band: len(band) == 2 and type(band[0]) is int and type(band[1]) is int and band[0] <= band[1])),
+    'format': Field(str, f"format must be one of {', '.join(WRITERS)}.", required=False, choices=WRITERS),
+    'total': Field(int, f'total must be Integer between 1-{Scraper.MAX_DEEP_TOTAL}', required=False, between=(1, Scraper.MAX_DEEP_TOTAL)),
+    'sort': Field(str, 'sort must be String', required=False)
+})
+
+
+class Exporter:
+    '''
+    Crawls region x category x price band tasks with at most parallelism
+    deep fetches in flight and writes their items to part files of about
+    chunk_rows rows in directory. A task's items are held until the task
+    completes, so memory is bounded by parallelism x total items however
+    large the export is.
+
+    checkpoint.json is rewritten whenever a part is closed and lists the
+    tasks those parts contain. Running an Exporter on the same directory
+    resumes after the last closed part: the unfinished part is discarded
+    and its tasks, failed tasks and the rest are fetched again.
+
+    Upstream calls are attributed to the API key in the checkpoint's meta
+    (owner and subscription), so an export queues with its owner's other
+    requests in the scheduler.
+    '''
+
+    def __init__(self, directory, format='ndjson', total=TOTAL, sort='RELEVANCE', parallelism=PARALLELISM,
+                 chunk_rows=CHUNK_ROWS, scraper_factory=None, progress=None):
+        self.directory = directory
+        self.format = format
+        self.total = total
+        self.sort = sort
+        self.parallelism = parallelism
+        self.chunk_rows = chunk_rows
+        self.scraper_factory = scraper_factory
+        self.progress = progress
+        self.meta = {}
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.directory, CHECKPOINT)
+
+    def scraper(self):
+        if self.scraper_factory is not None:
+            return self.scraper_factory()
+        return get_scraper()
+
+    def load(self):
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path) as file:
+            return json.load(file)
+
+    def save(self, state):
+        state['updated_at'] = round(time.time())
+        with open(self.checkpoint_path + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def prepare(self, tasks=None, meta=None):
+        '''
+        Creates the checkpoint for tasks, or loads the existing one. Resuming
+        uses the format, total and sort the export was started with.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        state = self.load()
+        if state is None:
+            if not tasks:
+                raise ValueError(f'No export to resume in {self.directory}')
+            state = {'format': self.format, 'total': self.total, 'sort': self.sort, 'tasks': tasks,
+                     'done': {}, 'failed': {}, 'parts': [], 'rows': 0, 'status': 'queued', 'meta': meta or {}}
+            self.save(state)
+        elif tasks and [task_key(task) for task in tasks] != [task_key(task) for task in state['tasks']]:
+            raise ValueError(f'{self.directory} holds a different export')
+        self.format, self.total, self.sort = state['format'], state['total'], state['sort']
+        self.meta = state['meta']
+        return state
+
+    def discard_partial(self, state):
+        for name in os.listdir(self.directory):
+            if PART_PATTERN.fullmatch(name) and name not in state['parts']:
+                os.remove(os.path.join(self.directory, name))
+
+    def upstream_client(self):
+        if self.meta.get('owner') is None:
+            return nullcontext()
+        return client(self.meta['owner'], self.meta.get('subscription', 'free'))
+
+    def crawl(self, task):
+        try:
+            with self.upstream_client():
+                is_payload_valid, validation_msg, items = self.scraper().fetch_deep(
+                    self.total, task['minPrice'], task['maxPrice'], [task['category']], self.sort, task['region'], parallelism=1)
+        except Exception as e:
+            logger.error(f'Error exporting {task_key(task)}: {str(e)}')
+            return task, None, str(e)
+        return task, items, validation_msg
+
+    def commit(self, state, writer, written):
+        '''
+        Closes the current part and records its tasks as done.
+        '''
+        name = writer.close()
+        if name is not None:
+            state['parts'].append(name)
+        for key, rows in written.items():
+            state['done'][key] = rows
+            state['rows'] += rows
+        written.clear()
+        self.save(state)
+        if self.progress is not None:
+            self.progress(state)
+
+    def run(self, tasks=None, meta=None):
+        '''
+        Runs (or resumes) the export and returns the final checkpoint state.
+        status is 'complete', or 'incomplete' if some tasks failed; running
+        again retries them.
+        '''
+        state = self.prepare(tasks, meta)
+        self.discard_partial(state)
+        state['status'], state['failed'] = 'running', {}
+        self.save(state)
+        todo = iter([task for task in state['tasks'] if task_key(task) not in state['done']])
+        writer = WRITERS[self.format](self.directory, len(state['parts']))
+        written = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallelism, thread_name_prefix='export') as executor:
+                pending = {executor.submit(self.crawl, task) for task in islice(todo, self.parallelism)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        task = next(todo, None)
+                        if task is not None:
+                            pending.add(executor.submit(self.crawl, task))
+                        task, items, validation_msg = future.result()
+                        if items is None:
+                            state['failed'][task_key(task)] = validation_msg or 'Error retrieving data.'
+                            continue
+                        writer.write(task_rows(task, items))
+                        written[task_key(task)] = len(items)
+                        if writer.rows >= self.chunk_rows:
+                            self.commit(state, writer, written)
+            self.commit(state, writer, written)
+        except BaseException:
+            state['status'] = 'interrupted'
+            self.save(state)
+            raise
+        state['status'] = 'incomplete' if state['failed'] else 'complete'
+        self.save(state)
+        return state
+
+
+def charged_requests(state):
+    '''
+    Upstream requests an export used: one per PAGE_SIZE items of each finished task.
+    '''
+    from modules.idealo import Scraper
+    return sum(max(1, math.ceil(rows / Scraper.PAGE_SIZE)) for rows in state['done'].values())
+
+
+class ExportJobs:
+    '''
+    Runs exports submitted through the API on background threads, at most
+    max_jobs at a time. Each job lives in directory/<job_id>; its status is
+    read from the checkpoint, so any worker process sharing the directory
+    can report it. Interrupted jobs are resumed with
+    `python manage.py export <directory>/<job_id>`.
+    '''
+
+    def __init__(self, directory, max_jobs=MAX_JOBS, parallelism=PARALLELISM, chunk_rows=CHUNK_ROWS):
+        self.directory = str(directory)
+        self.max_jobs = max_jobs
+        self.parallelism = parallelism
+        self.chunk_rows = chunk_rows
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def job_directory(self, job_id):
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        return os.path.join(self.directory, job_id)
+
+    def exporter(self, job_id, **kwargs):
+        return Exporter(self.job_directory(job_id), parallelism=self.parallelism, chunk_rows=self.chunk_rows, **kwargs)
+
+    def run(self, job_id, on_done=None):
+        state = None
+        try:
+            state = self.exporter(job_id).run()
+        except Exception as e:
+            logger.error(f'Error running export {job_id}: {str(e)}')
+        finally:
+            if on_done is not None:
+                on_done(state or self.status(job_id))
+
+    def submit(self, tasks, format='ndjson', total=TOTAL, sort='RELEVANCE', meta=None, on_done=None):
+        '''
+        Queues an export and returns its job id. on_done(state) is called
+        when it finishes.
+        '''
+        job_id = uuid.uuid4().hex
+        self.exporter(job_id, format=format, total=total, sort=sort).prepare(tasks, meta)
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix='export-job')
+            self.executor.submit(self.run, job_id, on_done)
+        return job_id
+
+    def status(self, job_id):
+        directory = self.job_directory(job_id)
+        if directory is None:
+            return None
+        return Exporter(directory).load()
+
+    def part_path(self, job_id, name):
+        '''
+        Path of a closed part of a job, or None.
+        '''
+        state = self.status(job_id)
+        if state is None or name not in state['parts']:
+            return None
+        return os.path.join(self.job_directory(job_id), name)
@@ -1,8 +1,27 @@
-import requests
 import json
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from modules.transport import get_transport, get_async_transport
+from modules.payload import get_compiler, ITEM_FIELDS
+from modules.items import loads, parse_items
+from modules.schema import Field, Schema
+from modules.resilience import get_resilience
+from modules.scheduler import get_scheduler, bind
+from modules.metrics import PAYLOAD_BUILD_SECONDS, JSON_DECODE_SECONDS
+
+logger = logging.getLogger(__name__)
 
 
 class Scraper:
+    '''
+    Client for the Idealo search API. It keeps no per-request state, so one
+    instance (see get_scraper) is shared by all views and threads. An
+    optional region binds the client: fetch and fetch_deep then default to it.
+    '''
     REGIONS = {
         'AT': 2,
         'DE': 1,
@@ -12,83 +31,606 @@ class Scraper:
         'UK': 3
     }
 
-    def __init__(self):
-        self.siteID = None
-        self.region = None
+    PAGE_SIZE = 100
+    MAX_BATCH_SIZE = 100
+    BATCH_PARALLELISM = 8
+    MAX_DEEP_TOTAL = 10000
+    DEEP_FETCH_PARALLELISM = 4
+    MAX_RESPONSE_BYTES = 16 * 1024 * 1024
+
+    REGION_ERROR = f"region must be String. Valid regions are {', '.join(REGIONS.keys())}."
+    REGIONS_ERROR = f"regions must be List of Strings. Valid regions are {', '.join(REGIONS.keys())}."
+    FIELDS_ERROR = f"fields must be List of Strings. Valid fields are {', '.join(ITEM_FIELDS)}."
+
+    SEARCH_SCHEMA = Schema({
+        'limit': Field(int, f'limit must be Integer between 1-{PAGE_SIZE}', between=(1, PAGE_SIZE)),
+        'minPrice': Field(int, 'minPrice must be Integer'),
+        'maxPrice': Field(int, 'maxPrice must be Integer'),
+        'includeCategories': Field(list, 'includeCategories must be List of Strings', items=Field(str)),
+        'sort': Field(str, 'sort must be String'),
+        'region': Field(str, REGION_ERROR, choices=REGIONS),
+        'fields': Field(list, FIELDS_ERROR, required=False, non_empty=True, items=Field(str, choices=ITEM_FIELDS))
+    })
+    DEEP_SEARCH_SCHEMA = SEARCH_SCHEMA.extend(
+        limit=None, total=Field(int, f'total must be Integer between 1-{MAX_DEEP_TOTAL}', between=(1, MAX_DEEP_TOTAL)))
+    REGIONS_SCHEMA = SEARCH_SCHEMA.extend(
+        region=None, regions=Field(list, REGIONS_ERROR, non_empty=True, items=Field(str, choices=REGIONS)))
+
+    def __init__(self, region=None, transport=None, compiler=None, resilience=None, scheduler=None):
+        if region is not None and region not in self.REGIONS:
+            raise ValueError(
+                f"Invalid region '{region}'. Valid regions are {', '.join(self.REGIONS.keys())}.")
+        self.region = region
+        self.siteID = self.REGIONS.get(region)
+        self._transport = transport
+        self._compiler = compiler
+        self._resilience = resilience
+        self._scheduler = scheduler
+
+    # Unless injected, the per-process instances are looked up on use, so a
+    # long-lived client follows configure() calls made after it was created.
+    @property
+    def transport(self):
+        return self._transport or get_transport()
+
+    @property
+    def compiler(self):
+        return self._compiler or get_compiler()
+
+    @property
+    def resilience(self):
+        return self._resilience or get_resilience()
+
+    @property
+    def scheduler(self):
+        return self._scheduler or get_scheduler()
+
+    def validation_result(self, errors):
+        return not errors, '; '.join(errors)
 
     def validate_payload(self, data):
-        if isinstance(data.get('limit'), int) == False or data.get('limit') not in range(1, 101):
-            return False, 'limit must be Integer between 1-100'
-        if isinstance(data.get('minPrice'), int) == False:
-            return False, 'minPrice must be Integer'
-        if isinstance(data.get('maxPrice'), int) == False:
-            return False, 'maxPrice must be Integer'
-        if isinstance(data.get('includeCategories'), list) == False or all(isinstance(i, str) for i in data.get('includeCategories')) == False:
-            return False, 'includeCategories must be List of Strings'
-        if isinstance(data.get('sort'), str) == False:
-            return False, 'sort must be String'
-        if isinstance(data.get('region'), str) == False or data.get('region') not in self.REGIONS:
-            return False, f"region must be String. Valid regions are {', '.join(self.REGIONS.keys())}."
+        return self.validation_result(self.SEARCH_SCHEMA.validate(data))
+
+    def validate_deep_payload(self, data):
+        return self.validation_result(self.DEEP_SEARCH_SCHEMA.validate(data))
+
+    def validate_regions_payload(self, data):
+        return self.validation_result(self.REGIONS_SCHEMA.validate(data))
+
+    def request_errors(self, data):
+        '''
+        All errors of a POST /data/idealo body, a search or (with total) a
+        deep search, so invalid requests are rejected before any upstream work.
+        '''
+        if type(data) is dict and 'total' in data:
+            return self.DEEP_SEARCH_SCHEMA.validate(data)
+        return self.SEARCH_SCHEMA.validate(data)
+
+    def validate_batch_payload(self, queries):
+        if isinstance(queries, list) == False or len(queries) not in range(1, self.MAX_BATCH_SIZE + 1) or all(isinstance(i, dict) for i in queries) == False:
+            return False, f'Request must be List of 1-{self.MAX_BATCH_SIZE} search payloads'
         return True, ''
 
-    def build_payload(self, limit, minPrice, maxPrice, includeCategories, sort, region):
-        self.siteID = self.REGIONS.get(region)
-        payload = json.dumps({
-            "operationName": "Search",
-            "query": "query Search($siteID: Long!, $query: String!, $offset: Int!, $limit: Int!, $sort: SortType!, $reverse: Boolean!, $filters: SearchFiltersInput, $includeCategoryHits: Boolean!, $includeManufacturerHits: Boolean!, $includeSearchFilterGroups: Boolean!, $includeItemStateHits: Boolean!) {\n  search(\n    siteId: $siteID\n    query: $query\n    offset: $offset\n    limit: $limit\n    sort: $sort\n    reverse: $reverse\n    filters: $filters\n  ) {\n       count\n       categoryHits @include(if: $includeCategoryHits) {\n            categoryId\n      categoryName\n      categoryType\n      amount\n    }\n   \n    manufacturerHits @include(if: $includeManufacturerHits) {\n            manufacturerId\n      searchFilterId\n      manufacturerName\n      searchFilterId\n      amount\n    }\n    searchFilterGroups @include(if: $includeSearchFilterGroups) {\n            name\n      attributeId\n      combinationStrategy\n      orderPos\n      filters {\n                amount\n        orderPos\n        filterId\n        content\n        categoryId\n        ownClicks\n        productClicks\n      }\n    }\n    itemStateHits @include(if: $includeItemStateHits) {\n            itemState\n      amount\n    }\n        items {\n            ...searchItemFields\n    }\n    queryUsed {\n            query\n      filters {\n                minPrice\n        maxPrice\n        availableOnly\n        bargainsOnly\n        excludeUsed\n        includeCategories\n        includeSearchFilters\n        includeManufacturers\n        promotedShops\n        disableModifiers\n      }\n    }\n  }\n}\nfragment searchItemFields on Item {\n    ...itemFields\n    url\n  \n  \n        \n}\nfragment itemFields on Item {\n    itemId\n    name\n   images {\n            images350x350\n  }\n \n} ",
-            "variables": {
-                "filters": {
-                    "bargainsOnly": True,
-                    "disableModifiers": ["DELPHI"],
-                    "includeCategories": includeCategories,
-                    "maxPrice": maxPrice * 100,
-                    "minPrice": minPrice * 100,
-                    "promotedShops": []
-                },
-                "includeCategoryHits": False,
-                "includeItemStateHits": False,
-                "includeManufacturerHits": False,
-                "includeSearchFilterGroups": False,
-                "limit": limit,
-                "offset": 0,
-                "query": "",
-                "reverse": False,
-                "siteID": self.siteID,
-                "sort": sort
-            }
-        })
-        return payload
+    def batch_result(self, result):
+        is_payload_valid, validation_msg, items = result[:3]
+        if is_payload_valid and items:
+            return {'success': True, **self.stale_marker(result), 'data': items}
+        return {'success': False, 'error': validation_msg}
 
-    def fetch(self, limit, minPrice, maxPrice, includeCategories, sort, region):
+    def region_result(self, region, result):
+        is_payload_valid, validation_msg, items = result[:3]
+        if is_payload_valid and items:
+            return {'region': region, 'siteID': self.REGIONS[region], 'success': True, **self.stale_marker(result), 'data': items}
+        return {'region': region, 'siteID': self.REGIONS[region], 'success': False, 'error': validation_msg}
+
+    def stale_marker(self, result):
         '''
-        Validates the payload before fetching the response body. 
+        Flags results a SearchCache served from an expired entry.
         '''
-        is_payload_valid, validation_msg = self.validate_payload({
+        return {'stale': True} if len(result) > 3 and result[3].startswith('STALE') else {}
+
+    def build_variables(self, limit, minPrice, maxPrice, includeCategories, sort, region, offset=0):
+        return {
+            "filters": {
+                "bargainsOnly": True,
+                "disableModifiers": ["DELPHI"],
+                "includeCategories": includeCategories,
+                "maxPrice": maxPrice * 100,
+                "minPrice": minPrice * 100,
+                "promotedShops": []
+            },
+            "includeCategoryHits": False,
+            "includeItemStateHits": False,
+            "includeManufacturerHits": False,
+            "includeSearchFilterGroups": False,
             "limit": limit,
-            "minPrice": minPrice,
-            "maxPrice": maxPrice,
-            "includeCategories": includeCategories,
-            "sort": sort,
-            "region": region
-        })
+            "offset": offset,
+            "query": "",
+            "reverse": False,
+            "siteID": self.REGIONS.get(region),
+            "sort": sort
+        }
+
+    def build_payload(self, limit, minPrice, maxPrice, includeCategories, sort, region, offset=0, persisted=None, fields=None):
+        with PAYLOAD_BUILD_SECONDS.time():
+            return self.compiler.compile(self.build_variables(
+                limit, minPrice, maxPrice, includeCategories, sort, region, offset), persisted, fields)
+
+    def send(self, region, payload):
+        with self.scheduler.slot():
+            return self.resilience.call(region, lambda: self.transport.post(payload, self.MAX_RESPONSE_BYTES))
+
+    def post(self, limit, minPrice, maxPrice, includeCategories, sort, region, offset=0, fields=None):
+        '''
+        Posts the search through the resilience layer (retries, circuit
+        breaker, hedging), repeating it with the full query if the backend
+        does not know the persisted query.
+        '''
+        args = (limit, minPrice, maxPrice, includeCategories, sort, region, offset)
+        response = self.send(region, self.build_payload(*args, fields=fields))
+        if self.compiler.persisted and self.compiler.is_unknown_query(response):
+            response = self.send(region, self.build_payload(*args, persisted=False, fields=fields))
+        return response
+
+    def project(self, items, fields):
+        '''
+        Shapes items to the requested fields; itemId is only fetched for de-duplication.
+        '''
+        if fields is None or items is None:
+            return items
+        return [{field: getattr(item, field) for field in fields} for item in items]
+
+    def fetch(self, limit, minPrice, maxPrice, includeCategories, sort, region=None, fields=None, validated=False):
+        '''
+        Validates the payload before fetching the response body, unless the
+        caller already did (validated).
+        '''
+        region = region or self.region
+        if not validated:
+            is_payload_valid, validation_msg = self.validate_payload({
+                "limit": limit,
+                "minPrice": minPrice,
+                "maxPrice": maxPrice,
+                "includeCategories": includeCategories,
+                "sort": sort,
+                "region": region,
+                "fields": fields
+            })
+
+            if not is_payload_valid:
+                logger.info('Payload validation failed', extra={'validation_msg': validation_msg})
+                return is_payload_valid, validation_msg, None
+
+        response = self.post(
+            limit, minPrice, maxPrice, includeCategories, sort, region, fields=fields)
+        is_payload_valid, validation_msg, items = self.parse_response(response, region)
+        return is_payload_valid, validation_msg, self.project(items, fields)
+
+    def parse_search(self, response):
+        '''
+        The search object of a response, or None. Bodies over
+        MAX_RESPONSE_BYTES are rejected (the transport stops reading them), and
+        at most PAGE_SIZE items are kept.
+        '''
+        if response.status_code != 200:
+            logger.error(f'Idealo responded with status {response.status_code}')
+            return None
+        if response.too_large:
+            logger.error(f'Idealo response exceeds MAX_RESPONSE_BYTES ({self.MAX_RESPONSE_BYTES} bytes)')
+            return None
+        try:
+            with JSON_DECODE_SECONDS.time():
+                content = loads(response.content)
+        except ValueError:
+            logger.error('Idealo responded with invalid JSON')
+            return None
+        if content.get('errors') or not content.get('data') or not content['data'].get('search'):
+            return None
+        search = content['data']['search']
+        search['items'] = search.get('items', [])[:self.PAGE_SIZE]
+        return search
+
+    def parse_response(self, response, region=None):
+        search = self.parse_search(response)
+
+        if search is not None:
+            items = parse_items(search['items'])
+            logger.info('Scraped items', extra={'region': region, 'item_count': len(items)})
+            return True, '', items
+        else:
+            logger.error('Error scraping count.', extra={'region': region})
+            return True, "Error scraping count.", None
+
+    def page_offsets(self, total, count):
+        '''
+        Offsets of the pages after the first one, stopping at the smaller of
+        the requested total and the result count reported by Idealo.
+        '''
+        return range(self.PAGE_SIZE, min(total, count), self.PAGE_SIZE)
+
+    def dedupe_pages(self, total):
+        '''
+        Returns a function that drops already seen itemIds from a page (results
+        can shift between page requests) and cuts the stream at total items.
+        '''
+        seen = set()
+
+        def dedupe(page):
+            items = []
+            for item in page:
+                if len(seen) >= total:
+                    break
+                if item.itemId not in seen:
+                    seen.add(item.itemId)
+                    items.append(item)
+            return items
+        return dedupe
+
+    def fetch_page(self, offset, minPrice, maxPrice, includeCategories, sort, region, fields=None):
+        search = self.parse_search(self.post(
+            self.PAGE_SIZE, minPrice, maxPrice, includeCategories, sort, region, offset, fields=fields))
+        if search is None:
+            return None, 0
+        return parse_items(search['items']), search['count']
+
+    def fetch_deep_pages(self, total, minPrice, maxPrice, includeCategories, sort, region=None, parallelism=None, fields=None, validated=False):
+        '''
+        Validates the payload (unless validated) and fetches the first page. On
+        success the third value is a generator yielding de-duplicated pages in
+        offset order.
+        '''
+        region = region or self.region
+        if not validated:
+            is_payload_valid, validation_msg = self.validate_deep_payload({
+                "total": total,
+                "minPrice": minPrice,
+                "maxPrice": maxPrice,
+                "includeCategories": includeCategories,
+                "sort": sort,
+                "region": region,
+                "fields": fields
+            })
+
+            if not is_payload_valid:
+                logger.info('Payload validation failed', extra={'validation_msg': validation_msg})
+                return is_payload_valid, validation_msg, None
+
+        items, count = self.fetch_page(
+            0, minPrice, maxPrice, includeCategories, sort, region, fields)
+        if items is None:
+            return True, "Error scraping count.", None
+        return True, '', self.iter_pages(items, count, total, minPrice, maxPrice, includeCategories, sort, region, parallelism, fields,
+                                         fetch_page=bind(self.fetch_page))
+
+    def iter_pages(self, items, count, total, minPrice, maxPrice, includeCategories, sort, region, parallelism=None, fields=None, fetch_page=None):
+        '''
+        Yields the first page, then the remaining offset pages while keeping at
+        most parallelism requests in flight. Stops early on an empty or failed page.
+        fetch_page defaults to self.fetch_page.
+        '''
+        fetch_page = fetch_page or self.fetch_page
+        dedupe = self.dedupe_pages(total)
+        yield self.project(dedupe(items), fields)
+
+        offsets = iter(self.page_offsets(total, count))
+        parallelism = parallelism or self.DEEP_FETCH_PARALLELISM
+        executor = ThreadPoolExecutor(max_workers=parallelism)
+        pending = deque(executor.submit(fetch_page, offset, minPrice, maxPrice, includeCategories, sort, region, fields)
+                        for offset in islice(offsets, parallelism))
+        try:
+            while pending:
+                page, _ = pending.popleft().result()
+                if not page:
+                    return
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(
+                        fetch_page, offset, minPrice, maxPrice, includeCategories, sort, region, fields))
+                yield self.project(dedupe(page), fields)
+        finally:
+            # also on close (client disconnect): queued pages are never
+            # fetched and pages in flight are not waited for (no
+            # cancel_futures before Python 3.9)
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def fetch_deep(self, total, minPrice, maxPrice, includeCategories, sort, region=None, parallelism=None, fields=None, validated=False):
+        '''
+        Fetches up to total items by splitting them into offset pages of
+        PAGE_SIZE, requesting up to parallelism pages at once.
+        '''
+        is_payload_valid, validation_msg, pages = self.fetch_deep_pages(
+            total, minPrice, maxPrice, includeCategories, sort, region, parallelism, fields, validated)
+        if pages is None:
+            return is_payload_valid, validation_msg, None
+
+        items = [item for page in pages for item in page]
+        logger.info('Scraped items', extra={'region': region or self.region, 'item_count': len(items), 'total': total})
+        return True, '', items
 
+    def fetch_regions(self, regions, limit, minPrice, maxPrice, includeCategories, sort, fetch=None, fields=None, validated=False):
+        '''
+        Runs the same search in all regions concurrently. Returns one result per
+        region tagged with region and siteID; failures are reported per region.
+        fetch defaults to self.fetch and can be swapped, e.g. for a cached fetch.
+        validated skips the schema check for params the caller already checked.
+        '''
+        if not validated:
+            is_payload_valid, validation_msg = self.validate_regions_payload({
+                "regions": regions,
+                "limit": limit,
+                "minPrice": minPrice,
+                "maxPrice": maxPrice,
+                "includeCategories": includeCategories,
+                "sort": sort,
+                "fields": fields
+            })
+
+            if not is_payload_valid:
+                logger.info('Payload validation failed', extra={'validation_msg': validation_msg})
+                return is_payload_valid, validation_msg, None
+
+        fetch = fetch or self.fetch
+        regions = list(dict.fromkeys(regions))
+
+        def fetch_region(region):
+            try:
+                return fetch(limit=limit, minPrice=minPrice, maxPrice=maxPrice,
+                             includeCategories=includeCategories, sort=sort, region=region, fields=fields, validated=True)
+            except Exception as e:
+                logger.error(f'Error scraping region {region}: {str(e)}')
+                return True, 'Error retrieving data.', None
+
+        with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            results = list(executor.map(bind(fetch_region), regions))
+        return True, '', [self.region_result(region, result) for region, result in zip(regions, results)]
+
+    def fetch_batch(self, queries, fetch=None, parallelism=None):
+        '''
+        Runs a list of search payloads concurrently and returns one result per
+        query in request order. Identical queries are fetched once.
+        '''
+        is_payload_valid, validation_msg = self.validate_batch_payload(queries)
         if not is_payload_valid:
-            print(f"Payload validation failed: {validation_msg}")
             return is_payload_valid, validation_msg, None
 
-        payload = self.build_payload(
-            limit, minPrice, maxPrice, includeCategories, sort, region)
-        response = requests.post("https://app.idealo.de/app-backend/api",
-                                 headers={'Content-Type': 'application/json'}, data=payload)
-        content = response.json()
+        fetch = fetch or self.fetch
+        unique_queries = {json.dumps(query, sort_keys=True): query for query in queries}
 
-        if response.status_code == 200 and len(content['errors']) == 0:
-            items = content['data']['search']['items']
-            print(f"Scraped item count: {len(items)}")
-            return is_payload_valid, validation_msg, items
-        else:
-            print(f'Error scraping count.')
-            return is_payload_valid, "Error scraping count.", None
+        def fetch_query(query):
+            is_payload_valid, validation_msg = self.validate_payload(query)
+            if not is_payload_valid:
+                return is_payload_valid, validation_msg, None
+            try:
+                return fetch(validated=True, **query)
+            except Exception as e:
+                logger.error(f'Error scraping batch query: {str(e)}')
+                return True, 'Error retrieving data.', None
+
+        with ThreadPoolExecutor(max_workers=parallelism or self.BATCH_PARALLELISM) as executor:
+            results = dict(zip(unique_queries, executor.map(bind(fetch_query), unique_queries.values())))
+        return True, '', [self.batch_result(results[json.dumps(query, sort_keys=True)]) for query in queries]
+
+
+class AsyncScraper(Scraper):
+    '''
+    Non-blocking counterpart of Scraper for asyncio callers (ASGI views).
+    Validation and payload building are shared, only the upstream round trip
+    is awaited. Without a transport, the AsyncTransport of the running loop
+    is used, so one instance can serve every loop.
+    '''
+
+    @property
+    def transport(self):
+        return self._transport or get_async_transport()
+
+    async def send(self, region, payload):
+        transport = self.transport
+        async with self.scheduler.aslot():
+            return await self.resilience.acall(region, lambda: transport.post(payload, self.MAX_RESPONSE_BYTES))
+
+    async def post(self, limit, minPrice, maxPrice, includeCategories, sort, region, offset=0, fields=None):
+        args = (limit, minPrice, maxPrice, includeCategories, sort, region, offset)
+        response = await self.send(region, self.build_payload(*args, fields=fields))
+        if self.compiler.persisted and self.compiler.is_unknown_query(response):
+            response = await self.send(region, self.build_payload(*args, persisted=False, fields=fields))
+        return response
+
+    async def fetch(self, limit, minPrice, maxPrice, includeCategories, sort, region=None, fields=None, validated=False):
+        '''
+        Validates the payload before fetching the response body, unless the
+        caller already did (validated).
+        '''
+        region = region or self.region
+        if not validated:
+            is_payload_valid, validation_msg = self.validate_payload({
+                "limit": limit,
+                "minPrice": minPrice,
+                "maxPrice": maxPrice,
+                "includeCategories": includeCategories,
+                "sort": sort,
+                "region": region,
+                "fields": fields
+            })
+
+            if not is_payload_valid:
+                logger.info('Payload validation failed', extra={'validation_msg': validation_msg})
+                return is_payload_valid, validation_msg, None
+
+        response = await self.post(
+            limit, minPrice, maxPrice, includeCategories, sort, region, fields=fields)
+        is_payload_valid, validation_msg, items = self.parse_response(response, region)
+        return is_payload_valid, validation_msg, self.project(items, fields)
+
+    async def fetch_page(self, offset, minPrice, maxPrice, includeCategories, sort, region, fields=None):
+        search = self.parse_search(await self.post(
+            self.PAGE_SIZE, minPrice, maxPrice, includeCategories, sort, region, offset, fields=fields))
+        if search is None:
+            return None, 0
+        return parse_items(search['items']), search['count']
+
+    async def fetch_deep_pages(self, total, minPrice, maxPrice, includeCategories, sort, region=None, parallelism=None, fields=None, validated=False):
+        '''
+        Validates the payload (unless validated) and fetches the first page. On
+        success the third value is an async generator yielding de-duplicated
+        pages in offset order.
+        '''
+        region = region or self.region
+        if not validated:
+            is_payload_valid, validation_msg = self.validate_deep_payload({
+                "total": total,
+                "minPrice": minPrice,
+                "maxPrice": maxPrice,
+                "includeCategories": includeCategories,
+                "sort": sort,
+                "region": region,
+                "fields": fields
+            })
+
+            if not is_payload_valid:
+                logger.info('Payload validation failed', extra={'validation_msg': validation_msg})
+                return is_payload_valid, validation_msg, None
+
+        items, count = await self.fetch_page(
+            0, minPrice, maxPrice, includeCategories, sort, region, fields)
+        if items is None:
+            return True, "Error scraping count.", None
+        return True, '', self.iter_pages(items, count, total, minPrice, maxPrice, includeCategories, sort, region, parallelism, fields,
+                                         fetch_page=bind(self.fetch_page))
+
+    async def iter_pages(self, items, count, total, minPrice, maxPrice, includeCategories, sort, region, parallelism=None, fields=None, fetch_page=None):
+        '''
+        Yields the first page, then the remaining offset pages while keeping at
+        most parallelism requests in flight. Stops early on an empty or failed page.
+        fetch_page defaults to self.fetch_page.
+        '''
+        fetch_page = fetch_page or self.fetch_page
+        dedupe = self.dedupe_pages(total)
+        yield self.project(dedupe(items), fields)
+
+        offsets = iter(self.page_offsets(total, count))
+        parallelism = parallelism or self.DEEP_FETCH_PARALLELISM
+        pending = deque(asyncio.ensure_future(fetch_page(offset, minPrice, maxPrice, includeCategories, sort, region, fields))
+                        for offset in islice(offsets, parallelism))
+        try:
+            while pending:
+                page, _ = await pending.popleft()
+                if not page:
+                    return
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(asyncio.ensure_future(
+                        fetch_page(offset, minPrice, maxPrice, includeCategories, sort, region, fields)))
+                yield self.project(dedupe(page), fields)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def fetch_deep(self, total, minPrice, maxPrice, includeCategories, sort, region=None, parallelism=None, fields=None, validated=False):
+        '''
+        Fetches up to total items by splitting them into offset pages of
+        PAGE_SIZE, awaiting up to parallelism pages at once.
+        '''
+        is_payload_valid, validation_msg, pages = await self.fetch_deep_pages(
+            total, minPrice, maxPrice, includeCategories, sort, region, parallelism, fields, validated)
+        if pages is None:
+            return is_payload_valid, validation_msg, None
+
+        items = [item async for page in pages for item in page]
+        logger.info('Scraped items', extra={'region': region or self.region, 'item_count': len(items), 'total': total})
+        return True, '', items
+
+    async def fetch_regions(self, regions, limit, minPrice, maxPrice, includeCategories, sort, fetch=None, fields=None, validated=False):
+        '''
+        Runs the same search in all regions concurrently. Returns one result per
+        region tagged with region and siteID; failures are reported per region.
+        fetch defaults to self.fetch and can be swapped, e.g. for a cached fetch.
+        validated skips the schema check for params the caller already checked.
+        '''
+        if not validated:
+            is_payload_valid, validation_msg = self.validate_regions_payload({
+                "regions": regions,
+                "limit": limit,
+                "minPrice": minPrice,
+                "maxPrice": maxPrice,
+                "includeCategories": includeCategories,
+                "sort": sort,
+                "fields": fields
+            })
+
+            if not is_payload_valid:
+                logger.info('Payload validation failed', extra={'validation_msg': validation_msg})
+                return is_payload_valid, validation_msg, None
+
+        fetch = fetch or self.fetch
+        regions = list(dict.fromkeys(regions))
+
+        async def fetch_region(region):
+            try:
+                return await fetch(limit=limit, minPrice=minPrice, maxPrice=maxPrice,
+                                   includeCategories=includeCategories, sort=sort, region=region, fields=fields, validated=True)
+            except Exception as e:
+                logger.error(f'Error scraping region {region}: {str(e)}')
+                return True, 'Error retrieving data.', None
+
+        results = await asyncio.gather(*[fetch_region(region) for region in regions])
+        return True, '', [self.region_result(region, result) for region, result in zip(regions, results)]
+
+    async def fetch_batch(self, queries, fetch=None, parallelism=None):
+        '''
+        Runs a list of search payloads concurrently and returns one result per
+        query in request order. Identical queries are fetched once.
+        '''
+        is_payload_valid, validation_msg = self.validate_batch_payload(queries)
+        if not is_payload_valid:
+            return is_payload_valid, validation_msg, None
+
+        fetch = fetch or self.fetch
+        unique_queries = {json.dumps(query, sort_keys=True): query for query in queries}
+        semaphore = asyncio.Semaphore(parallelism or self.BATCH_PARALLELISM)
+
+        async def fetch_query(query):
+            is_payload_valid, validation_msg = self.validate_payload(query)
+            if not is_payload_valid:
+                return is_payload_valid, validation_msg, None
+            async with semaphore:
+                try:
+                    return await fetch(validated=True, **query)
+                except Exception as e:
+                    logger.error(f'Error scraping batch query: {str(e)}')
+                    return True, 'Error retrieving data.', None
+
+        results = dict(zip(unique_queries, await asyncio.gather(*[fetch_query(query) for query in unique_queries.values()])))
+        return True, '', [self.batch_result(results[json.dumps(query, sort_keys=True)]) for query in queries]
+
+
+_scrapers = {}
+_scrapers_lock = threading.Lock()
+
+
+def get_scraper(region=None):
+    '''
+    Returns the per-process Scraper, optionally bound to region, creating it on first use.
+    '''
+    return _get_scraper(Scraper, region)
+
+
+def get_async_scraper(region=None):
+    '''
+    Returns the per-process AsyncScraper, optionally bound to region, creating it on first use.
+    '''
+    return _get_scraper(AsyncScraper, region)
+
+
+def _get_scraper(cls, region):
+    scraper = _scrapers.get((cls, region))
+    if scraper is None:
+        with _scrapers_lock:
+            scraper = _scrapers.get((cls, region))
+            if scraper is None:
+                scraper = _scrapers[(cls, region)] = cls(region)
+    return scraper
 
 
 if __name__ == '__main__':
@@ -102,4 +644,4 @@ if __name__ == '__main__':
         "region": "AT"
     }
 
-    print(Scraper().fetch(**sample_data))
+    print(get_scraper().fetch(**sample_data))
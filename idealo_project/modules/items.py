@@ -0,0 +1,71 @@
+import json
+from dataclasses import dataclass
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+@dataclass
+class Item:
+    '''
+    One search result. Slotted records are smaller than the upstream dicts
+    and serialize natively with orjson, to the same JSON object as before.
+    images keeps the upstream {"images350x350": [...]} object.
+    '''
+    __slots__ = ('itemId', 'name', 'images', 'url')
+
+    itemId: str
+    name: str
+    images: dict
+    url: str
+
+    @classmethod
+    def from_dict(cls, item):
+        return cls(item.get('itemId'), item.get('name'), item.get('images'), item.get('url'))
+
+    def as_dict(self):
+        return {'itemId': self.itemId, 'name': self.name, 'images': self.images, 'url': self.url}
+
+
+def parse_items(items):
+    return [Item.from_dict(item) for item in items]
+
+
+def _default(value):
+    if isinstance(value, Item):
+        return value.as_dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def loads(content):
+    '''
+    Decodes a JSON body, with orjson if it is installed.
+    '''
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def dumps(value):
+    '''
+    Encodes value (which may contain Items) as compact JSON bytes.
+    '''
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+def packb(value):
+    '''
+    Encodes value (which may contain Items) as MessagePack, if msgpack is installed.
+    '''
+    if msgpack is None:
+        raise ImportError('MessagePack output requires msgpack (pip install msgpack)')
+    return msgpack.packb(value, default=_default)
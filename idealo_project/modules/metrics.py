@@ -0,0 +1,234 @@
+import time
+import threading
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''
+    A metric family with optional labels. labels(*values) returns the child
+    for one label combination; unlabeled metrics are used directly.
+    '''
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.child())
+        return child
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{labels} {format_value(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Value:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    @contextmanager
+    def track(self):
+        '''
+        Counts the block as in flight while it runs.
+        '''
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def child(self):
+        return Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield self.name, format_labels(self.labelnames, values), child.value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def track(self):
+        return self.labels().track()
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.sum += seconds
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[index] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, seconds):
+        self.labels().observe(seconds)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            with child.lock:
+                counts, count, total = list(child.counts), child.count, child.sum
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', format_labels(self.labelnames, values, [('le', format_value(bound))]), cumulative
+            yield self.name + '_sum', format_labels(self.labelnames, values), total
+            yield self.name + '_count', format_labels(self.labelnames, values), count
+
+
+class Registry:
+    '''
+    The metrics of this process, rendered in the Prometheus text format.
+    Collectors are callables returning extra metrics computed at scrape time.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, collect):
+        self.collectors.append(collect)
+        return collect
+
+    def render(self):
+        metrics = self.metrics + [metric for collect in self.collectors for metric in collect()]
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'idealo_http_request_seconds', 'Time from request to response in Django, by route.', ('method', 'route', 'status'))
+HTTP_REQUESTS_IN_FLIGHT = registry.gauge(
+    'idealo_http_requests_in_flight', 'Requests currently being handled.')
+UPSTREAM_SECONDS = registry.histogram(
+    'idealo_upstream_request_seconds', 'Idealo round trip of one attempt (retries and hedges count separately), by region.', ('region',))
+UPSTREAM_IN_FLIGHT = registry.gauge(
+    'idealo_upstream_requests_in_flight', 'Idealo requests currently waiting for a response, by region.', ('region',))
+UPSTREAM_QUEUE_SECONDS = registry.histogram(
+    'idealo_upstream_queue_seconds', 'Time an upstream call waited for a scheduler slot, by subscription type.', ('subscription',))
+UPSTREAM_REJECTED = registry.counter(
+    'idealo_upstream_rejected_total', 'Upstream calls refused by the scheduler (queue full or timed out), by subscription type.', ('subscription',))
+PAYLOAD_BUILD_SECONDS = registry.histogram(
+    'idealo_payload_build_seconds', 'Time to build a search request body.')
+JSON_DECODE_SECONDS = registry.histogram(
+    'idealo_json_decode_seconds', 'Time to decode an Idealo response body.')
+AUTH_SECONDS = registry.histogram(
+    'idealo_auth_seconds', 'Time to resolve an X-API-Key (cache or database).')
+QUOTA_SECONDS = registry.histogram(
+    'idealo_quota_seconds', 'Time to reserve requests from an API key quota.')
+CACHE_REQUESTS = registry.counter(
+    'idealo_cache_requests_total', 'Search cache lookups, by cache status.', ('status',))
+
+
+@registry.collector
+def cache_hit_ratio():
+    '''
+    Share of search cache lookups served from the cache (fresh or stale).
+    '''
+    counts = {values[0]: child.value for values, child in list(CACHE_REQUESTS.children.items())}
+    total = sum(counts.values())
+    ratio = Gauge('idealo_cache_hit_ratio', 'Share of search cache lookups answered from the cache since start.')
+    ratio.set((total - counts.get('MISS', 0)) / total if total else 0.0)
+    return [ratio]
@@ -0,0 +1,133 @@
+import os
+import hashlib
+import threading
+from modules.items import dumps
+
+
+SEARCH_QUERY = "query Search($siteID: Long!, $query: String!, $offset: Int!, $limit: Int!, $sort: SortType!, $reverse: Boolean!, $filters: SearchFiltersInput, $includeCategoryHits: Boolean!, $includeManufacturerHits: Boolean!, $includeSearchFilterGroups: Boolean!, $includeItemStateHits: Boolean!) {\n  search(\n    siteId: $siteID\n    query: $query\n    offset: $offset\n    limit: $limit\n    sort: $sort\n    reverse: $reverse\n    filters: $filters\n  ) {\n       count\n       categoryHits @include(if: $includeCategoryHits) {\n            categoryId\n      categoryName\n      categoryType\n      amount\n    }\n   \n    manufacturerHits @include(if: $includeManufacturerHits) {\n            manufacturerId\n      searchFilterId\n      manufacturerName\n      searchFilterId\n      amount\n    }\n    searchFilterGroups @include(if: $includeSearchFilterGroups) {\n            name\n      attributeId\n      combinationStrategy\n      orderPos\n      filters {\n                amount\n        orderPos\n        filterId\n        content\n        categoryId\n        ownClicks\n        productClicks\n      }\n    }\n    itemStateHits @include(if: $includeItemStateHits) {\n            itemState\n      amount\n    }\n        items {\n            ...searchItemFields\n    }\n    queryUsed {\n            query\n      filters {\n                minPrice\n        maxPrice\n        availableOnly\n        bargainsOnly\n        excludeUsed\n        includeCategories\n        includeSearchFilters\n        includeManufacturers\n        promotedShops\n        disableModifiers\n      }\n    }\n  }\n}\nfragment searchItemFields on Item {\n    ...itemFields\n    url\n  \n  \n        \n}\nfragment itemFields on Item {\n    itemId\n    name\n   images {\n            images350x350\n  }\n \n} "
+
+# SEARCH_QUERY without the categoryHits/manufacturerHits/searchFilterGroups
+# selections (and their $include* variables), which are never requested.
+TRIMMED_SEARCH_QUERY = (
+    "query Search($siteID: Long!, $query: String!, $offset: Int!, $limit: Int!, $sort: SortType!, $reverse: Boolean!, $filters: SearchFiltersInput, $includeItemStateHits: Boolean!) {"
+    " search(siteId: $siteID, query: $query, offset: $offset, limit: $limit, sort: $sort, reverse: $reverse, filters: $filters) {"
+    " count"
+    " itemStateHits @include(if: $includeItemStateHits) { itemState amount }"
+    " items { ...searchItemFields }"
+    " queryUsed { query filters { minPrice maxPrice availableOnly bargainsOnly excludeUsed includeCategories includeSearchFilters includeManufacturers promotedShops disableModifiers } }"
+    " } }"
+    " fragment searchItemFields on Item { ...itemFields url }"
+    " fragment itemFields on Item { itemId name images { images350x350 } }"
+)
+
+# Selections of the item fields clients can project onto with `fields`.
+ITEM_FIELDS = {
+    'itemId': 'itemId',
+    'name': 'name',
+    'images': 'images { images350x350 }',
+    'url': 'url'
+}
+
+TRIMMED_VARIABLES = ('includeCategoryHits', 'includeManufacturerHits', 'includeSearchFilterGroups')
+
+MODES = ('full', 'trimmed', 'persisted')
+
+PERSISTED_QUERY_NOT_FOUND = b'PersistedQueryNotFound'
+
+
+def projected_query(fields):
+    '''
+    Trimmed search query selecting only the given item fields. itemId is
+    always selected since deep fetches de-duplicate on it.
+    '''
+    selection = ' '.join(ITEM_FIELDS[field] for field in ITEM_FIELDS if field == 'itemId' or field in fields)
+    return (
+        "query Search($siteID: Long!, $query: String!, $offset: Int!, $limit: Int!, $sort: SortType!, $reverse: Boolean!, $filters: SearchFiltersInput, $includeItemStateHits: Boolean!) {"
+        " search(siteId: $siteID, query: $query, offset: $offset, limit: $limit, sort: $sort, reverse: $reverse, filters: $filters) {"
+        " count"
+        " itemStateHits @include(if: $includeItemStateHits) { itemState amount }"
+        f" items {{ {selection} }}"
+        " } }"
+    )
+
+
+class PayloadCompiler:
+    '''
+    Builds Search request bodies from pre-encoded parts: the static query text
+    is JSON-encoded once, per request only the variables are serialized and
+    spliced in. Modes:
+    - full: the original query, compactly encoded (the same query and
+      variables as before, without the spaces after separators)
+    - trimmed: TRIMMED_SEARCH_QUERY, a smaller query and variable block
+    - persisted: only the sha256 of the trimmed query is sent (Apollo
+      persisted-query protocol); compile(persisted=False) gives the fallback,
+      which sends the query together with its hash so the backend registers it
+    compile(fields=...) swaps in projected_query(fields) in every mode.
+    '''
+
+    def __init__(self, mode='full'):
+        if mode not in MODES:
+            raise ValueError(f"Invalid payload mode '{mode}'. Valid modes are {', '.join(MODES)}.")
+        self.mode = mode
+        self.trimmed = mode != 'full'
+        self.persisted = mode == 'persisted'
+        self.lock = threading.Lock()
+        self.parts = {None: self.encode(TRIMMED_SEARCH_QUERY if self.trimmed else SEARCH_QUERY)}
+
+    def encode(self, query):
+        query_prefix = b'{"operationName":"Search","query":' + dumps(query) + b',"variables":'
+        persisted_suffix = b',"extensions":{"persistedQuery":{"version":1,"sha256Hash":"' + \
+            hashlib.sha256(query.encode('utf-8')).hexdigest().encode('ascii') + b'"}}}'
+        return query_prefix, persisted_suffix
+
+    def projection(self, fields):
+        '''
+        Encoded parts of the projected query for a set of item fields, built
+        once per distinct set.
+        '''
+        key = frozenset(fields) if fields is not None else None
+        parts = self.parts.get(key)
+        if parts is None:
+            with self.lock:
+                parts = self.parts.setdefault(key, self.encode(projected_query(key)))
+        return parts
+
+    def compile(self, variables, persisted=None, fields=None):
+        if self.trimmed or fields is not None:
+            variables = {k: v for k, v in variables.items() if k not in TRIMMED_VARIABLES}
+        query_prefix, persisted_suffix = self.projection(fields)
+        if self.persisted if persisted is None else persisted:
+            return b'{"operationName":"Search","variables":' + dumps(variables) + persisted_suffix
+        if self.persisted:
+            return query_prefix + dumps(variables) + persisted_suffix
+        return query_prefix + dumps(variables) + b'}'
+
+    def is_unknown_query(self, response):
+        '''
+        True if the backend did not know the persisted query hash and the
+        request has to be repeated with the full query text.
+        '''
+        return PERSISTED_QUERY_NOT_FOUND in response.content
+
+
+_compiler = None
+_compiler_lock = threading.Lock()
+
+
+def get_compiler():
+    '''
+    Returns the per-process PayloadCompiler, creating it on first use.
+    '''
+    global _compiler
+    if _compiler is None:
+        with _compiler_lock:
+            if _compiler is None:
+                _compiler = PayloadCompiler(os.environ.get('IDEALO_PAYLOAD_MODE', 'full'))
+    return _compiler
+
+
+def configure(mode='full'):
+    global _compiler
+    with _compiler_lock:
+        _compiler = PayloadCompiler(mode)
+    return _compiler
@@ -0,0 +1,267 @@
+import time
+import logging
+import threading
+from contextlib import nullcontext
+from modules.cache import normalize, limit_bucket
+from modules.scheduler import client, current
+
+logger = logging.getLogger(__name__)
+
+TOP_N = 20
+INTERVAL = 30
+HALF_LIFE = 600
+MAX_TRACKED = 1000
+FLUSH_INTERVAL = 5
+BUDGET_PER_MINUTE = 120
+
+# number of trackers that ever flushed; tracker i writes its counts to POPULARITY_KEY.format(i)
+WORKERS_KEY = 'prewarm:popularity:workers'
+POPULARITY_KEY = 'prewarm:popularity:{}'
+
+
+def _cache(alias):
+    from django.core.cache import caches
+    return caches[alias]
+
+
+class PopularityTracker:
+    '''
+    Exponentially decayed hit counts per normalized search. Hits are counted
+    locally and every flush_interval seconds the process's counts are written
+    to its own entry of a Django cache; top() merges the entries of all
+    workers, so a scheduler in another process sees the traffic of all
+    workers when the cache is shared (redis/memcached). Each entry has a
+    single writer, so concurrent flushes never overwrite each other's counts.
+    With cache_alias None the counts stay in this process. Each search
+    also keeps the scheduler client (API key) that last made it.
+    '''
+
+    def __init__(self, cache_alias=None, half_life=HALF_LIFE, max_tracked=MAX_TRACKED, flush_interval=FLUSH_INTERVAL):
+        self.cache = _cache(cache_alias) if cache_alias else None
+        self.half_life = half_life
+        self.max_tracked = max_tracked
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.scores = {}
+        self.slot = None
+        self.flushed_at = time.time()
+
+    def record(self, key, params, client=None):
+        with self.lock:
+            hits = self.pending.get(key, (0,))[0]
+            self.pending[key] = (hits + 1, params, client)
+            is_due = time.time() - self.flushed_at >= self.flush_interval
+        if is_due:
+            self.flush()
+
+    def decay(self, scores, now, merged=None):
+        '''
+        Adds scores ({key: (score, updated_at, params, client)}) decayed to
+        now to merged.
+        '''
+        merged = {} if merged is None else merged
+        for key, (score, updated_at, params, client) in scores.items():
+            total = merged.get(key, (0,))[0]
+            merged[key] = (total + score * 0.5 ** ((now - updated_at) / self.half_life), now, params, client)
+        return merged
+
+    def merge(self, scores, pending, now):
+        '''
+        Decays scores to now and adds the pending hits, keeping the
+        max_tracked most popular searches.
+        '''
+        merged = self.decay(scores, now)
+        for key, (hits, params, client) in pending.items():
+            score = merged.get(key, (0,))[0]
+            merged[key] = (score + hits, now, params, client)
+        if len(merged) > self.max_tracked:
+            merged = dict(sorted(merged.items(), key=lambda entry: entry[1][0], reverse=True)[:self.max_tracked])
+        return merged
+
+    def claim_slot(self):
+        '''
+        Number of this tracker's cache entry, taken from an atomic counter.
+        '''
+        if self.slot is None:
+            self.cache.add(WORKERS_KEY, 0, None)
+            self.slot = self.cache.incr(WORKERS_KEY)
+        return self.slot
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = now = time.time()
+            self.scores = scores = self.merge(self.scores, pending, now)
+        if self.cache is None:
+            return
+        try:
+            # entries of stopped workers expire once their counts have decayed
+            self.cache.set(POPULARITY_KEY.format(self.claim_slot()), scores, 10 * self.half_life)
+        except Exception as e:
+            logger.error(f'Error flushing search popularity: {str(e)}')
+
+    def shared_scores(self, now):
+        '''
+        The counts of all workers, merged from their cache entries.
+        '''
+        workers = self.cache.get(WORKERS_KEY, 0)
+        merged = {}
+        for scores in self.cache.get_many([POPULARITY_KEY.format(slot) for slot in range(1, workers + 1)]).values():
+            self.decay(scores, now, merged)
+        return merged
+
+    def top(self, n):
+        '''
+        The n most popular searches as (fetch params, client), most popular first.
+        '''
+        self.flush()
+        scores = self.scores if self.cache is None else self.shared_scores(time.time())
+        ranked = sorted(scores.values(), key=lambda entry: entry[0], reverse=True)
+        return [(params, client) for _, _, params, client in ranked[:n]]
+
+
+class UpstreamBudget:
+    '''
+    Global per-minute cap on upstream searches, counted in a Django cache
+    (shared across workers with redis/memcached). Cache misses of user
+    requests are recorded unconditionally; pre-warming only spends what is
+    left of the budget.
+    '''
+
+    def __init__(self, per_minute=BUDGET_PER_MINUTE, cache_alias='default'):
+        self.per_minute = per_minute
+        self.cache = _cache(cache_alias)
+
+    def window_key(self):
+        return f'prewarm:budget:{int(time.time() // 60)}'
+
+    def add(self, requests):
+        key = self.window_key()
+        self.cache.add(key, 0, 120)
+        try:
+            return self.cache.incr(key, requests)
+        except ValueError:
+            self.cache.set(key, requests, 120)
+            return requests
+
+    def record(self, requests=1):
+        self.add(requests)
+
+    def spend(self, requests=1):
+        '''
+        Reserves requests from the current minute, or returns False if the
+        budget is used up.
+        '''
+        if self.add(requests) > self.per_minute:
+            self.add(-requests)
+            return False
+        return True
+
+
+class Prewarmer:
+    '''
+    Keeps hot searches in the SearchCache: every interval seconds the top_n
+    most popular searches (plus the configured seed queries) are refetched
+    if their cache entry is missing or would expire before the next run.
+    Refreshes stop for the round once the upstream budget is used up.
+    A popular search is refreshed for the API key that last made it, so it
+    queues with that key's requests in the scheduler; seed queries run in
+    the background flow.
+    '''
+
+    def __init__(self, search_cache, tracker=None, budget=None, top_n=TOP_N, interval=INTERVAL,
+                 queries=None, scraper_factory=None, in_process=False):
+        self.search_cache = search_cache
+        self.tracker = tracker or PopularityTracker()
+        self.budget = budget
+        self.top_n = top_n
+        self.interval = interval
+        self.queries = [self.normalize_params(query) for query in queries or []]
+        self.scraper_factory = scraper_factory
+        self.in_process = in_process
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def normalize_params(self, params):
+        return dict(params, limit=limit_bucket(params['limit']))
+
+    def track(self, key, params):
+        '''
+        Called by SearchCache for every valid search. Starts the in-process
+        worker on first use if configured.
+        '''
+        self.tracker.record(key, self.normalize_params(params), current())
+        if self.in_process:
+            self.start()
+
+    def scraper(self):
+        if self.scraper_factory is not None:
+            return self.scraper_factory()
+        from modules.idealo import get_scraper
+        return get_scraper()
+
+    def candidates(self):
+        candidates = {}
+        for params, search_client in [(query, None) for query in self.queries] + self.tracker.top(self.top_n):
+            candidates.setdefault(normalize(**params), (params, search_client))
+        return candidates
+
+    def needs_refresh(self, key, params):
+        cached = self.search_cache.backend.get(key)
+        if cached is None:
+            return True
+        return time.time() - cached[1] >= self.search_cache.ttl(params['region']) - self.interval
+
+    def run_once(self):
+        '''
+        One refresh round. Returns the number of searches refreshed.
+        '''
+        refreshed = 0
+        for key, (params, search_client) in self.candidates().items():
+            if not self.needs_refresh(key, params):
+                continue
+            if self.budget is not None and not self.budget.spend():
+                logger.error('Upstream budget used up, skipping remaining pre-warm refreshes')
+                break
+            try:
+                with client(*search_client) if search_client else nullcontext():
+                    self.search_cache.refresh(self.scraper(), **params)
+                refreshed += 1
+            except Exception as e:
+                logger.error(f'Error pre-warming {key}: {str(e)}')
+        return refreshed
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f'Error pre-warming searches: {str(e)}')
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.worker is None:
+            with self.lock:
+                if self.worker is None:
+                    self.worker = threading.Thread(target=self.run, name='prewarm', daemon=True)
+                    self.worker.start()
+
+
+def build_prewarmer(config, search_cache):
+    '''
+    Builds a Prewarmer from a settings dict such as settings.IDEALO_PREWARM
+    and attaches it to search_cache so live traffic is tracked.
+    '''
+    cache_alias = config.get('CACHE_ALIAS', 'default')
+    prewarmer = Prewarmer(
+        search_cache,
+        tracker=PopularityTracker(cache_alias, config.get('HALF_LIFE', HALF_LIFE)),
+        budget=UpstreamBudget(config.get('BUDGET_PER_MINUTE', BUDGET_PER_MINUTE), cache_alias),
+        top_n=config.get('TOP_N', TOP_N),
+        interval=config.get('INTERVAL', INTERVAL),
+        queries=config.get('QUERIES'),
+        in_process=config.get('IN_PROCESS', False))
+    search_cache.prewarmer = prewarmer
+    search_cache.budget = prewarmer.budget
+    return prewarmer
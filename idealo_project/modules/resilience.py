@@ -0,0 +1,315 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import requests
+from modules.metrics import UPSTREAM_SECONDS, UPSTREAM_IN_FLIGHT
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+RETRIES = int(os.environ.get('IDEALO_RETRIES', 2))
+BACKOFF_BASE = float(os.environ.get('IDEALO_RETRY_BACKOFF', 0.1))
+BACKOFF_MAX = float(os.environ.get('IDEALO_RETRY_BACKOFF_MAX', 2))
+FAILURE_THRESHOLD = int(os.environ.get('IDEALO_BREAKER_THRESHOLD', 5))
+RESET_TIMEOUT = float(os.environ.get('IDEALO_BREAKER_RESET', 30))
+HEDGE_AFTER = os.environ.get('IDEALO_HEDGE_AFTER') or None
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WORKERS = 64
+LATENCY_WINDOW = 200
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+TRANSPORT_ERRORS = (requests.RequestException,) + ((httpx.HTTPError,) if httpx is not None else ())
+
+
+class UpstreamError(Exception):
+    '''
+    Idealo could not be reached or kept failing after all retries.
+    '''
+
+
+class CircuitOpenError(UpstreamError):
+    '''
+    Raised without calling Idealo while the region's circuit breaker is open.
+    '''
+
+
+class CircuitBreaker:
+    '''
+    Opens after failure_threshold consecutive failed calls (calls whose
+    retries were all exhausted), so calls fail fast for reset_timeout
+    seconds. Afterwards a single probe call is let through: on success the
+    breaker closes, on failure it opens again.
+    '''
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        '''
+        Returns (is_allowed, is_probe).
+        '''
+        with self.lock:
+            if self.opened_at is None:
+                return True, False
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False, False
+            self.probing = True
+            return True, True
+
+    def abandon(self):
+        '''
+        Ends a probe that gave no verdict (cancelled or an unexpected error),
+        so the next call may probe again.
+        '''
+        with self.lock:
+            self.probing = False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class LatencyTracker:
+    '''
+    Sliding window of successful upstream latencies, used to derive the
+    hedging threshold. The percentile is recomputed every few samples.
+    '''
+
+    def __init__(self, window=LATENCY_WINDOW, min_samples=HEDGE_MIN_SAMPLES):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.recorded = 0
+        self.p95 = None
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.recorded += 1
+        if len(self.samples) >= self.min_samples and (self.p95 is None or self.recorded % 10 == 0):
+            samples = sorted(self.samples)
+            self.p95 = samples[int(len(samples) * 0.95) - 1]
+
+
+class Resilience:
+    '''
+    Wraps each upstream call with jittered exponential retries, a circuit
+    breaker per region and optionally a hedged second request. hedge_after
+    is None (off), a delay in seconds or 'p95' for the region's observed
+    95th percentile latency. Searches are idempotent, so retrying and
+    hedging them is safe. Hedged sync calls run their attempts on a pool of
+    hedge_workers threads, which should fit two attempts for every upstream
+    call the scheduler lets through.
+    '''
+
+    def __init__(self, retries=RETRIES, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, hedge_after=HEDGE_AFTER,
+                 hedge_workers=HEDGE_WORKERS):
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_after = hedge_after if hedge_after in (None, 'p95') else float(hedge_after)
+        self.hedge_workers = hedge_workers
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.latencies = {}
+        self.executor = None
+
+    def breaker(self, region):
+        breaker = self.breakers.get(region)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(
+                    region, CircuitBreaker(self.failure_threshold, self.reset_timeout))
+        return breaker
+
+    def latency(self, region):
+        tracker = self.latencies.get(region)
+        if tracker is None:
+            with self.lock:
+                tracker = self.latencies.setdefault(region, LatencyTracker())
+        return tracker
+
+    def backoff(self, attempt):
+        '''
+        Full jitter: a random delay up to base * 2^attempt, capped at backoff_max.
+        '''
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def hedge_delay(self, region):
+        if self.hedge_after == 'p95':
+            return self.latency(region).p95
+        return self.hedge_after
+
+    def is_retryable(self, response):
+        return response.status_code in RETRY_STATUSES
+
+    def on_failure(self, region, breaker, error):
+        breaker.failure()
+        if breaker.is_open:
+            logger.error(f'Circuit breaker open for region {region}: {type(error).__name__} {str(error)}')
+
+    def timed(self, region, send):
+        start_time = time.monotonic()
+        try:
+            with UPSTREAM_IN_FLIGHT.labels(region).track():
+                response = send()
+        finally:
+            UPSTREAM_SECONDS.labels(region).observe(time.monotonic() - start_time)
+        if not self.is_retryable(response):
+            self.latency(region).record(time.monotonic() - start_time)
+        return response
+
+    def attempt(self, region, send):
+        delay = self.hedge_delay(region)
+        if delay is None:
+            return self.timed(region, send)
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix='idealo-hedge')
+        pending = {self.executor.submit(self.timed, region, send)}
+        done, pending = wait(pending, timeout=delay)
+        if not done:
+            pending.add(self.executor.submit(self.timed, region, send))
+        # first usable response wins; a slow loser finishes in the background
+        while True:
+            if not done:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            future = done.pop()
+            if not pending or (future.exception() is None and not self.is_retryable(future.result())):
+                return future.result()
+
+    def call(self, region, send):
+        '''
+        Calls send() (which posts one request and returns the response) until
+        it gets a non-retryable response. Raises UpstreamError once retries
+        are exhausted and CircuitOpenError while the breaker is open.
+        '''
+        breaker = self.breaker(region)
+        is_allowed, is_probe = breaker.allow()
+        if not is_allowed:
+            raise CircuitOpenError(f'Idealo {region} is unavailable, try again later.')
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = self.attempt(region, send)
+                except TRANSPORT_ERRORS as e:
+                    error = e
+                else:
+                    if not self.is_retryable(response):
+                        breaker.success()
+                        return response
+                    error = UpstreamError(f'Idealo responded with status {response.status_code}.')
+                if attempt < self.retries:
+                    time.sleep(self.backoff(attempt))
+            self.on_failure(region, breaker, error)
+            raise UpstreamError(f'Idealo {region} did not respond successfully after {self.retries + 1} attempts.') from error
+        finally:
+            if is_probe:
+                breaker.abandon()
+
+    async def atimed(self, region, send):
+        start_time = time.monotonic()
+        try:
+            with UPSTREAM_IN_FLIGHT.labels(region).track():
+                response = await send()
+        finally:
+            UPSTREAM_SECONDS.labels(region).observe(time.monotonic() - start_time)
+        if not self.is_retryable(response):
+            self.latency(region).record(time.monotonic() - start_time)
+        return response
+
+    async def aattempt(self, region, send):
+        delay = self.hedge_delay(region)
+        if delay is None:
+            return await self.atimed(region, send)
+        pending = {asyncio.ensure_future(self.atimed(region, send))}
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            pending.add(asyncio.ensure_future(self.atimed(region, send)))
+        try:
+            while True:
+                if not done:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                task = done.pop()
+                if not pending or (task.exception() is None and not self.is_retryable(task.result())):
+                    return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def acall(self, region, send):
+        breaker = self.breaker(region)
+        is_allowed, is_probe = breaker.allow()
+        if not is_allowed:
+            raise CircuitOpenError(f'Idealo {region} is unavailable, try again later.')
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = await self.aattempt(region, send)
+                except TRANSPORT_ERRORS as e:
+                    error = e
+                else:
+                    if not self.is_retryable(response):
+                        breaker.success()
+                        return response
+                    error = UpstreamError(f'Idealo responded with status {response.status_code}.')
+                if attempt < self.retries:
+                    await asyncio.sleep(self.backoff(attempt))
+            self.on_failure(region, breaker, error)
+            raise UpstreamError(f'Idealo {region} did not respond successfully after {self.retries + 1} attempts.') from error
+        finally:
+            # success() and failure() already end a probe; this covers cancellation
+            if is_probe:
+                breaker.abandon()
+
+
+_resilience = None
+_resilience_lock = threading.Lock()
+
+
+def get_resilience():
+    '''
+    Returns the per-process Resilience, creating it on first use.
+    '''
+    global _resilience
+    if _resilience is None:
+        with _resilience_lock:
+            if _resilience is None:
+                _resilience = Resilience()
+    return _resilience
+
+
+def configure(**kwargs):
+    global _resilience
+    with _resilience_lock:
+        _resilience = Resilience(**kwargs)
+    return _resilience
@@ -0,0 +1,294 @@
+import time
+import asyncio
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from modules.resilience import UpstreamError
+from modules.metrics import UPSTREAM_QUEUE_SECONDS, UPSTREAM_REJECTED
+
+MAX_CONCURRENCY = 32
+PER_KEY_CONCURRENCY = 4
+PER_KEY_QUEUE = 16
+QUEUE_TIMEOUT = 5
+WEIGHTS = {
+    'free': 1,
+    'basic': 2,
+    'premium': 4
+}
+
+# (key, subscription_type) of the request the current upstream calls are made for
+_client = ContextVar('idealo_upstream_client', default=None)
+
+
+class OverloadedError(UpstreamError):
+    '''
+    Raised without calling Idealo when an upstream call gets no slot: the
+    key's queue is full or the call waited longer than the queue timeout.
+    '''
+
+
+class Flow:
+    '''
+    The upstream calls of one API key, or of all calls made outside a request.
+    '''
+    __slots__ = ('key', 'subscription', 'weight', 'limit', 'queue_size', 'active', 'waiting', 'finish')
+
+    def __init__(self, key, subscription, weight, limit, queue_size):
+        self.key = key
+        self.subscription = subscription
+        self.weight = weight
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = deque()
+        self.finish = 0.0
+
+
+class Waiter:
+    __slots__ = ('flow', 'tag', 'wake', 'granted')
+
+    def __init__(self, flow, tag, wake):
+        self.flow = flow
+        self.tag = tag
+        self.wake = wake
+        self.granted = False
+
+
+class Scheduler:
+    '''
+    Admits upstream calls: at most max_concurrency in flight per process and
+    per_key_concurrency per API key. Calls beyond that wait for up to
+    queue_timeout seconds (at most per_key_queue per key), then fail with
+    OverloadedError. Free slots are handed out by start-time fair queuing,
+    so each waiting key gets a share of the slots in proportion to the
+    weight of its subscription type and a burst of one key only delays that
+    key's own calls. Calls made outside a request (pre-warming, cache
+    revalidation, exports) share one flow of weight 1 without a per-key
+    limit. max_concurrency 0 turns scheduling off.
+    '''
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, per_key_concurrency=PER_KEY_CONCURRENCY,
+                 per_key_queue=PER_KEY_QUEUE, queue_timeout=QUEUE_TIMEOUT, weights=None):
+        self.max_concurrency = max_concurrency
+        self.per_key_concurrency = per_key_concurrency
+        self.per_key_queue = per_key_queue
+        self.queue_timeout = queue_timeout
+        self.weights = dict(WEIGHTS if weights is None else weights)
+        self.lock = threading.Lock()
+        self.flows = {}
+        self.in_flight = 0
+        self.virtual_time = 0.0
+
+    def flow(self, client):
+        key, subscription = client if client is not None else (None, None)
+        flow = self.flows.get(key)
+        if flow is None:
+            if key is None:
+                flow = Flow(None, 'none', 1, float('inf'), float('inf'))
+            else:
+                flow = Flow(key, subscription, self.weights.get(subscription, 1), self.per_key_concurrency, self.per_key_queue)
+            self.flows[key] = flow
+        return flow
+
+    def grant(self, waiter):
+        waiter.granted = True
+        waiter.flow.active += 1
+        self.in_flight += 1
+        self.virtual_time = max(self.virtual_time, waiter.tag)
+
+    def forget_idle(self, flow):
+        if not flow.active and not flow.waiting:
+            self.flows.pop(flow.key, None)
+
+    def admit(self, client, wake):
+        '''
+        Grants a slot right away or queues the call. Returns the Waiter, or
+        None if the key's queue is full.
+        '''
+        with self.lock:
+            flow = self.flow(client)
+            is_free = self.in_flight < self.max_concurrency and flow.active < flow.limit and not flow.waiting
+            if not is_free and len(flow.waiting) >= flow.queue_size:
+                self.forget_idle(flow)
+                return None
+            # a key's calls are spaced 1/weight apart in virtual time, so
+            # heavier subscriptions are due more often
+            waiter = Waiter(flow, max(self.virtual_time, flow.finish), wake)
+            flow.finish = waiter.tag + 1 / flow.weight
+            if is_free:
+                self.grant(waiter)
+            else:
+                flow.waiting.append(waiter)
+            return waiter
+
+    def dispatch(self):
+        '''
+        Hands free slots to the waiting calls with the lowest start tags whose
+        key is below its limit. Returns the wake callbacks to run.
+        '''
+        woken = []
+        while self.in_flight < self.max_concurrency:
+            best = None
+            for flow in self.flows.values():
+                if flow.waiting and flow.active < flow.limit and (best is None or flow.waiting[0].tag < best.waiting[0].tag):
+                    best = flow
+            if best is None:
+                break
+            waiter = best.waiting.popleft()
+            self.grant(waiter)
+            woken.append(waiter.wake)
+        return woken
+
+    def release(self, waiter):
+        with self.lock:
+            waiter.flow.active -= 1
+            self.in_flight -= 1
+            woken = self.dispatch()
+            self.forget_idle(waiter.flow)
+        for wake in woken:
+            wake()
+
+    def withdraw(self, waiter):
+        '''
+        Takes a waiting call out of the queue. Returns True if it was granted
+        a slot in the meantime, which the caller then holds.
+        '''
+        with self.lock:
+            if waiter.granted:
+                return True
+            waiter.flow.waiting.remove(waiter)
+            self.forget_idle(waiter.flow)
+            return False
+
+    def rejected(self, subscription, message):
+        UPSTREAM_REJECTED.labels(subscription).inc()
+        return OverloadedError(message)
+
+    def queue_full(self, client):
+        return self.rejected(client[1] if client is not None else 'none',
+                             'Too many upstream requests in flight for this API key, try again later.')
+
+    def timed_out(self, waiter):
+        return self.rejected(waiter.flow.subscription, 'Timed out waiting for an upstream slot, try again later.')
+
+    @contextmanager
+    def slot(self):
+        '''
+        Holds one upstream slot for the current client while the block runs.
+        '''
+        if not self.max_concurrency:
+            yield
+            return
+        start_time = time.monotonic()
+        event = threading.Event()
+        client = _client.get()
+        waiter = self.admit(client, event.set)
+        if waiter is None:
+            raise self.queue_full(client)
+        if not waiter.granted and not event.wait(self.queue_timeout) and not self.withdraw(waiter):
+            raise self.timed_out(waiter)
+        UPSTREAM_QUEUE_SECONDS.labels(waiter.flow.subscription).observe(time.monotonic() - start_time)
+        try:
+            yield
+        finally:
+            self.release(waiter)
+
+    @asynccontextmanager
+    async def aslot(self):
+        if not self.max_concurrency:
+            yield
+            return
+        start_time = time.monotonic()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        client = _client.get()
+        waiter = self.admit(client, lambda: loop.call_soon_threadsafe(
+            lambda: granted.done() or granted.set_result(None)))
+        if waiter is None:
+            raise self.queue_full(client)
+        if not waiter.granted:
+            try:
+                await asyncio.wait_for(granted, self.queue_timeout)
+            except asyncio.TimeoutError:
+                if not self.withdraw(waiter):
+                    raise self.timed_out(waiter)
+            except BaseException:
+                if self.withdraw(waiter):
+                    self.release(waiter)
+                raise
+        UPSTREAM_QUEUE_SECONDS.labels(waiter.flow.subscription).observe(time.monotonic() - start_time)
+        try:
+            yield
+        finally:
+            self.release(waiter)
+
+
+@contextmanager
+def client(key, subscription_type):
+    '''
+    Attributes the upstream calls made in the block (and in asyncio tasks
+    started from it) to the API key key.
+    '''
+    token = _client.set((key, subscription_type))
+    try:
+        yield
+    finally:
+        _client.reset(token)
+
+
+def current():
+    '''
+    (key, subscription_type) the current upstream calls are attributed to,
+    or None outside a request.
+    '''
+    return _client.get()
+
+
+def bind(fn):
+    '''
+    fn bound to the current client, for work that runs on another thread or
+    after the request's block has exited (e.g. streamed pages).
+    '''
+    bound_client = _client.get()
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def bound(*args, **kwargs):
+            token = _client.set(bound_client)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _client.reset(token)
+    else:
+        @functools.wraps(fn)
+        def bound(*args, **kwargs):
+            token = _client.set(bound_client)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _client.reset(token)
+    return bound
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    '''
+    Returns the per-process Scheduler, creating it on first use.
+    '''
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler()
+    return _scheduler
+
+
+def configure(**kwargs):
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = Scheduler(**kwargs)
+    return _scheduler
@@ -0,0 +1,80 @@
+'''
+Declarative request schemas. A Schema is compiled once into one check per
+key, so validating a decoded body is a single pass over its keys that
+collects every error instead of stopping at the first one.
+'''
+
+
+class Field:
+    '''
+    One key of a request. kind is int, str or list; between is an inclusive
+    (min, max) for ints, choices the allowed values of a str, items the Field
+    every list element must match and check an extra predicate on the value.
+    bools are never accepted as ints.
+    '''
+
+    def __init__(self, kind, message=None, required=True, between=None, choices=None, items=None, non_empty=False, check=None):
+        self.kind = kind
+        self.message = message
+        self.required = required
+        self.between = between
+        self.choices = frozenset(choices) if choices is not None else None
+        self.items = items
+        self.non_empty = non_empty
+        self.check = check
+
+    def compile(self):
+        '''
+        Returns a predicate telling whether a value matches the field.
+        '''
+        kind, choices, check = self.kind, self.choices, self.check
+        if kind is int and self.between is not None:
+            low, high = self.between
+            predicate = lambda value: type(value) is int and low <= value <= high
+        elif kind is list:
+            is_item = self.items.compile() if self.items is not None else None
+            non_empty = self.non_empty
+            predicate = lambda value: (type(value) is list and (len(value) > 0 or not non_empty)
+                                       and (is_item is None or all(map(is_item, value))))
+        elif choices is not None:
+            predicate = lambda value: type(value) is kind and value in choices
+        else:
+            predicate = lambda value: type(value) is kind
+        if check is None:
+            return predicate
+        return lambda value: predicate(value) and check(value)
+
+
+class Schema:
+    '''
+    The keys a JSON object may have. validate returns the list of all
+    errors (empty if valid); unknown keys are an error. Optional keys may be
+    missing or null.
+    '''
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.checks = tuple((name, field.required, field.compile(), field.message) for name, field in fields.items())
+        self.unknown_message = f"Unknown parameters {{}}. Valid parameters are {', '.join(fields)}."
+
+    def extend(self, **fields):
+        '''
+        A copy with fields added or replaced; a field set to None is removed.
+        '''
+        merged = dict(self.fields, **fields)
+        return Schema({name: field for name, field in merged.items() if field is not None})
+
+    def validate(self, data):
+        if type(data) is not dict:
+            return ['Request must be JSON object']
+        errors = []
+        if not data.keys() <= self.fields.keys():
+            errors.append(self.unknown_message.format(', '.join(key for key in data if key not in self.fields)))
+        for name, required, predicate, message in self.checks:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    errors.append(message)
+            elif not predicate(value):
+                errors.append(message)
+        return errors
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function, callers arriving while it is in flight wait for and share its
+    result (or exception). do() serves threads, ado() serves asyncio tasks.
+    Exceptions of a type in unshared concern only the caller that ran the
+    function (e.g. its own upstream slot was refused): waiting callers get
+    to call again instead, usually as the new leader.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.async_calls = {}
+
+    def do(self, key, fn, unshared=()):
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                is_leader = call is None
+                if is_leader:
+                    call = self.calls[key] = _Call()
+            if is_leader:
+                break
+            call.event.wait()
+            if call.error is None:
+                return call.result
+            if not isinstance(call.error, unshared):
+                raise call.error
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    async def ado(self, key, coro_fn, unshared=()):
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        while True:
+            task = self.async_calls.get(flight_key)
+            is_leader = task is None
+            if is_leader:
+                task = loop.create_task(coro_fn())
+                self.async_calls[flight_key] = task
+                task.add_done_callback(lambda _: self.async_calls.pop(flight_key, None))
+            try:
+                # shield: a cancelled waiter must not cancel the shared upstream call
+                return await asyncio.shield(task)
+            except unshared:
+                if is_leader:
+                    raise
+
+    def in_flight(self):
+        return len(self.calls) + len(self.async_calls)
@@ -0,0 +1,189 @@
+import os
+import asyncio
+import threading
+import weakref
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+API_URL = "https://app.idealo.de/app-backend/api"
+
+POOL_CONNECTIONS = int(os.environ.get('IDEALO_POOL_CONNECTIONS', 10))
+POOL_MAXSIZE = int(os.environ.get('IDEALO_POOL_MAXSIZE', 50))
+CONNECT_TIMEOUT = float(os.environ.get('IDEALO_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('IDEALO_READ_TIMEOUT', 10))
+HTTP2 = os.environ.get('IDEALO_HTTP2', '0') == '1'
+
+HEADERS = {
+    'Content-Type': 'application/json',
+    'Connection': 'keep-alive'
+}
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UpstreamResponse:
+    '''
+    Status and body of an Idealo response. too_large is set (and content
+    left empty) once the body exceeds max_bytes, found out from
+    Content-Length or while streaming, so it is never held in memory.
+    '''
+    __slots__ = ('status_code', 'content', 'too_large')
+
+    def __init__(self, status_code, content, too_large=False):
+        self.status_code = status_code
+        self.content = content
+        self.too_large = too_large
+
+
+def is_too_long(headers, max_bytes):
+    length = headers.get('Content-Length')
+    return max_bytes is not None and length is not None and length.isdigit() and int(length) > max_bytes
+
+
+def read_body(status_code, headers, chunks, max_bytes=None):
+    '''
+    Reads a streamed body, stopping at the first chunk past max_bytes.
+    '''
+    if is_too_long(headers, max_bytes):
+        return UpstreamResponse(status_code, b'', True)
+    body = bytearray()
+    for chunk in chunks:
+        body += chunk
+        if max_bytes is not None and len(body) > max_bytes:
+            return UpstreamResponse(status_code, b'', True)
+    return UpstreamResponse(status_code, bytes(body))
+
+
+async def aread_body(status_code, headers, chunks, max_bytes=None):
+    if is_too_long(headers, max_bytes):
+        return UpstreamResponse(status_code, b'', True)
+    body = bytearray()
+    async for chunk in chunks:
+        body += chunk
+        if max_bytes is not None and len(body) > max_bytes:
+            return UpstreamResponse(status_code, b'', True)
+    return UpstreamResponse(status_code, bytes(body))
+
+
+class Transport:
+    '''
+    Pooled keep-alive connection to the Idealo backend. One instance is shared
+    per process so the TCP+TLS handshake is paid once per pooled connection
+    instead of once per API hit.
+    '''
+
+    def __init__(self, url=API_URL, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, http2=HTTP2):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = http2 and httpx is not None
+        if self.http2:
+            self.client = httpx.Client(
+                http2=True,
+                headers=HEADERS,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize))
+        else:
+            self.client = requests.Session()
+            self.client.headers.update(HEADERS)
+            adapter = HTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize, pool_block=False)
+            self.client.mount('https://', adapter)
+            self.client.mount('http://', adapter)
+
+    def post(self, payload, max_bytes=None):
+        '''
+        Posts payload and reads the response body, at most max_bytes of it.
+        An oversized body is dropped and its connection closed.
+        '''
+        if self.http2:
+            response = self.client.send(self.client.build_request('POST', self.url, content=payload), stream=True)
+            chunks = response.iter_bytes(CHUNK_SIZE)
+        else:
+            response = self.client.post(self.url, data=payload, timeout=self.timeout, stream=True)
+            chunks = response.iter_content(CHUNK_SIZE)
+        try:
+            return read_body(response.status_code, response.headers, chunks, max_bytes)
+        finally:
+            response.close()
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncTransport:
+    '''
+    Non-blocking counterpart of Transport built on httpx.AsyncClient. Clients
+    are bound to an event loop, so get_async_transport keeps one per loop.
+    '''
+
+    def __init__(self, url=API_URL, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, http2=HTTP2):
+        if httpx is None:
+            raise ImportError('AsyncTransport requires httpx (pip install httpx)')
+        self.url = url
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            headers=HEADERS,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize))
+
+    async def post(self, payload, max_bytes=None):
+        response = await self.client.send(self.client.build_request('POST', self.url, content=payload), stream=True)
+        try:
+            return await aread_body(response.status_code, response.headers, response.aiter_bytes(CHUNK_SIZE), max_bytes)
+        finally:
+            await response.aclose()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+_transport = None
+_transport_kwargs = {}
+_async_transports = weakref.WeakKeyDictionary()
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    '''
+    Returns the per-process Transport, creating it on first use.
+    '''
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = Transport(**_transport_kwargs)
+    return _transport
+
+
+def get_async_transport():
+    '''
+    Returns the AsyncTransport of the running event loop, creating it on first use.
+    '''
+    loop = asyncio.get_running_loop()
+    async_transport = _async_transports.get(loop)
+    if async_transport is None:
+        async_transport = AsyncTransport(**_transport_kwargs)
+        _async_transports[loop] = async_transport
+    return async_transport
+
+
+def configure(**kwargs):
+    '''
+    Replaces the per-process Transport, e.g. from Django settings at startup.
+    Async transports created afterwards use the same options.
+    '''
+    global _transport, _transport_kwargs
+    with _transport_lock:
+        _transport_kwargs = kwargs
+        if _transport is not None:
+            _transport.close()
+        _transport = Transport(**kwargs)
+    return _transport